@@ -0,0 +1,222 @@
+import os
+import json
+import itertools
+import argparse
+import numpy as np
+import tensorflow as tf
+from training_utils import get_training_data, read_and_decode_single_example, read_and_decode_batches, \
+    read_and_decode_sampled, _read_images, _read_cached_images, scale_batch, load_validation_data, get_batches, \
+    EvaluationData, augment, DATASET_SHAPES
+from dataset_utils import train_images_dir
+from profiling_utils import Stopwatch, peak_rss_mb, git_commit, run_in_subprocess, report_result, write_results
+
+# input paths which read fixed size records, the others can crop or make any size
+RECORD_PATHS = ("queue", "tfdata", "sampler", "numpy", "mmap")
+ALL_PATHS = ("queue", "tfdata", "sampler", "png", "cache", "numpy", "mmap", "augment")
+
+## Build the input tensors of one of the tfrecords, png or augment paths in its own graph
+## Returns: graph and the X, y tensors of a batch
+def _build_graph(config):
+    path = config["path"]
+    batch_size = config["batch_size"]
+    threads = config["threads"]
+    size = config["size"]
+    distort = config["distort"]
+    label_type = config["label_type"]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        if path == "queue":
+            train_files, _ = get_training_data(what=config["dataset"])
+            uint8 = config.get("uint8", False)
+            image, label = read_and_decode_single_example(train_files, label_type=label_type, distort=distort,
+                                                          size=size, uint8=uint8, pack_masks=uint8)
+            X, y = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=75 * batch_size,
+                                          min_after_dequeue=30 * batch_size, num_threads=threads)
+
+            if uint8:
+                X, y = scale_batch(X, y, mask_size=size if label_type == "mask" else None)
+
+        elif path == "tfdata":
+            train_files, _ = get_training_data(what=config["dataset"])
+            X, y = read_and_decode_batches(train_files, batch_size, label_type=label_type, distort=distort, size=size,
+                                           num_parallel_calls=threads, shuffle_buffer=30 * batch_size)
+
+        elif path == "sampler":
+            train_files, _ = get_training_data(what=config["dataset"])
+            X, y, _ = read_and_decode_sampled(train_files, batch_size, label_type=label_type, distort=distort,
+                                              size=size, num_parallel_calls=threads)
+
+        elif path in ("png", "cache"):
+            crops = config.get("crops", 1)
+
+            if path == "cache":
+                image, label = _read_cached_images(config["cache_dir"], size, distort=distort)
+                crops = 1
+            else:
+                image, label = _read_images(config["image_dir"], size, distort=distort, crops_per_image=crops)
+
+            X, y = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=75 * batch_size,
+                                          min_after_dequeue=30 * batch_size, num_threads=threads,
+                                          enqueue_many=crops > 1)
+
+        elif path == "augment":
+            # a fixed batch so only the augmentation is measured
+            rng = np.random.RandomState(0)
+            images = rng.randint(0, 256, size=(batch_size, size, size, 1)).astype(np.uint8)
+            masks = (rng.rand(batch_size, size, size, 1) > 0.98).astype(np.int32)
+
+            X, y = augment(tf.constant(images), tf.constant(masks), horizontal_flip=distort, vertical_flip=distort,
+                           augment_labels=True, mixup=config.get("mixup", 0))
+
+        else:
+            raise ValueError("Unknown input path " + path)
+
+    return graph, X, y
+
+## Build one of the numpy paths
+## Returns: function which returns the next batch
+def _numpy_batches(config):
+    batch_size = config["batch_size"]
+    how = config["label_type"]
+
+    if config["path"] == "numpy":
+        X, y = load_validation_data(how=how, which=config["dataset"], scale=True, size=config["size"])
+
+        def epochs():
+            while True:
+                for batch in get_batches(X, y, batch_size, distort=config["distort"]):
+                    yield batch
+    else:
+        # the memory-mapped evaluation data, threads is the number of batches prefetched
+        data = EvaluationData(how=how, which=config["dataset"], size=config["size"], scale=True,
+                              prefetch=config["threads"])
+
+        def epochs():
+            while True:
+                for batch in data.get_batches(batch_size):
+                    yield batch
+
+    batches = epochs()
+    return lambda: next(batches)
+
+## Run one configuration in this process and report samples/sec, cpu utilization and peak memory
+def run_config(config):
+    if config["path"] in ("numpy", "mmap"):
+        next_batch = _numpy_batches(config)
+        sess = None
+    else:
+        graph, X, y = _build_graph(config)
+
+        with graph.as_default():
+            init = [tf.global_variables_initializer(), tf.local_variables_initializer()]
+
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(inter_op_parallelism_threads=config["threads"]))
+        sess.run(init)
+
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+        next_batch = lambda: sess.run([X, y])
+
+    # the first steps fill the queues
+    for _ in range(config["warmup"]):
+        next_batch()
+
+    stopwatch = Stopwatch()
+    stopwatch.start()
+
+    samples = 0
+    for _ in range(config["steps"]):
+        samples += len(next_batch()[0])
+
+    seconds = stopwatch.stop()
+
+    if sess is not None:
+        coord.request_stop()
+        coord.join(threads, stop_grace_period_secs=5)
+        sess.close()
+
+    return dict(config, samples_per_sec=samples / seconds, seconds=seconds,
+                cpu_utilization=stopwatch.cpu_utilization, peak_rss_mb=peak_rss_mb())
+
+## every combination of the settings to run, the record paths always use the size of the records
+def _configs(args):
+    for path in args.paths:
+        size, label_type = DATASET_SHAPES.get(args.data, (640, 'mask'))
+        sizes = [size] if path in RECORD_PATHS else args.sizes
+
+        for threads, batch_size, size, distort in itertools.product(args.threads, args.batch_sizes, sizes,
+                                                                    args.distort):
+            config = {
+                "path": path,
+                "dataset": args.data,
+                "label_type": "normal" if label_type == "label" else label_type,
+                "batch_size": batch_size,
+                "threads": threads,
+                "size": size,
+                "distort": bool(distort),
+                "steps": args.steps,
+                "warmup": args.warmup,
+            }
+
+            if path == "queue":
+                config["uint8"] = args.uint8
+            elif path == "png":
+                config["image_dir"] = args.images or train_images_dir()
+                config["crops"] = args.crops
+            elif path == "cache":
+                if args.cache is None:
+                    continue
+                config["cache_dir"] = args.cache
+
+            yield config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--paths", help="input paths to benchmark", nargs="+", default=list(ALL_PATHS),
+                        choices=ALL_PATHS)
+    parser.add_argument("-d", "--data", help="which dataset to read", default=12, type=int)
+    parser.add_argument("-t", "--threads", help="thread counts to try", nargs="+", default=[1, 2, 4, 8], type=int)
+    parser.add_argument("-b", "--batch_sizes", help="batch sizes to try", nargs="+", default=[8, 16, 32], type=int)
+    parser.add_argument("--sizes", help="crop sizes to try for the png, cache and augment paths", nargs="+",
+                        default=[320, 640], type=int)
+    parser.add_argument("--distort", help="distortion settings to try, 0 and/or 1", nargs="+", default=[0, 1], type=int)
+    parser.add_argument("--steps", help="number of timed batches", default=50, type=int)
+    parser.add_argument("--warmup", help="number of batches before timing", default=10, type=int)
+    parser.add_argument("--uint8", help="queue uint8 examples in the queue path", nargs='?', const=True, default=False)
+    parser.add_argument("--images", help="directory of pngs for the png path, defaults to the manifest's",
+                        default=None)
+    parser.add_argument("--cache", help="decoded image cache for the cache path", default=None)
+    parser.add_argument("--crops", help="crops per decoded png", default=1, type=int)
+    parser.add_argument("--timeout", help="seconds before a configuration is recorded as failed", default=600,
+                        type=int)
+    parser.add_argument("-o", "--out", help="where to write the results, as .csv and .json", default="benchmark_inputs")
+    parser.add_argument("--run", help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    # run a single configuration, called by the parent process
+    if args.run is not None:
+        report_result(run_config(json.loads(args.run)))
+    else:
+        commit = git_commit()
+        results = []
+
+        for config in _configs(args):
+            # a configuration which fails or hangs is recorded with its error and the sweep goes on
+            result = run_in_subprocess(os.path.abspath(__file__), config, timeout=args.timeout)
+            result["commit"] = commit
+            results.append(result)
+
+            description = "{path} batch {batch_size} threads {threads} size {size} distort {distort}".format(**config)
+            if "error" in result:
+                print(description, "failed:", result["error"])
+            else:
+                print(description + ": {samples_per_sec:.1f} samples/sec, {cpu_utilization:.2f} cpus, "
+                      "{peak_rss_mb:.0f} MB".format(**result))
+
+            # write the results so far, so they are kept if the sweep is interrupted
+            write_results(results, args.out)
+
+        csv_path, json_path = write_results(results, args.out)
+        print("Wrote results to", csv_path, "and", json_path)
@@ -0,0 +1,181 @@
+import os
+import sys
+import glob
+import json
+import socket
+import shlex
+import argparse
+import tensorflow as tf
+from graph_utils import build_candidate_graph, candidate_tensors, count_parameters, synthetic_feed
+from profiling_utils import Stopwatch, peak_rss_mb, git_commit, run_in_subprocess, report_result, write_results
+
+DEFAULT_MODELS = ["candidate_*.py", "vgg_16.3.py", "inception_v4.05.py"]
+
+## count the floating point operations of one run of fetches, using the shapes from a traced run so the batch size
+## is known
+def _count_flops(sess, fetches, feed_dict):
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+             run_metadata=run_metadata)
+
+    options = tf.profiler.ProfileOptionBuilder(tf.profiler.ProfileOptionBuilder.float_operation()) \
+        .with_empty_output().build()
+    profile = tf.profiler.profile(sess.graph, run_meta=run_metadata, cmd='op', options=options)
+
+    return profile.total_float_ops
+
+## time steps runs of fetches after warmup runs
+## Returns: seconds per step and the cpu utilization
+def _time_steps(sess, fetches, feed_dict, steps, warmup):
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+
+    stopwatch = Stopwatch()
+    stopwatch.start()
+
+    for _ in range(steps):
+        sess.run(fetches, feed_dict=feed_dict)
+
+    return stopwatch.stop() / steps, stopwatch.cpu_utilization
+
+## make any network connection from this process fail
+def _block_network():
+    def refuse(*args, **kwargs):
+        raise IOError("network access is blocked")
+
+    socket.socket.connect = refuse
+    socket.getaddrinfo = refuse
+
+## Build a model's graph with the network blocked, to check it builds without downloading anything
+def check_config(config):
+    _block_network()
+
+    namespace = build_candidate_graph(config["model"], config["argv"])
+    graph = namespace["graph"]
+
+    return {
+        "model": os.path.basename(config["model"]),
+        "argv": " ".join(config["argv"]),
+        "nodes": len(graph.as_graph_def().node),
+        "parameters": count_parameters(graph),
+    }
+
+## Build a model's graph and time forward and forward + backward steps on a synthetic batch
+def run_config(config):
+    namespace = build_candidate_graph(config["model"], config["argv"])
+    tensors = candidate_tensors(namespace)
+    graph = tensors["graph"]
+
+    batch_size = config["batch_size"] or namespace.get("batch_size", 16)
+    feed_dict = synthetic_feed(tensors, batch_size)
+
+    with graph.as_default():
+        init = [tf.global_variables_initializer(), tf.local_variables_initializer()]
+
+    with tf.Session(graph=graph) as sess:
+        sess.run(init)
+
+        # the placeholders are fed so the input queues are never touched and don't need to be started
+        forward_feed = dict(feed_dict, **{tensors["training"]: False})
+        train_feed = dict(feed_dict, **{tensors["training"]: True})
+
+        forward = tensors["logits"]
+        train = [tensors["train_op"], tensors["extra_update_ops"]]
+
+        forward_seconds, forward_cpu = _time_steps(sess, forward, forward_feed, config["steps"], config["warmup"])
+        train_seconds, train_cpu = _time_steps(sess, train, train_feed, config["steps"], config["warmup"])
+
+        forward_flops = _count_flops(sess, forward, forward_feed) if config["flops"] else None
+
+    return {
+        "model": os.path.basename(config["model"]),
+        "argv": " ".join(config["argv"]),
+        "input_shape": "x".join(str(d) for d in tensors["X"].get_shape().as_list()[1:]),
+        "batch_size": batch_size,
+        "parameters": count_parameters(graph),
+        "forward_gflops_per_image": forward_flops / batch_size / 1e9 if forward_flops is not None else "",
+        "forward_images_per_sec": batch_size / forward_seconds,
+        "train_images_per_sec": batch_size / train_seconds,
+        "forward_cpu_utilization": forward_cpu,
+        "train_cpu_utilization": train_cpu,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--models", help="model scripts or patterns to benchmark", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("-a", "--args", help="command line arguments to build every model with, i.e. \"-d 12 --size 320\"",
+                        default="")
+    parser.add_argument("-b", "--batch_size", help="batch size, defaults to each script's own", default=None, type=int)
+    parser.add_argument("--steps", help="number of timed steps", default=10, type=int)
+    parser.add_argument("--warmup", help="number of steps before timing", default=2, type=int)
+    parser.add_argument("--no_flops", help="don't count the flops", nargs='?', const=True, default=False)
+    parser.add_argument("--gpu", help="allow the models to use a gpu", nargs='?', const=True, default=False)
+    parser.add_argument("--check", help="only check that each model's graph builds with the network blocked",
+                        nargs='?', const=True, default=False)
+    parser.add_argument("-o", "--out", help="where to write the report, as .csv and .json", default="benchmark_models")
+    parser.add_argument("--run", help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    # benchmark a single model, called by the parent process
+    if args.run is not None:
+        config = json.loads(args.run)
+        report_result(check_config(config) if config.get("check") else run_config(config))
+    elif args.check:
+        models = []
+        for pattern in args.models:
+            models.extend(sorted(glob.glob(pattern)))
+
+        failed = []
+        for model in models:
+            result = run_in_subprocess(os.path.abspath(__file__), {
+                "model": os.path.abspath(model),
+                "argv": shlex.split(args.args),
+                "check": True,
+            }, env={"CUDA_VISIBLE_DEVICES": ""})
+
+            if "error" in result:
+                failed.append(model)
+                print(model, "failed:", result["error"])
+            else:
+                print("{}: built offline, {} nodes, {} parameters".format(model, result["nodes"], result["parameters"]))
+
+        print(len(models) - len(failed), "of", len(models), "models built without network access")
+        if failed:
+            sys.exit(1)
+    else:
+        models = []
+        for pattern in args.models:
+            models.extend(sorted(glob.glob(pattern)))
+
+        # only measure the cpu unless told otherwise
+        env = None if args.gpu else {"CUDA_VISIBLE_DEVICES": ""}
+        commit = git_commit()
+        results = []
+
+        for model in models:
+            config = {
+                "model": os.path.abspath(model),
+                "argv": shlex.split(args.args),
+                "batch_size": args.batch_size,
+                "steps": args.steps,
+                "warmup": args.warmup,
+                "flops": not args.no_flops,
+            }
+
+            result = run_in_subprocess(os.path.abspath(__file__), config, env=env)
+            result["model"] = os.path.basename(model)
+            result["commit"] = commit
+            results.append(result)
+
+            if "error" in result:
+                print(model, "failed:", result["error"])
+            else:
+                print("{model}: {forward_images_per_sec:.2f} images/sec forward, {train_images_per_sec:.2f} images/sec "
+                      "train, {parameters} parameters, {peak_rss_mb:.0f} MB".format(**result))
+
+        # fastest to train first
+        results.sort(key=lambda result: -result.get("train_images_per_sec", 0))
+
+        csv_path, json_path = write_results(results, args.out)
+        print("Wrote report to", csv_path, "and", json_path)
@@ -0,0 +1,16 @@
+import os
+import argparse
+from training_utils import build_image_cache
+from dataset_utils import train_images_dir
+
+# Decode the training pngs for dataset 100 once and store them in shards of raw images
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", "--images", help="directory of training pngs, defaults to the manifest's", default=None)
+parser.add_argument("-o", "--out", help="directory to write the cache to", default=os.path.join("data", "image_cache"))
+parser.add_argument("-s", "--scale", help="resize the images by this factor before caching them", default=None, type=float)
+parser.add_argument("--shard_mb", help="maximum size of each shard in MB", default=1024, type=int)
+args = parser.parse_args()
+
+image_dir = args.images or train_images_dir()
+total = build_image_cache(image_dir, args.out, scale_by=args.scale, shard_bytes=args.shard_mb * 2 ** 20)
+print("Cached", total, "images to", args.out)
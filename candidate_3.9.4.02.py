@@ -3,9 +3,13 @@ import os
 import wget
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
-from training_utils import download_file, get_batches, load_validation_data, \
-    download_data, get_training_data, load_weights, flatten, _conv2d_batch_norm, _read_images, \
-    read_and_decode_single_example, augment
+from training_utils import get_training_data, _conv2d_batch_norm, _read_images, read_and_decode_single_example, \
+    augment, read_and_decode_batches, read_and_decode_sampled, scale_batch, get_evaluation_data, _read_cached_images, \
+    ImageCache, build_feature_cache, FeatureCache, DATASET_SHAPES
+from dataset_utils import train_images_dir
+from profiling_utils import TraceSampler, StepTimer, parse_step_window
+from trainer_utils import Trainer
+from filter_utils import TileFilter, rejected_crop_fraction
 import argparse
 from tensorboard import summary as summary_lib
 
@@ -27,8 +31,23 @@ parser.add_argument("-w", "--weight", help="weight to give to positive examples
                     type=float)
 parser.add_argument("-v", "--version", help="version or run number to assign to model name", default="")
 parser.add_argument("--distort", help="use online data augmentation", default=False, const=True, nargs="?")
-parser.add_argument("--size", help="size of image to crop (default 640)", default=640, type=int)
+parser.add_argument("--size", help="size of image to crop, defaults to the size of the dataset's images", default=None, type=int)
 parser.add_argument("-i", "--iou", help="DO NOT use iou loss, use x-entropy instead", nargs='?', const=True, default=False)
+parser.add_argument("--tfdata", help="use the tf.data input pipeline instead of queue runners", nargs='?', const=True, default=False)
+parser.add_argument("--sampler", help="read the training records in a full random permutation every epoch", nargs='?', const=True, default=False)
+parser.add_argument("--packed", help="read the training records with bit-packed masks written by pack_masks.py", nargs='?', const=True, default=False)
+parser.add_argument("--uint8", help="queue examples as uint8 with bit-packed masks and scale after batching", nargs='?', const=True, default=False)
+parser.add_argument("--cache", help="directory of decoded image cache to crop dataset 100 from", default=None)
+parser.add_argument("--crops", help="number of random crops to take from each decoded image for dataset 100", default=1, type=int)
+parser.add_argument("--trace_every", help="trace every nth training step, 0 to turn tracing off", default=0, type=int)
+parser.add_argument("--trace_steps", help="window of training steps to trace, as start:stop", default=None)
+parser.add_argument("--time_every", help="split every nth step into input wait and compute, 0 to turn timing off", default=100, type=int)
+parser.add_argument("--features", help="directory to cache the frozen layers' output in and train the head from, requires --freeze", default=None)
+parser.add_argument("--save_steps", help="also save a checkpoint every n steps", default=None, type=int)
+parser.add_argument("--save_seconds", help="also save a checkpoint every n seconds", default=None, type=float)
+parser.add_argument("--keep", help="number of step checkpoints to keep", default=3, type=int)
+parser.add_argument("--filter_crops", help="take the dataset 100 crops from positions which are not mostly background", nargs='?', const=True, default=False)
+parser.add_argument("--dynamic", help="build the graph for inputs of any size, for running on whole scans", nargs='?', const=True, default=False)
 args = parser.parse_args()
 
 epochs = args.epochs
@@ -42,11 +61,29 @@ freeze = args.freeze
 stop = args.stop
 contrast = args.contrast
 normalize = args.normalize
-size = args.size
+# the records are stored at their dataset's size, only the crops of dataset 100 can be taken at another size
+size = args.size or DATASET_SHAPES.get(dataset, (640, 'mask'))[0]
+if dataset != 100 and dataset in DATASET_SHAPES and size != DATASET_SHAPES[dataset][0]:
+    parser.error("dataset %d has %d pixel images, --size can only be changed for dataset 100" % (dataset, DATASET_SHAPES[dataset][0]))
 weight = args.weight - 1
 distort = args.distort
 version = args.version
 iou_loss = args.iou
+tfdata = args.tfdata
+use_sampler = args.sampler
+packed_labels = args.packed
+uint8 = args.uint8
+image_cache = args.cache
+crops_per_image = args.crops
+trace_every = args.trace_every
+trace_start, trace_stop = parse_step_window(args.trace_steps)
+feature_dir = args.features
+time_every = args.time_every
+save_steps = args.save_steps
+save_seconds = args.save_seconds
+keep_checkpoints = args.keep
+dynamic_shapes = args.dynamic
+filter_crops = args.filter_crops
 
 # figure out how to label the model name
 if how == "label":
@@ -65,10 +102,13 @@ else:
 batch_size = 16
 
 if dataset != 100:
-    train_files, total_records = get_training_data(what=dataset)
+    train_files, total_records = get_training_data(what=dataset, packed=packed_labels)
+elif image_cache is not None:
+    # use each image 3 times for each epoch since we are taking random crops
+    total_records = len(ImageCache(image_cache)) * 3
 else:
     # use each image 3 times for each epoch since we are taking random crops
-    total_records = len(os.listdir(os.path.join("data", "train_images"))) * 3
+    total_records = len(os.listdir(train_images_dir())) * 3
 
 ## Hyperparameters
 epsilon = 1e-8
@@ -211,24 +251,58 @@ with graph.as_default():
 
     with tf.name_scope('inputs') as scope:
         with tf.device('/cpu:0'):
-            if dataset == 100:
+            input_sampler = None
+
+            if dataset == 100 and image_cache is not None:
+                # crop from the pre-decoded images
+                image, label = _read_cached_images(image_cache, size, scale_by=0.66, distort=False,
+                                                   standardize=normalize)
+            elif dataset == 100:
                 # decode the image
-                image, label = _read_images("./data/train_images/", size, scale_by=0.66, distort=False,
-                                            standardize=normalize)
+                image, label = _read_images(train_images_dir(), size, scale_by=0.66, distort=False,
+                                            standardize=normalize, crops_per_image=crops_per_image,
+                                            tile_filter=TileFilter() if filter_crops else None)
+
+                if filter_crops:
+                    crops_rejected = rejected_crop_fraction()
+                    tf.summary.scalar('crops_rejected', crops_rejected, collections=["summaries"])
+            elif tfdata:
+                # read and parse whole batches with tf.data
+                X_def, y_def = read_and_decode_batches(train_files, batch_size, label_type=how, normalize=False,
+                                                       distort=False, size=size, num_parallel_calls=6,
+                                                       shuffle_buffer=30 * batch_size, packed_labels=packed_labels)
+            elif use_sampler:
+                # read the records in a new permutation of the whole dataset every epoch
+                X_def, y_def, input_sampler = read_and_decode_sampled(train_files, batch_size, label_type=how,
+                                                                      normalize=False, distort=False, size=size,
+                                                                      num_parallel_calls=6, packed_labels=packed_labels)
             else:
                 image, label = read_and_decode_single_example(train_files, label_type=how, normalize=False,
-                                                              distort=False, size=640)
+                                                              distort=False, size=size, uint8=uint8,
+                                                              pack_masks=uint8, packed_labels=packed_labels)
+
+            if dataset == 100 or not (tfdata or use_sampler):
+                # when several crops are taken from each image they are enqueued together and mixed by the shuffle
+                many = dataset == 100 and image_cache is None and crops_per_image > 1
+                X_def, y_def = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=75 * batch_size,
+                                                      seed=None, num_threads=6, min_after_dequeue=30 * batch_size,
+                                                      enqueue_many=many)
 
-            X_def, y_def = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=75 * batch_size,
-                                                  seed=None, num_threads=6, min_after_dequeue=30 * batch_size)
+            # the examples were queued as uint8 so scale the whole batch at once
+            if uint8 and dataset != 100 and not (tfdata or use_sampler):
+                X_def, y_def = scale_batch(X_def, y_def, mu=127.0, scale=255.0, mask_size=size)
 
             if distort:
                 X_def, y_def = augment(X_def, y_def, horizontal_flip=True, augment_labels=True, vertical_flip=True,
                                        mixup=0)
 
-        # Placeholders
-        X = tf.placeholder_with_default(X_def, shape=[None, size, size, 1])
-        y = tf.placeholder_with_default(y_def, shape=[None, size, size, 1])
+        # Placeholders, the height and width are left open for whole scans if the graph is built with --dynamic
+        input_shape = [None, None, None, 1] if dynamic_shapes else [None, size, size, 1]
+        X = tf.placeholder_with_default(X_def, shape=input_shape)
+        y = tf.placeholder_with_default(y_def, shape=input_shape)
+
+        # the height and width the upsampling resizes to, which have to be a multiple of 32
+        image_size = tf.shape(X)[1:3] if dynamic_shapes else [size, size]
 
         X_adj = tf.cast(X, tf.float32)
         y_adj = tf.cast(y, tf.int32)
@@ -1028,8 +1102,8 @@ with graph.as_default():
 
     # resize images - 80x80x256
     with tf.name_scope('resize_1') as scope:
-        new_size = int(size // 8)
-        unpool1 = tf.image.resize_images(fc1, size=[new_size, new_size],
+        new_size = image_size // 8 if dynamic_shapes else [size // 8, size // 8]
+        unpool1 = tf.image.resize_images(fc1, size=new_size,
                                          method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
 
     # 80x80x128
@@ -1067,7 +1141,8 @@ with graph.as_default():
 
     # resize to 160x160x128
     with tf.name_scope('resize_6') as scope:
-        unpool6 = tf.image.resize_images(unpool21, size=[size // 4, size // 4],
+        new_size = image_size // 4 if dynamic_shapes else [size // 4, size // 4]
+        unpool6 = tf.image.resize_images(unpool21, size=new_size,
                                          method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
 
     # 160x160x64
@@ -1122,7 +1197,7 @@ with graph.as_default():
 
     # resize the logits
     with tf.name_scope('resize_11') as scope:
-        logits = tf.image.resize_images(logits, size=[size, size],
+        logits = tf.image.resize_images(logits, size=image_size,
                                         method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
 
     # softmax the logits and take the last dimension
@@ -1200,14 +1275,20 @@ with graph.as_default():
 
     train_op_1 = optimizer.minimize(loss, global_step=global_step)
 
+    # an image is positive if more than 1/750 of its pixels are
+    if dynamic_shapes:
+        positive_pixels = tf.cast(tf.reduce_prod(image_size) // 750, tf.float32)
+    else:
+        positive_pixels = size * size // 750
+
     # squash the predictions into a per image prediction - negative images will have a max of 0
     pred_sum = tf.reduce_sum(predictions, axis=[1, 2])
-    image_predictions = tf.cast(tf.greater(pred_sum, (size * size // 750)), dtype=tf.uint8)
+    image_predictions = tf.cast(tf.greater(pred_sum, positive_pixels), dtype=tf.uint8)
     image_truth = tf.reduce_max(y_adj, axis=[1, 2])
 
     # set a threshold on the predictions so we ignore images with only a few positive pixels
     pred_sum = tf.reduce_sum(predictions, axis=[1, 2])
-    image_predictions = tf.cast(tf.greater(pred_sum, (size * size // 750)), dtype=tf.uint8)
+    image_predictions = tf.cast(tf.greater(pred_sum, positive_pixels), dtype=tf.uint8)
 
     # get the accuracy per pixel
     accuracy, acc_op = tf.metrics.accuracy(
@@ -1268,258 +1349,86 @@ with graph.as_default():
     print("Graph created...")
 
 ## CONFIGURE OPTIONS
-if init_model is not None:
-    if os.path.exists(os.path.join("model", init_model + '.ckpt.index')):
-        init = False
-    else:
-        init = True
-elif restore_model is not None:
-    if os.path.exists(os.path.join("model", restore_model + '.ckpt.index')):
-        init = False
-    else:
-        init = True
-else:
-    if os.path.exists(os.path.join("model", model_name + '.ckpt.index')):
-        init = False
-    else:
-        init = True
-
-meta_data_every = 1
 log_to_tensorboard = True
 print_every = 1 # how often to print metrics
 checkpoint_every = 1  # how often to save model in epochs
-print_metrics = True  # whether to print or plot metrics, if False a plot will be created and updated every epoch
-#
-# # Initialize metrics
-# valid_acc_values = []
-# valid_cost_values = []
-# valid_recall_values = []
 
 # create the config
 config = tf.ConfigProto()
 
-# if we are freezing some layers adjust the steps per epoch since we will do one extra training step
-if freeze:
-    steps_per_epoch -= 1
+# the tensors the trainer needs from the graph
+tensors = {
+    'X': X,
+    'y': y,
+    'training': training,
+    'global_step': global_step,
+    'train_op': train_op_1,
+    'frozen_train_op': train_op_2 if freeze else None,
+    'extra_update_ops': extra_update_ops,
+    'metrics_op': metrics_op,
+    'merged': merged,
+    'features': pool4,
+    'train_metrics': {
+        'precision': prec_op,
+        'accuracy': accuracy,
+        'cost': mean_ce,
+        'recall': rec_op,
+        'learning_rate': learning_rate,
+    },
+    'eval_metrics': {
+        'accuracy': accuracy,
+        'recall': recall,
+        'precision': precision,
+        'iou': iou_score,
+    },
+}
+
+# report how many of the random crops were rejected as background
+if dataset == 100 and image_cache is None and filter_crops:
+    tensors['train_metrics']['crops_rejected'] = crops_rejected
+
+# only the sampled steps are run with tracing on
+tracer = TraceSampler(every=trace_every, start=trace_start, stop=trace_stop)
+
+# break the step time down into input wait and compute
+timer = StepTimer(every=time_every, report_every=500)
 
 ## train the model
-with tf.Session(graph=graph, config=config) as sess:
-    if log_to_tensorboard:
-        train_writer = tf.summary.FileWriter('./logs/tr_' + model_name, sess.graph)
-        test_writer = tf.summary.FileWriter('./logs/te_' + model_name)
-
-    # create the saver
-    saver = tf.train.Saver()
-    sess.run(tf.local_variables_initializer())
-
-    # If the model is new initialize variables, else restore the session
-    if init:
-        sess.run(tf.global_variables_initializer())
-        print("Initializing model...")
-    else:
-        # if we are initializing with the weights from another model load it
-        if init_model is not None:
-            # initialize the global variables
-            sess.run(tf.global_variables_initializer())
+with Trainer(graph, tensors, model_name, config=config, log_to_tensorboard=log_to_tensorboard,
+             checkpoint_every=checkpoint_every, print_every=print_every, tracer=tracer, timer=timer,
+             checkpoint_steps=save_steps, checkpoint_seconds=save_seconds, keep_checkpoints=keep_checkpoints,
+             sampler=input_sampler) as trainer:
+    trainer.initialize(init_model=init_model, restore_model=restore_model)
 
-            # create the initializer function to initialize the weights
-            init_fn = load_weights(init_model, exclude=[])
-
-            # run the initializer
-            init_fn(sess)
-
-            # reset the global step
-            initial_global_step = global_step.assign(0)
-            sess.run(initial_global_step)
-
-            print("Initializing weights from model", init_model)
-
-            # reset init model so we don't do this again
-            init_model = None
-        elif restore_model is not None:
-            saver.restore(sess, './model/' + restore_model + '.ckpt')
-            print("Restoring model from", restore_model)
+    # if we are training the model
+    if action == "train":
+        # map the validation data once, it is reused every epoch
+        cv_data = get_evaluation_data(how=how, which=dataset, size=size, scale=True)
 
-            # initial_global_step = global_step.assign(0)
-            # sess.run(initial_global_step)
+        # run the frozen layers over the training data once and train the head from their cached output
+        if freeze and feature_dir is not None:
+            if not os.path.exists(os.path.join(feature_dir, "features.json")):
+                print("Caching output of frozen layers...")
+                build_feature_cache(trainer.sess, pool4, y, steps_per_epoch, feature_dir, feed_dict={training: False})
 
-        # otherwise load this model
+            feature_cache = FeatureCache(feature_dir)
         else:
-            saver.restore(sess, './model/' + model_name + '.ckpt')
-            print("Restoring model", model_name)
+            feature_cache = None
 
-    # start the queue runners
-    coord = tf.train.Coordinator()
-    threads = tf.train.start_queue_runners(coord=coord)
+        trainer.train(epochs, steps_per_epoch, eval_data=cv_data, batch_size=batch_size, freeze=freeze,
+                      feature_cache=feature_cache)
 
-    # if we are training the model
-    if action == "train":
-
-        print("Training model", model_name, "...")
+    # stop the queue runners, the test data is fed directly
+    trainer.stop_queues()
 
-        for epoch in range(epochs):
-            sess.run(tf.local_variables_initializer())
-
-            if freeze:
-                train_op = train_op_2
-            else:
-                train_op = train_op_1
-
-            # Accuracy values (train) after each batch
-            batch_acc = []
-            batch_cost = []
-            batch_recall = []
-
-            for i in range(steps_per_epoch):
-                # create the metadata
-                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
-
-                # Run training op and update ops
-                if (i % 50 != 0) or (i == 0):
-                    # log the kernel images once per epoch
-                    if False: #(i == (steps_per_epoch - 1)) and log_to_tensorboard:
-                        _, _, step = sess.run(
-                            [train_op, extra_update_ops, kernel_summaries, global_step],
-                            feed_dict={
-                                training: True,
-                            },
-                            options=run_options,
-                            run_metadata=run_metadata)
-
-                        # write the summary
-                        train_writer.add_summary(image_summary, step)
-
-                    else:
-                        _, _, step = sess.run(
-                            [train_op, extra_update_ops, global_step],
-                            feed_dict={
-                                training: True,
-                            },
-                            options=run_options,
-                            run_metadata=run_metadata)
-
-                # every 50th step get the metrics
-                else:
-                    _, _, precision_value, summary, acc_value, cost_value, recall_value, step, lr = sess.run(
-                        [train_op, extra_update_ops, prec_op, merged, accuracy, mean_ce, rec_op, global_step,
-                         learning_rate],
-                        feed_dict={
-                            training: True,
-                        },
-                        options=run_options,
-                        run_metadata=run_metadata)
-
-                    # Save accuracy (current batch)
-                    batch_acc.append(acc_value)
-                    batch_cost.append(cost_value)
-                    batch_recall.append(recall_value)
-
-                    # log the summaries to tensorboard every 50 steps
-                    if log_to_tensorboard:
-                        # write the summary
-                        train_writer.add_summary(summary, step)
-
-                # only log the meta data once per epoch
-                if i == 1:
-                    train_writer.add_run_metadata(run_metadata, 'step %d' % step)
-
-            # save checkpoint every nth epoch
-            if (epoch % checkpoint_every == 0):
-                # if we have frozen some layers run one more iteration on the full training op so we (hopefully) save the entire graph
-                if freeze:
-                    _ = sess.run(train_op_1, feed_dict={
-                        training: True,
-                    })
-
-                print("Saving checkpoint")
-                save_path = saver.save(sess, './model/' + model_name + '.ckpt')
-
-                # Now that model is saved set init to false so we reload it next time
-                init = False
-
-            # init batch arrays
-            batch_cv_acc = []
-            batch_cv_loss = []
-            batch_cv_recall = []
-
-            # initialize the local variables so we have metrics only on the evaluation
-            sess.run(tf.local_variables_initializer())
-
-            print("Evaluating model...")
-            # load the test data
-            X_cv, y_cv = load_validation_data(percentage=1, how=how, which=dataset, scale=True, size=size)
-            counter = 0
-
-            # evaluate on pre-cropped images
-            for X_batch, y_batch in get_batches(X_cv, y_cv, batch_size, distort=False):
-                _, valid_acc, valid_recall, valid_cost = sess.run(
-                    [metrics_op, accuracy, recall, mean_ce],
-                    feed_dict={
-                        X: X_batch,
-                        y: y_batch,
-                        training: False
-                    })
-
-            # one more step to get our metrics
-            summary, valid_acc, valid_recall, valid_prec, iou = sess.run(
-                [merged, accuracy, recall, precision, iou_score],
-                feed_dict={
-                    training: False
-                })
-
-            batch_cv_acc.append(valid_acc)
-            batch_cv_loss.append(valid_cost)
-            batch_cv_recall.append(valid_recall)
-
-            if log_to_tensorboard:
-                test_writer.add_summary(summary, step)
-
-            step += 1
-
-            # delete the test data to save memory
-            del (X_cv)
-            del (y_cv)
-
-            print("Done evaluating...")
-
-            # Print progress every nth epoch to keep output to reasonable amount
-            if (epoch % print_every == 0):
-                print(
-                    'Epoch {:02d} - step {} - cv acc: {:.4f} - train acc: {:.3f} (mean)'.format(
-                        epoch, step, np.mean(batch_cv_acc), np.mean(batch_acc)
-                    ))
-
-    # stop the coordinator
-    coord.request_stop()
-
-    # Wait for threads to stop
-    coord.join(threads)
-
-    sess.run(tf.local_variables_initializer())
     print("Evaluating on test data")
 
     # evaluate the test data
-    X_te, y_te = load_validation_data(how=how, data="test", which=dataset, scale=True, size=size)
-
-    for X_batch, y_batch in get_batches(X_te, y_te, batch_size, distort=False):
-        _ = sess.run([metrics_op],
-            feed_dict=
-            {
-                X: X_batch,
-                y: y_batch,
-                training: False
-            })
-
-    # one more step to get our metrics
-    summary, test_acc, test_recall, test_prec, test_iou = sess.run(
-        [merged, accuracy, recall, precision, iou_score],
-        feed_dict={
-            training: False
-        })
+    te_data = get_evaluation_data(data="test", how=how, which=dataset, size=size, scale=True)
+    results = trainer.evaluate(te_data, batch_size, writer=None)
 
     # print the results
-    print("Mean Test Accuracy:", test_acc)
-    print("Mean Test Recall:", test_recall)
-    print("Mean Test Precision:", test_prec)
-    print("Mean Test IOU:", test_iou)
+    print("Mean Test Accuracy:", results['accuracy'])
+    print("Mean Test Recall:", results['recall'])
+    print("Mean Test Precision:", results['precision'])
+    print("Mean Test IOU:", results['iou'])
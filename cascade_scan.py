@@ -0,0 +1,134 @@
+import os
+import time
+import shlex
+import argparse
+import numpy as np
+import tensorflow as tf
+from graph_utils import build_candidate_graph
+from inference_utils import TiledInference, ClassifierGate, tile_positions, cascade_recall_curve
+from filter_utils import TileFilter
+from profiling_utils import write_results
+from infer_scan import read_scan
+
+# the classifier scripts default to a dataset which no longer exists, so the one they were trained on is passed in
+CLASSIFIER_ARGS = "-d 8 -l normal"
+
+## Build a candidate's graph and restore it in its own session. Only the checkpoint is needed, so the training data the
+## scripts download before building their graphs, i.e. the classifier's dataset, is never fetched.
+## Returns: the script's namespace and the session
+def restore_candidate(script, argv, checkpoint=None):
+    namespace = build_candidate_graph(script, argv, download=False)
+    checkpoint = checkpoint or os.path.join("./model", namespace["model_name"] + ".ckpt")
+
+    with namespace["graph"].as_default():
+        saver = tf.train.Saver()
+
+    sess = tf.Session(graph=namespace["graph"])
+    saver.restore(sess, checkpoint)
+    print("Restored", checkpoint)
+
+    return namespace, sess
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scans", help="scans to run the cascade on, as .npy or png", nargs="+")
+    parser.add_argument("-m", "--model", help="segmentation model script", default="candidate_3.9.4.02.py")
+    parser.add_argument("-a", "--args", help="command line arguments the segmentation model was trained with", default="")
+    parser.add_argument("-c", "--checkpoint", help="segmentation checkpoint, defaults to the model's own", default=None)
+    parser.add_argument("--classifier", help="normal/abnormal classifier script", default="candidate_1.0.0.29.py")
+    parser.add_argument("--classifier_args", help="command line arguments the classifier was trained with",
+                        default=CLASSIFIER_ARGS)
+    parser.add_argument("--classifier_checkpoint", help="classifier checkpoint, defaults to the model's own", default=None)
+    parser.add_argument("-t", "--threshold", help="abnormality score a tile needs to be segmented", default=0.5, type=float)
+    parser.add_argument("--stride", help="pixels between tiles, defaults to three quarters of a tile", default=None, type=int)
+    parser.add_argument("-b", "--batch_size", help="number of tiles per batch", default=8, type=int)
+    parser.add_argument("--scale_by", help="factor to resize the scans by before tiling", default=1.0, type=float)
+    parser.add_argument("--filter", help="skip background tiles before classifying them", nargs='?', const=True,
+                        default=False)
+    parser.add_argument("--baseline", help="also time the segmenter on every tile", nargs='?', const=True, default=False)
+    parser.add_argument("--curve", help="measure the recall of the cascade against the masks in the second channel of "
+                        "the scans at these thresholds", nargs="*", default=None, type=float)
+    parser.add_argument("-o", "--out", help="directory to write the probability maps and curve to", default="predictions")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+
+    segmenter, segmenter_sess = restore_candidate(args.model, shlex.split(args.args), args.checkpoint)
+    classifier, classifier_sess = restore_candidate(args.classifier, shlex.split(args.classifier_args),
+                                                    args.classifier_checkpoint)
+
+    # the classifiers which predict the abnormality type have the normal class first
+    if "abnormal_probability" in classifier:
+        abnormal_probability = classifier["abnormal_probability"]
+    else:
+        with classifier["graph"].as_default():
+            abnormal_probability = 1 - classifier["probabilities"][:, 0]
+
+    prefilter = TileFilter() if args.filter else None
+    gate = ClassifierGate(classifier_sess, classifier["X"], abnormal_probability, threshold=args.threshold,
+                          batch_size=args.batch_size * 4, feed_dict={classifier["training"]: False},
+                          prefilter=prefilter)
+
+    inference = TiledInference(segmenter_sess, segmenter["X"], segmenter["logits_sm"], tile_size=segmenter["size"],
+                               stride=args.stride, batch_size=args.batch_size,
+                               feed_dict={segmenter["training"]: False}, tile_filter=gate)
+
+    thresholds = args.curve if args.curve else np.linspace(0.05, 0.95, 19).tolist()
+    curve = []
+
+    for path in args.scans:
+        scan = read_scan(path, scale_by=args.scale_by)
+        name = os.path.splitext(os.path.basename(path))[0]
+
+        out = np.lib.format.open_memmap(os.path.join(args.out, name + "_probabilities.npy"), mode="w+",
+                                        dtype=np.float32, shape=scan.shape)
+
+        start = time.time()
+        inference.predict(scan, out=out)
+        seconds = time.time() - start
+        out.flush()
+        del out
+
+        print("{}: segmented {} of {} tiles ({:.0%} skipped), {:.2f} seconds".format(
+            name, inference.tiles_run, inference.total_tiles, inference.skipped_fraction(), seconds))
+
+        if args.baseline:
+            inference.tile_filter = prefilter
+            start = time.time()
+            inference.predict(scan)
+            baseline_seconds = time.time() - start
+            inference.tile_filter = gate
+
+            print("    without the classifier: {:.2f} seconds, {:.1f}x faster with it".format(
+                baseline_seconds, baseline_seconds / seconds))
+
+        if args.curve is not None:
+            mask = read_scan(path, scale_by=args.scale_by, channel=1)
+            ys = tile_positions(scan.shape[0], inference.tile_size, inference.stride)
+            xs = tile_positions(scan.shape[1], inference.tile_size, inference.stride)
+
+            for point in cascade_recall_curve(gate.scores, mask, ys, xs, inference.tile_size, thresholds):
+                point["scan"] = name
+                curve.append(point)
+
+    if curve:
+        # the curve over all of the scans, weighting each scan the same
+        for threshold in thresholds:
+            points = [point for point in curve if point["threshold"] == threshold and point["scan"] != "all"]
+            curve.append({
+                "scan": "all",
+                "threshold": threshold,
+                "tiles_segmented": float(np.mean([point["tiles_segmented"] for point in points])),
+                "tile_recall": float(np.nanmean([point["tile_recall"] for point in points])),
+                "pixel_recall": float(np.nanmean([point["pixel_recall"] for point in points])),
+            })
+
+            print("threshold {:.2f}: {:.1%} of tiles segmented, tile recall {:.3f}, pixel recall {:.3f}".format(
+                threshold, curve[-1]["tiles_segmented"], curve[-1]["tile_recall"], curve[-1]["pixel_recall"]))
+
+        csv_path, json_path = write_results(curve, os.path.join(args.out, "cascade_curve"))
+        print("Wrote the recall curve to", csv_path, "and", json_path)
+
+    segmenter_sess.close()
+    classifier_sess.close()
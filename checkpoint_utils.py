@@ -0,0 +1,197 @@
+import os
+import glob
+import json
+import time
+import shutil
+import threading
+import tensorflow as tf
+from tensorflow.python.ops import io_ops
+
+## Saves checkpoints without stalling training. A save only copies the variables out of the training session, which
+## takes about as long as one step, and a background thread feeds the copies straight to a SaveV2 op in a private
+## graph, so no second set of variables is kept to hold them. Each
+## checkpoint is written as model_name-step.ckpt under temporary names and renamed into place, index last, so a crash
+## during a write never leaves a checkpoint that looks complete. The latest one is then hardlinked to model_name.ckpt,
+## where the scripts restore and initialize from, and only the last keep checkpoints are kept. A checkpoint can carry
+## a json state next to its variables, which is renamed into place with it, for resuming training exactly.
+## Args: graph - tf.Graph - the training graph
+##       model_name - str - name to save the checkpoints as
+##       checkpoint_dir - str - directory to save to
+##       keep - int - number of step checkpoints to keep
+##       every_steps - int - save every n steps, or None
+##       every_seconds - float - save every n seconds, or None
+class CheckpointManager(object):
+    def __init__(self, graph, model_name, checkpoint_dir="./model", keep=3, every_steps=None, every_seconds=None):
+        self.model_name = model_name
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+
+        with graph.as_default():
+            self.variables = tf.global_variables()
+
+        # the snapshots are fed to the save op under the variables' names, the same keys a Saver writes and restores
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = [tf.placeholder(variable.dtype.base_dtype, shape=variable.get_shape())
+                                  for variable in self.variables]
+            self._prefix = tf.placeholder(tf.string, shape=[])
+            self._save = io_ops.save_v2(self._prefix, [variable.op.name for variable in self.variables],
+                                        [""] * len(self.variables), self._placeholders)
+
+        self._sess = tf.Session(graph=self._graph)
+
+        self._thread = None
+        self._error = None
+        self._last_step = None
+        self._last_time = time.time()
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        # checkpoints from earlier runs count towards the ones kept
+        self.saved = _step_checkpoints(checkpoint_dir, model_name)
+
+    def path(self, step=None):
+        name = self.model_name if step is None else "%s-%d" % (self.model_name, step)
+        return os.path.join(self.checkpoint_dir, name + ".ckpt")
+
+    ## whether a save is due at this step under the step or time cadence
+    def should_save(self, step):
+        if self._last_step is None:
+            self._last_step = step
+
+        if self.every_steps and step - self._last_step >= self.every_steps:
+            return True
+
+        if self.every_seconds and time.time() - self._last_time >= self.every_seconds:
+            return True
+
+        return False
+
+    ## Copy the variables out of sess and write them in the background
+    ## Args: state - dict - json serializable state to save with the checkpoint, or None
+    ## Returns: path of the checkpoint being written
+    def save(self, sess, step, state=None):
+        values = sess.run(self.variables)
+
+        # only one write at a time, training only waits here if saves are requested faster than they are written
+        self.wait()
+
+        self._last_step = step
+        self._last_time = time.time()
+
+        self._thread = threading.Thread(target=self._write, args=(values, step, state), name="checkpoint_writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self.path(step)
+
+    ## wait for the checkpoint being written, raising any error from writing it
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._sess.close()
+
+    def _write(self, values, step, state):
+        try:
+            final_path = self.path(step)
+            temp_path = final_path + ".tmp"
+
+            feed_dict = dict(zip(self._placeholders, values))
+            feed_dict[self._prefix] = temp_path
+            self._sess.run(self._save, feed_dict=feed_dict)
+
+            if state is not None:
+                with open(temp_path + ".state.json", "w") as f:
+                    json.dump(state, f)
+
+            # move the files into place with the index last, a checkpoint without an index is never read
+            files = _checkpoint_files(temp_path)
+            for temp_file in sorted(files, key=lambda f: f.endswith(".index")):
+                os.replace(temp_file, final_path + temp_file[len(temp_path):])
+
+            self._update_latest(final_path)
+
+            # a step saved again, i.e. at the end of an epoch right after a timed save, moves to the newest
+            if final_path in self.saved:
+                self.saved.remove(final_path)
+            self.saved.append(final_path)
+
+            # only keep the last keep checkpoints, never removing the one just written
+            while len(self.saved) > max(self.keep, 1):
+                for old_file in _checkpoint_files(self.saved.pop(0)):
+                    os.remove(old_file)
+
+            print("Saved checkpoint", final_path)
+        except Exception as e:
+            self._error = e
+
+    ## point model_name.ckpt at the newest checkpoint
+    def _update_latest(self, checkpoint_path):
+        latest = self.path()
+
+        # remove data files of the latest checkpoint which the new one doesn't have
+        old_files = set(f[len(latest):] for f in _checkpoint_files(latest))
+        new_files = [f[len(checkpoint_path):] for f in _checkpoint_files(checkpoint_path)]
+
+        for suffix in sorted(new_files, key=lambda f: f == ".index"):
+            temp_link = latest + suffix + ".tmp"
+            if os.path.exists(temp_link):
+                os.remove(temp_link)
+
+            try:
+                os.link(checkpoint_path + suffix, temp_link)
+            except OSError:
+                shutil.copyfile(checkpoint_path + suffix, temp_link)
+
+            os.replace(temp_link, latest + suffix)
+            old_files.discard(suffix)
+
+        for suffix in old_files:
+            if suffix.endswith(".meta"):
+                continue
+            os.remove(latest + suffix)
+
+## Load the state saved with a checkpoint
+## Returns: the state dict, or None if the checkpoint has none
+def load_checkpoint_state(checkpoint_path):
+    path = checkpoint_path + ".state.json"
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+## the index, data and state files a checkpoint prefix is written as
+def _checkpoint_files(prefix):
+    files = []
+
+    for path in glob.glob(glob.escape(prefix) + ".*"):
+        suffix = path[len(prefix):]
+        if suffix in (".index", ".state.json") or (suffix.startswith(".data-") and not suffix.endswith(".tmp")):
+            files.append(path)
+
+    return files
+
+## the step checkpoints of a model already in a directory, oldest first
+def _step_checkpoints(checkpoint_dir, model_name):
+    prefix = os.path.join(checkpoint_dir, model_name + "-")
+    steps = []
+
+    for path in glob.glob(glob.escape(prefix) + "*.ckpt.index"):
+        step = path[len(prefix):-len(".ckpt.index")]
+        if step.isdigit():
+            steps.append(int(step))
+
+    return [prefix + "%d.ckpt" % step for step in sorted(steps)]
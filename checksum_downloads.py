@@ -0,0 +1,57 @@
+import os
+import argparse
+from dataset_utils import load_manifest, save_manifest, get_dataset
+from download_utils import fetch_file, file_sha256
+
+# Fill in the size and sha256 of the files to download in the manifest, so fetch_dataset can verify them. Files which
+# are still in the data directory as they were downloaded are hashed there, the others (i.e. the zips, which are
+# deleted once extracted) are downloaded again to a scratch directory first.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data", help="which datasets to checksum", nargs="+", type=int, default=None)
+    parser.add_argument("--data_dir", help="directory the data was downloaded to", default="data")
+    parser.add_argument("--download_dir", help="directory to download the files which aren't present to",
+                        default=os.path.join("data", "checksums"))
+    parser.add_argument("--download", help="download the files which aren't present to checksum them", nargs='?',
+                        const=True, default=False)
+    parser.add_argument("--all", help="checksum files which already have a size and sha256 too", nargs='?', const=True,
+                        default=False)
+    parser.add_argument("-u", "--update", help="write the sizes and checksums to the manifest", nargs='?', const=True,
+                        default=False)
+    args = parser.parse_args()
+
+    manifest = load_manifest()
+    datasets = args.data if args.data is not None else sorted(int(what) for what in manifest["datasets"])
+
+    for what in datasets:
+        dataset = get_dataset(what, manifest)
+        if dataset is None or "files" not in dataset:
+            continue
+
+        for entry in dataset["files"]:
+            if not args.all and entry.get("size") is not None and entry.get("sha256") is not None:
+                continue
+
+            path = os.path.join(args.data_dir, entry["name"])
+            downloaded = False
+
+            if not os.path.exists(path):
+                if not args.download:
+                    print("Skipping", entry["name"], "- not downloaded")
+                    continue
+
+                path = fetch_file(entry["url"], args.download_dir, entry["name"], extract=False)
+                downloaded = True
+
+            entry["size"] = os.path.getsize(path)
+            entry["sha256"] = file_sha256(path)
+
+            print("Checksummed", entry["name"], "-", entry["size"], "bytes, sha256", entry["sha256"])
+
+            # the scratch copies are only needed for their checksums
+            if downloaded:
+                os.remove(path)
+
+    if args.update:
+        save_manifest(manifest)
+        print("Updated manifest")
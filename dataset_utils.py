@@ -0,0 +1,350 @@
+import os
+import json
+import struct
+import threading
+import queue
+import numpy as np
+
+# the DATASETS_MANIFEST environment variable points everything at another manifest, i.e. one for synthetic data
+MANIFEST_PATH = os.environ.get("DATASETS_MANIFEST",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets.json"))
+
+_manifest = None
+
+## Load the manifest describing each dataset: its training shards with their record counts and sizes, the validation,
+## test and mias files and the files to download. The default manifest is only read once.
+def load_manifest(path=None):
+    global _manifest
+
+    if path is not None:
+        with open(path) as f:
+            return json.load(f)
+
+    if _manifest is None:
+        with open(MANIFEST_PATH) as f:
+            _manifest = json.load(f)
+
+    return _manifest
+
+## write the manifest back, i.e. after index_tfrecords.py has filled in the shard sizes
+def save_manifest(manifest, path=MANIFEST_PATH):
+    global _manifest
+
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+
+    if path == MANIFEST_PATH:
+        _manifest = manifest
+
+## the directory the data is in, the manifest can set it with a data_dir entry
+def _data_dir(data_dir, manifest):
+    if data_dir is not None:
+        return data_dir
+
+    return manifest.get("data_dir", "data")
+
+## the directory of the full size training pngs of dataset 100, with a trailing separator for _read_images
+def train_images_dir(data_dir=None, manifest=None):
+    manifest = manifest if manifest is not None else load_manifest()
+
+    return os.path.join(_data_dir(data_dir, manifest), "train_images", "")
+
+## get the manifest entry of a dataset, or None if the dataset isn't listed
+def get_dataset(what, manifest=None):
+    manifest = manifest if manifest is not None else load_manifest()
+
+    return manifest["datasets"].get(str(what))
+
+## Get the training shards of a dataset and the number of records in them. If every shard has a record count the total
+## is their sum, otherwise it is the total recorded for the dataset.
+## Args: packed - bool - use the shards with bit-packed masks written by pack_masks.py
+## Returns: list of the shard paths and the total number of records
+def training_shards(what, data_dir=None, manifest=None, packed=False):
+    manifest = manifest if manifest is not None else load_manifest()
+    dataset = get_dataset(what, manifest)
+
+    if dataset is None or "training" not in dataset:
+        raise ValueError('Invalid dataset!')
+
+    data_dir = _data_dir(data_dir, manifest)
+    shards = dataset["training"]
+    paths = [os.path.join(data_dir, shard["path"]) for shard in shards]
+
+    if packed:
+        paths = [packed_path(path) for path in paths]
+
+    if all(shard.get("records") is not None for shard in shards):
+        total_records = sum(shard["records"] for shard in shards)
+    else:
+        total_records = dataset["records"]
+
+    return paths, total_records
+
+## Get the paths of the data and labels of the validation, test or mias data of a dataset. Datasets without their own
+## validation data use the default dataset's.
+def evaluation_files(data="validation", which=5, data_dir=None, manifest=None):
+    manifest = manifest if manifest is not None else load_manifest()
+    data_dir = _data_dir(data_dir, manifest)
+
+    if data not in ("validation", "test", "mias"):
+        raise ValueError('Invalid data!')
+
+    dataset = get_dataset(which, manifest)
+
+    if dataset is not None and data in dataset:
+        files = dataset[data]
+    elif data == "mias":
+        files = manifest["default"]["mias"]
+    else:
+        files = get_dataset(manifest["default"]["validation"], manifest)[data]
+
+    return os.path.join(data_dir, files["data"]), os.path.join(data_dir, files["labels"])
+
+## path of the version of a tfrecords shard or labels array with bit-packed masks, i.e. training12_0.packed.tfrecords
+def packed_path(path):
+    root, ext = os.path.splitext(path)
+
+    return root + ".packed" + ext
+
+## Bit-pack an array of binary masks of shape (n, h, w, 1) or (n, h, w) along the width, giving shape (n, h, ceil(w / 8))
+def pack_mask_array(masks):
+    masks = np.asarray(masks)
+    if masks.ndim == 4:
+        masks = masks[..., 0]
+
+    return np.packbits(masks > 0, axis=2)
+
+## Bit-packed masks which index like the dense (n, h, w, 1) uint8 array, so they can be used in place of a memmap of the
+## masks. Only the rows which are indexed are unpacked.
+class PackedMasks(object):
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.width = width
+        self.shape = (packed.shape[0], packed.shape[1], width, 1)
+        self.dtype = np.dtype(np.uint8)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        examples, rows, cols = (key + (slice(None),) * 3)[:3]
+
+        masks = np.unpackbits(self.packed[examples, rows], axis=-1)[..., :self.width]
+        return masks[..., cols, np.newaxis]
+
+    def __array__(self, dtype=None):
+        masks = self[:]
+        return masks if dtype is None else masks.astype(dtype)
+
+## Load the masks of a validation or test set, using the bit-packed version if there is one
+## Args: labels_path - str - path of the dense masks
+##       width - int - width of the masks, i.e. the width of the images
+##       mmap_mode - passed to np.load
+## Returns: dense array or memmap of the masks, or PackedMasks if the packed version is memory-mapped
+def load_masks(labels_path, width, mmap_mode=None):
+    path = packed_path(labels_path)
+
+    if not os.path.exists(path):
+        return np.load(labels_path, mmap_mode=mmap_mode)
+
+    packed = PackedMasks(np.load(path, mmap_mode=mmap_mode), width)
+
+    # if we are reading it all into memory unpack it now
+    return np.asarray(packed) if mmap_mode is None else packed
+
+## path of the record offset index written for a tfrecords shard by index_tfrecords.py
+def index_path(shard_path):
+    return shard_path + ".idx.npy"
+
+## load the byte offsets of the records in a tfrecords shard, memory-mapped, or None if the shard hasn't been indexed
+def load_shard_index(shard_path):
+    path = index_path(shard_path)
+
+    if not os.path.exists(path):
+        return None
+
+    return np.load(path, mmap_mode='r')
+
+## Scan a tfrecords file and get the byte offset of each record. Each record is framed as an 8 byte little-endian length,
+## a 4 byte crc of the length, the data and a 4 byte crc of the data, so only the lengths need to be read and the data is
+## skipped with a seek.
+## Returns: array of the offsets of the records and the size of the file
+def scan_tfrecords(path):
+    file_size = os.path.getsize(path)
+    offsets = []
+
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < file_size:
+            header = f.read(8)
+            if len(header) < 8:
+                raise IOError("Truncated record header at byte %d of %s" % (offset, path))
+
+            length, = struct.unpack("<Q", header)
+            offsets.append(offset)
+
+            # skip the length crc, the data and the data crc
+            offset += 8 + 4 + length + 4
+            if offset > file_size:
+                raise IOError("Truncated record at byte %d of %s" % (offsets[-1], path))
+
+            f.seek(offset)
+
+    return np.array(offsets, dtype=np.int64), file_size
+
+## write the record offsets of a shard next to it
+## Returns: number of records and size of the shard
+def index_shard(path):
+    offsets, file_size = scan_tfrecords(path)
+    np.save(index_path(path), offsets)
+
+    return len(offsets), file_size
+
+## Reads the records of a set of tfrecords shards in a new random permutation of all the records every epoch, using the
+## record offsets written by index_tfrecords.py (shards without an index are scanned when the sampler is created). The
+## records are read readahead at a time in a background thread, in file order within each block to keep the reads
+## mostly sequential, and handed out in the permuted order, so memory use is bounded by about two blocks of records no
+## matter how large the dataset is.
+## Args: filenames - list - tfrecords shards
+##       seed - int - the permutation of each epoch is seeded with seed + epoch so it can be recreated on restore
+##       readahead - int - number of records to read at a time
+##       num_epochs - int - number of epochs to read, None to read forever
+class RecordSampler(object):
+    def __init__(self, filenames, seed=0, readahead=64, num_epochs=None):
+        self.filenames = list(filenames)
+        self.seed = seed
+        self.readahead = readahead
+        self.num_epochs = num_epochs
+
+        shard_ids = []
+        offsets = []
+        lengths = []
+
+        for k, path in enumerate(self.filenames):
+            index = load_shard_index(path)
+            if index is None:
+                index_shard(path)
+                index = load_shard_index(path)
+
+            # the length of each record's data follows from the offset of the next record
+            ends = np.append(index[1:], os.path.getsize(path))
+            shard_ids.append(np.full(len(index), k, dtype=np.int32))
+            offsets.append(np.asarray(index) + 12)
+            lengths.append(ends - index - 16)
+
+        self.shard_ids = np.concatenate(shard_ids)
+        self.offsets = np.concatenate(offsets)
+        self.lengths = np.concatenate(lengths)
+
+        self.epoch = 0
+        self.position = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    ## the epoch and the number of records of it already handed out
+    def state(self):
+        return {"epoch": self.epoch, "position": self.position, "seed": self.seed}
+
+    ## continue from a saved state, must be called before the records are read
+    def restore(self, state):
+        self.epoch = state["epoch"]
+        self.position = state["position"]
+        self.seed = state.get("seed", self.seed)
+
+    ## The state after another n records have been read from state. The records are read ahead of training, so the
+    ## position training has reached is this from the state it started at and the records it has consumed.
+    def advance(self, state, n):
+        total = state["epoch"] * len(self) + state["position"] + n
+        return {"epoch": int(total // len(self)), "position": int(total % len(self)), "seed": state.get("seed", self.seed)}
+
+    def permutation(self, epoch):
+        return np.random.RandomState(self.seed + epoch).permutation(len(self.offsets))
+
+    ## read the records idx in file order and return them in the order of idx
+    def _read_block(self, files, idx):
+        records = [None] * len(idx)
+
+        for k in np.lexsort((self.offsets[idx], self.shard_ids[idx])):
+            record = idx[k]
+            f = files[self.shard_ids[record]]
+            f.seek(self.offsets[record])
+            records[k] = f.read(self.lengths[record])
+
+        return records
+
+    ## generator of the serialized records, e.g. for tf.data.Dataset.from_generator
+    def records(self):
+        blocks = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        start_epoch, start_position = self.epoch, self.position
+
+        def worker():
+            files = [open(path, "rb") for path in self.filenames]
+
+            try:
+                epoch = start_epoch
+                position = start_position
+
+                while self.num_epochs is None or epoch < self.num_epochs:
+                    order = self.permutation(epoch)
+
+                    for i in range(position, len(order), self.readahead):
+                        block = (epoch, i, self._read_block(files, order[i:i + self.readahead]))
+                        if not put_until_stopped(blocks, block, stop):
+                            return
+
+                    epoch += 1
+                    position = 0
+
+                put_until_stopped(blocks, None, stop)
+            except Exception as e:
+                put_until_stopped(blocks, e, stop)
+            finally:
+                for f in files:
+                    f.close()
+
+        thread = threading.Thread(target=worker, name="record_sampler")
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                block = blocks.get()
+
+                if block is None:
+                    break
+                elif isinstance(block, Exception):
+                    raise block
+
+                epoch, position, records = block
+                for record in records:
+                    self.epoch = epoch
+                    self.position = position + 1
+                    position += 1
+
+                    yield record
+
+                # move the state on to the next epoch once this one is done
+                if position == len(self.offsets):
+                    self.epoch = epoch + 1
+                    self.position = 0
+        finally:
+            # stop the worker if we are done early
+            stop.set()
+            thread.join()
+
+## put an item in the queue, giving up if the consumer has stopped
+def put_until_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
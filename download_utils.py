@@ -0,0 +1,180 @@
+import os
+import hashlib
+import zipfile
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from dataset_utils import load_manifest, get_dataset
+
+## Download one file into dest_dir, resuming a partial download from a previous run with a byte range request. The data
+## is written to name.part and the size and sha256 are checked against the manifest before it is renamed, so a truncated
+## file is never treated as present. Without a size in the manifest the size the server reports is checked instead.
+## Zip files are extracted and deleted once they have been verified.
+## Args: url - str - where to download the file from
+##       dest_dir - str - directory to download to
+##       name - str - name of the file
+##       size - int - expected size in bytes, or None to use the Content-Length
+##       sha256 - str - expected hex digest, or None to skip the check
+##       retries - int - how many times to retry a failed or corrupt download
+## Returns: path of the downloaded file
+def fetch_file(url, dest_dir, name, size=None, sha256=None, extract=True, retries=3, chunk_size=1 << 20, timeout=60):
+    path = os.path.join(dest_dir, name)
+    part_path = path + ".part"
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    for attempt in range(retries + 1):
+        try:
+            expected_size = _download(url, part_path, size, chunk_size, timeout)
+            _verify(part_path, expected_size, sha256)
+            break
+        except (IOError, URLError, HTTPException) as e:
+            print("Error downloading", name, "-", e)
+
+            if attempt == retries:
+                raise IOError("Could not download %s from %s" % (name, url))
+
+    os.rename(part_path, path)
+
+    # if the file is a zip file unzip it and delete the archive to save disk space
+    if extract and name.endswith(".zip"):
+        with zipfile.ZipFile(path, mode='r', allowZip64=True) as archive:
+            archive.extractall(dest_dir)
+
+        os.remove(path)
+        print("Zip file extracted and deleted", name)
+
+    return path
+
+## Download url to part_path, continuing from the end of part_path if it exists
+## Returns: the size the file should have, size if it is given, otherwise from the response headers or None
+def _download(url, part_path, size, chunk_size, timeout):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    # already complete, only needs verifying
+    if size is not None and offset == size:
+        return size
+
+    # a partial file larger than the expected size can't be resumed
+    if size is not None and offset > size:
+        os.remove(part_path)
+        offset = 0
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%d-" % offset)
+
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        # the range starts at the end of the file, so the file is complete
+        if e.code == 416 and offset:
+            return size if size is not None else offset
+        raise
+
+    with response:
+        # if the server ignores the range we get the whole file again
+        if offset and response.getcode() != 206:
+            offset = 0
+
+        if size is None:
+            size = _response_size(response, offset)
+
+        with open(part_path, "ab" if offset else "wb") as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    return size
+
+## the full size of the file a response is for, from the total of its Content-Range or from its Content-Length, or None
+def _response_size(response, offset):
+    content_range = response.headers.get("Content-Range")
+    if offset and content_range is not None and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+
+    length = response.headers.get("Content-Length")
+    if length is not None:
+        return offset + int(length)
+
+    return None
+
+## check the size and sha256 of a downloaded file, deleting it if it doesn't match so the next attempt starts over
+def _verify(path, size, sha256):
+    actual_size = os.path.getsize(path)
+    if size is not None and actual_size != size:
+        # a short file can still be resumed
+        if actual_size > size:
+            os.remove(path)
+        raise IOError("expected %d bytes, got %d" % (size, actual_size))
+
+    if sha256 is not None and file_sha256(path) != sha256.lower():
+        os.remove(path)
+        raise IOError("checksum mismatch")
+
+## hex sha256 digest of a file, read in chunks
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+## Download all the files of a dataset that aren't present yet, several at a time
+## Args: what - int - which dataset
+##       data_dir - str - directory to download to
+##       manifest - dict - manifest to use, defaults to datasets.json
+##       base_url - str - replaces the location of the files in the manifest, i.e. to download from a mirror
+##       workers - int - number of files to download at a time
+## Returns: list of the files that were downloaded
+def fetch_dataset(what, data_dir="data", manifest=None, base_url=None, workers=4, retries=3):
+    if manifest is None:
+        manifest = load_manifest()
+
+    dataset = get_dataset(what, manifest)
+    if dataset is None or "files" not in dataset:
+        print("No files to download for dataset", what)
+        return []
+
+    # only fetch the files whose contents aren't there yet
+    files = [entry for entry in dataset["files"]
+             if not os.path.exists(os.path.join(data_dir, *entry["check"].split("/")))]
+
+    if not files:
+        return []
+
+    print("Downloading", len(files), "files for dataset", what, "...")
+
+    downloaded = []
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for entry in files:
+            url = entry["url"]
+            if base_url is not None:
+                url = base_url.rstrip("/") + "/" + entry["name"]
+
+            future = pool.submit(fetch_file, url, data_dir, entry["name"], size=entry.get("size"),
+                                 sha256=entry.get("sha256"), retries=retries)
+            futures[future] = entry["name"]
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                downloaded.append(name)
+                print("Downloaded", name)
+            except (IOError, OSError, zipfile.BadZipfile) as e:
+                failed.append(name)
+                print("Failed", name, "-", e)
+
+    if failed:
+        raise IOError("Could not download: " + ", ".join(sorted(failed)))
+
+    return downloaded
@@ -0,0 +1,202 @@
+import os
+import time
+import shlex
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from graph_utils import build_candidate_graph, inference_graph_def
+
+# cleanups applied to the frozen graph, batch norms are folded into the convolutions before them
+TRANSFORMS = [
+    "strip_unused_nodes",
+    "remove_nodes(op=Identity, op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "strip_unused_nodes",
+    "sort_by_execution_order",
+]
+
+# every input pipeline centers the 0-255 pixels on MU and divides them by SCALE unless it standardizes them
+MU = 127.0
+SCALE = 255.0
+
+## How a candidate scaled its training images, from its namespace. Only the pngs of dataset 100 are standardized per
+## image, when the script is run with -n, the tfrecords and the evaluation data are always centered and scaled.
+## Returns: standardize - bool - whether the images are standardized per image
+##          mu, scale - float - the centering and scaling otherwise
+def input_scaling(namespace):
+    standardize = bool(namespace.get("normalize", False)) and namespace.get("dataset") == 100
+
+    return standardize, MU, SCALE
+
+## scale a batch of uint8 images the way the candidate's input did, the same as tf.image.per_image_standardization
+## for each image when standardizing
+def scale_images(images, standardize, mu=MU, scale=SCALE):
+    images = tf.cast(images, tf.float32)
+
+    if not standardize:
+        return (images - mu) / scale
+
+    pixels = tf.cast(tf.reduce_prod(tf.shape(images)[1:]), tf.float32)
+    mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    std = tf.sqrt(tf.reduce_mean(tf.square(images - mean), axis=[1, 2, 3], keepdims=True))
+
+    return (images - mean) / tf.maximum(std, tf.rsqrt(pixels))
+
+## Export a candidate as a minimal inference graph. The graph is built as usual and rewritten before it is frozen: X is
+## cut off from the input queues and augmentation which fed it, is_training becomes a constant so the training
+## branches of the batch norm and dropout layers are removed, and everything the output doesn't need, the optimizers,
+## metrics and summaries, is stripped. The variables are restored and frozen into constants and a uint8 image
+## placeholder is mapped onto X with the same scaling as the model's training data.
+## Args: script - str - candidate script
+##       argv - list - command line arguments the model was trained with
+##       checkpoint - str - checkpoint to restore, defaults to the model's own
+##       output - str - name of the tensor to output, defaults to logits_sm for the segmentation models and
+##                probabilities for the classifiers
+## Returns: GraphDef with an "image" input and a "probabilities" output
+def export_graph_def(script, argv=None, checkpoint=None, output=None):
+    namespace = build_candidate_graph(script, argv)
+    graph = namespace["graph"]
+    checkpoint = checkpoint or os.path.join("./model", namespace["model_name"] + ".ckpt")
+
+    if output is None:
+        output = "logits_sm" if "logits_sm" in namespace else "probabilities"
+
+    X = namespace["X"]
+    output_name = namespace[output].op.name
+
+    with graph.as_default():
+        saver = tf.train.Saver()
+
+    # cutting the graph at X before freezing it leaves out the input pipeline's local variables, which aren't restored
+    graph_def = inference_graph_def(graph.as_graph_def(), [X], namespace["training"], [output_name])
+
+    with tf.Session(graph=graph) as sess:
+        saver.restore(sess, checkpoint)
+        frozen = tf.graph_util.convert_variables_to_constants(sess, graph_def, [output_name])
+
+    # feed the frozen graph from a uint8 image instead of its input pipeline
+    export = tf.Graph()
+    with export.as_default():
+        image = tf.placeholder(tf.uint8, shape=X.get_shape(), name="image")
+        scaled = scale_images(image, *input_scaling(namespace))
+
+        probabilities, = tf.import_graph_def(frozen, input_map={X.name: scaled}, return_elements=[output_name + ":0"],
+                                             name="model")
+        tf.identity(probabilities, name="probabilities")
+
+    graph_def = tf.graph_util.extract_sub_graph(export.as_graph_def(), ["probabilities"])
+
+    return TransformGraph(graph_def, ["image"], ["probabilities"], TRANSFORMS)
+
+## write a GraphDef as a SavedModel with a predict signature from image to probabilities
+def write_saved_model(graph_def, export_dir):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+
+    builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+    signature = tf.saved_model.signature_def_utils.predict_signature_def(
+        inputs={"image": graph.get_tensor_by_name("image:0")},
+        outputs={"probabilities": graph.get_tensor_by_name("probabilities:0")})
+
+    with tf.Session(graph=graph) as sess:
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING], signature_def_map={
+            tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+
+    builder.save()
+
+## Load an exported GraphDef
+## Returns: session, image placeholder and probabilities tensor
+def load_exported(path):
+    graph_def = tf.GraphDef()
+    with open(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+
+    return tf.Session(graph=graph), graph.get_tensor_by_name("image:0"), graph.get_tensor_by_name("probabilities:0")
+
+## Time loading a model and running images through it, from the checkpoint and from the exported graph
+## Returns: dict of the startup seconds and per image seconds of both
+def benchmark_export(script, argv, checkpoint, path, batch_size=1, steps=20):
+    results = {}
+
+    def time_runs(run):
+        run()
+        start = time.time()
+        for _ in range(steps):
+            run()
+        return (time.time() - start) / steps / batch_size
+
+    # restoring the training graph from the checkpoint
+    start = time.time()
+    namespace = build_candidate_graph(script, argv)
+    with namespace["graph"].as_default():
+        saver = tf.train.Saver()
+    sess = tf.Session(graph=namespace["graph"])
+    saver.restore(sess, checkpoint or os.path.join("./model", namespace["model_name"] + ".ckpt"))
+    results["checkpoint_startup_seconds"] = time.time() - start
+
+    X = namespace["X"]
+    shape = [batch_size] + [d or 640 for d in X.get_shape().as_list()[1:]]
+    images = np.random.RandomState(0).randint(0, 256, size=shape).astype(np.uint8)
+    output = namespace["logits_sm"] if "logits_sm" in namespace else namespace["probabilities"]
+
+    # the checkpoint's graph is fed the images scaled the same way as the exported one scales them
+    with tf.Graph().as_default():
+        pixels = tf.placeholder(tf.uint8, shape=shape)
+        scaled = scale_images(pixels, *input_scaling(namespace))
+        with tf.Session() as scale_sess:
+            scaled_images = scale_sess.run(scaled, feed_dict={pixels: images})
+
+    feed_dict = {X: scaled_images, namespace["training"]: False}
+
+    results["checkpoint_seconds_per_image"] = time_runs(lambda: sess.run(output, feed_dict=feed_dict))
+    sess.close()
+
+    # loading the exported graph
+    start = time.time()
+    sess, image, probabilities = load_exported(path)
+    results["export_startup_seconds"] = time.time() - start
+
+    results["export_seconds_per_image"] = time_runs(lambda: sess.run(probabilities, feed_dict={image: images}))
+    sess.close()
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", help="candidate script to export", default="candidate_3.9.4.02.py")
+    parser.add_argument("-a", "--args", help="command line arguments the model was trained with, i.e. \"-d 12\"", default="")
+    parser.add_argument("-c", "--checkpoint", help="checkpoint to export, defaults to the model's own", default=None)
+    parser.add_argument("--output", help="tensor to output, defaults to logits_sm or probabilities", default=None)
+    parser.add_argument("-o", "--out", help="path of the .pb to write", default=None)
+    parser.add_argument("--saved_model", help="also write a SavedModel to this directory", default=None)
+    parser.add_argument("--benchmark", help="compare the startup time and latency to restoring the checkpoint",
+                        nargs='?', const=True, default=False)
+    args = parser.parse_args()
+
+    argv = shlex.split(args.args)
+    graph_def = export_graph_def(args.model, argv, checkpoint=args.checkpoint, output=args.output)
+
+    out = args.out or os.path.join("./model", os.path.splitext(os.path.basename(args.model))[0] + ".pb")
+    with open(out, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    print("Wrote", len(graph_def.node), "nodes to", out)
+
+    if args.saved_model is not None:
+        write_saved_model(graph_def, args.saved_model)
+        print("Wrote SavedModel to", args.saved_model)
+
+    if args.benchmark:
+        results = benchmark_export(args.model, argv, args.checkpoint, out)
+        print("Startup: {checkpoint_startup_seconds:.2f} seconds from the checkpoint, {export_startup_seconds:.2f} "
+              "seconds exported".format(**results))
+        print("Per image: {checkpoint_seconds_per_image:.4f} seconds from the checkpoint, "
+              "{export_seconds_per_image:.4f} seconds exported".format(**results))
@@ -0,0 +1,126 @@
+import numpy as np
+import tensorflow as tf
+
+## Mean and standard deviation of the windows of size at every combination of ys and xs. The scan is summed one band
+## of size rows at a time, so only one band is held at float64 rather than integral images of the whole scan. Windows
+## past the edge of the image are clipped to it.
+## Returns: means, stds - arrays (len(ys), len(xs))
+def tile_stats(image, ys, xs, size):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[:, :, 0]
+
+    height, width = image.shape
+    x0 = np.asarray(xs)
+    x1 = np.minimum(x0 + size, width)
+
+    means = np.zeros((len(ys), len(x0)))
+    stds = np.zeros((len(ys), len(x0)))
+
+    for i, y in enumerate(ys):
+        band = image[y:min(y + size, height)].astype(np.float64)
+
+        # the windows of a band are differences of the running sums of its columns
+        sums = np.concatenate([[0], np.cumsum(band.sum(axis=0))])
+        squared_sums = np.concatenate([[0], np.cumsum(np.einsum("ij,ij->j", band, band))])
+        area = band.shape[0] * (x1 - x0)
+
+        means[i] = (sums[x1] - sums[x0]) / area
+        variances = (squared_sums[x1] - squared_sums[x0]) / area - means[i] ** 2
+        stds[i] = np.sqrt(np.maximum(variances, 0))
+
+    return means, stds
+
+## The same as tile_stats for windows at (ys[i], xs[i]) in a tensorflow image, for use in the input pipelines. The
+## image is first averaged over cells of grid x grid pixels and the windows are snapped to the cells, so the running sums
+## are only over the cells, and the statistics are exact for the cells the window covers.
+def _tf_window_stats(image, ys, xs, size, grid=8):
+    image = tf.cast(image, tf.float32)[tf.newaxis, :, :, tf.newaxis]
+
+    def cell_sums(values):
+        pooled = tf.nn.avg_pool(values, [1, grid, grid, 1], [1, grid, grid, 1], padding="VALID")[0, :, :, 0]
+        return tf.pad(tf.cumsum(tf.cumsum(tf.cast(pooled, tf.float64), axis=0), axis=1), [[1, 0], [1, 0]])
+
+    sums = cell_sums(image)
+    squared_sums = cell_sums(tf.square(image))
+
+    cells = tf.shape(sums) - 1
+    cells_per_window = tf.maximum(size // grid, 1)
+    y0 = tf.minimum(ys // grid, cells[0] - 1)
+    x0 = tf.minimum(xs // grid, cells[1] - 1)
+    y1 = tf.minimum(y0 + cells_per_window, cells[0])
+    x1 = tf.minimum(x0 + cells_per_window, cells[1])
+    area = tf.cast((y1 - y0) * (x1 - x0), tf.float64)
+
+    def window_sums(ii):
+        corner = lambda y, x: tf.gather_nd(ii, tf.stack([y, x], axis=1))
+        return corner(y1, x1) - corner(y0, x1) - corner(y1, x0) + corner(y0, x0)
+
+    means = window_sums(sums) / area
+    variances = window_sums(squared_sums) / area - tf.square(means)
+
+    return means, tf.sqrt(tf.maximum(variances, 0.0))
+
+## Rejects windows of a scan which are mostly black background or blown out artifacts, as the datasets were made by
+## keeping only tiles between thresholds on their mean and variance. The statistics come from running sums over bands
+## of the scan, so checking every tile of a scan costs about one pass over its pixels and is much cheaper than running
+## the tiles through a network. The thresholds are on the 0-255 pixel values.
+## Args: min_mean, max_mean - float - range of the mean of a tile to keep
+##       min_std - float - minimum standard deviation of a tile to keep
+class TileFilter(object):
+    def __init__(self, min_mean=20.0, max_mean=220.0, min_std=5.0):
+        self.min_mean = min_mean
+        self.max_mean = max_mean
+        self.min_std = min_std
+
+    ## which windows to keep from their means and standard deviations, for numpy arrays or tensors
+    def keep(self, means, stds):
+        if isinstance(means, np.ndarray):
+            return (means >= self.min_mean) & (means <= self.max_mean) & (stds >= self.min_std)
+
+        return tf.logical_and(tf.logical_and(means >= self.min_mean, means <= self.max_mean), stds >= self.min_std)
+
+    ## Which tiles of a scan to run, as TiledInference's tile_filter
+    ## Returns: bool array (len(ys), len(xs))
+    def __call__(self, scan, ys, xs, tile_size):
+        means, stds = tile_stats(scan, ys, xs, tile_size)
+
+        return self.keep(means, stds)
+
+    ## Pick random crop positions in a tensorflow image which pass the filter. candidates random positions are checked
+    ## and n of them are taken, the ones which pass first, so if fewer than n pass some background crops are still used.
+    ## The numbers of positions checked and rejected are counted in local variables, crops_checked and crops_rejected.
+    ## Args: image - uint8 or float Tensor (height, width) of the pixel values
+    ##       size - int Tensor - size of the crops
+    ## Returns: ys, xs - int32 Tensors (n,) of the top left corners
+    def random_crops(self, image, size, n=1, candidates=8):
+        shape = tf.shape(image)
+        ys = tf.cast(tf.random_uniform([candidates]) * tf.cast(shape[0] - size + 1, tf.float32), tf.int32)
+        xs = tf.cast(tf.random_uniform([candidates]) * tf.cast(shape[1] - size + 1, tf.float32), tf.int32)
+
+        means, stds = _tf_window_stats(image, ys, xs, size)
+        keep = self.keep(means, stds)
+
+        # the passing positions come first, in their random order
+        _, order = tf.nn.top_k(tf.cast(keep, tf.int32) * candidates - tf.range(candidates), k=n)
+
+        with tf.variable_scope("crop_filter", reuse=tf.AUTO_REUSE):
+            checked = tf.get_variable("crops_checked", shape=[], dtype=tf.int64, trainable=False,
+                                      initializer=tf.zeros_initializer(), collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            rejected = tf.get_variable("crops_rejected", shape=[], dtype=tf.int64, trainable=False,
+                                       initializer=tf.zeros_initializer(), collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        counts = [tf.assign_add(checked, candidates),
+                  tf.assign_add(rejected, tf.reduce_sum(tf.cast(tf.logical_not(keep), tf.int64)))]
+
+        with tf.control_dependencies(counts):
+            return tf.gather(ys, order), tf.gather(xs, order)
+
+## Fraction of the random crops rejected by TileFilter.random_crops since the local variables were initialized, i.e.
+## the fraction of training steps that would have been spent on background
+def rejected_crop_fraction():
+    with tf.variable_scope("crop_filter", reuse=True):
+        checked = tf.get_variable("crops_checked", dtype=tf.int64)
+        rejected = tf.get_variable("crops_rejected", dtype=tf.int64)
+
+    return tf.cast(rejected, tf.float32) / tf.cast(tf.maximum(checked, 1), tf.float32)
@@ -0,0 +1,182 @@
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+import training_utils
+
+# every candidate script builds its graph above this line and runs the session below it
+CONFIGURE_MARKER = "## CONFIGURE OPTIONS"
+
+## stands in for the download functions of training_utils while a script's graph is built
+def _skip_download(*args, **kwargs):
+    return []
+
+## Build the graph of a candidate script without running any training, by running the script up to its
+## "## CONFIGURE OPTIONS" line with argv as its command line arguments. The scripts download their dataset before
+## building the graph, which isn't needed for the graph, so download_data and download_file are skipped unless
+## download is set. The training file paths only come from the manifest so they need no data either.
+## Args: script - str - path of the candidate script
+##       argv - list - command line arguments for the script, i.e. ["-d", "12", "--size", "320"]
+##       download - bool - let the script download its data
+## Returns: dict of the script's global variables, including graph, X, y and training
+def build_candidate_graph(script, argv=None, download=False):
+    with open(script) as f:
+        source = f.read()
+
+    index = source.find(CONFIGURE_MARKER)
+    if index < 0:
+        raise ValueError("%s has no %s line" % (script, CONFIGURE_MARKER))
+
+    script_dir = os.path.dirname(os.path.abspath(script))
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+    namespace = {"__name__": "__candidate__", "__file__": os.path.abspath(script)}
+
+    # the script parses sys.argv and imports the utils from its own directory or the repo
+    old_argv, old_path = sys.argv, list(sys.path)
+    sys.argv = [script] + list(argv or [])
+    sys.path[:0] = [script_dir, repo_dir]
+
+    # the scripts import the download functions from training_utils, so they get the stand-ins while it is patched
+    downloads = training_utils.download_data, training_utils.download_file
+    if not download:
+        training_utils.download_data = training_utils.download_file = _skip_download
+
+    try:
+        exec(compile(source[:index], script, "exec"), namespace)
+    finally:
+        sys.argv, sys.path[:] = old_argv, old_path
+        training_utils.download_data, training_utils.download_file = downloads
+
+    return namespace
+
+## Rewrite the GraphDef of a built candidate graph into one for inference only, without building it again. The inputs
+## are cut off from whatever feeds them, i.e. the input queues of X, and become plain placeholders, is_training becomes
+## a constant False, the training branches of the batch norm and dropout conds on it are removed and everything the
+## outputs don't need is dropped. The variables are left as they are, so it can be frozen afterwards.
+## Args: graph_def - GraphDef of the candidate graph
+##       inputs - list of Tensors - where to cut the graph, i.e. [X]
+##       training - Tensor - the is_training placeholder
+##       outputs - list of str - names of the output ops
+## Returns: the inference GraphDef
+def inference_graph_def(graph_def, inputs, training, outputs):
+    inference = tf.GraphDef()
+    inference.CopyFrom(graph_def)
+    nodes = dict((node.name, node) for node in inference.node)
+
+    for tensor in inputs:
+        node = nodes[tensor.op.name]
+        node.op = "Placeholder"
+        del node.input[:]
+        node.attr.clear()
+        node.attr["dtype"].type = tensor.dtype.as_datatype_enum
+        node.attr["shape"].shape.CopyFrom(tensor.get_shape().as_proto())
+
+    node = nodes[training.op.name]
+    node.op = "Const"
+    del node.input[:]
+    node.attr.clear()
+    node.attr["dtype"].type = tf.bool.as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(False))
+
+    return tf.graph_util.extract_sub_graph(_remove_constant_conds(inference), outputs)
+
+## the name and output index of a NodeDef input, the index is -1 for a control input
+def _input_ref(ref):
+    if ref.startswith("^"):
+        return ref[1:], -1
+
+    name, _, index = ref.partition(":")
+    return name, int(index) if index else 0
+
+## Remove the untaken branches of the conds whose predicate is a constant from a GraphDef, the same way the executor
+## would skip them. The untaken output of such a Switch is dead, a node with a dead input is dead except for a Merge,
+## which is only dead when all its inputs are, and the taken output of the Switch and a Merge left with a single live
+## input are replaced by the tensor they pass through. The nodes come in the order they were created, so every input
+## is seen before the nodes which use it, other than the back edges of while loops, which are left alone.
+def _remove_constant_conds(graph_def):
+    constants = {}
+    dead_nodes = set()
+    dead_outputs = set()
+    replacements = {}
+
+    def is_dead(name, index):
+        return name in dead_nodes or (name, index) in dead_outputs
+
+    # the value of a bool input which is known to be constant, or None
+    def constant(ref):
+        name, index = _input_ref(ref)
+        return constants.get(name) if index == 0 else None
+
+    pruned = tf.GraphDef()
+    pruned.versions.CopyFrom(graph_def.versions)
+    pruned.library.CopyFrom(graph_def.library)
+
+    for original in graph_def.node:
+        refs = [_input_ref(ref) for ref in original.input]
+        controls = [ref for ref in original.input if ref.startswith("^")]
+
+        if original.op in ("Merge", "RefMerge"):
+            inputs = [ref for ref, (name, index) in zip(original.input, refs) if index >= 0 and not is_dead(name, index)]
+            if not inputs or any(is_dead(name, index) for name, index in refs if index < 0):
+                dead_nodes.add(original.name)
+                continue
+        elif any(is_dead(name, index) for name, index in refs):
+            dead_nodes.add(original.name)
+            continue
+        else:
+            inputs = [ref for ref in original.input if not ref.startswith("^")]
+
+        # inputs from the Switches and Merges which have been bypassed come from what they pass through
+        node = pruned.node.add()
+        node.CopyFrom(original)
+        del node.input[:]
+        node.input.extend([replacements.get(_input_ref(ref), ref) for ref in inputs] + controls)
+
+        if node.op in ("Merge", "RefMerge"):
+            node.attr["N"].i = len(inputs)
+            if len(inputs) == 1:
+                replacements[(node.name, 0)] = node.input[0]
+        elif node.op in ("Switch", "RefSwitch") and constant(node.input[1]) is not None:
+            taken = 1 if constant(node.input[1]) else 0
+            dead_outputs.add((node.name, 1 - taken))
+            replacements[(node.name, taken)] = node.input[0]
+        elif node.op == "Identity" and constant(node.input[0]) is not None:
+            constants[node.name] = constant(node.input[0])
+        elif node.op == "Const" and node.attr["dtype"].type == tf.bool.as_datatype_enum:
+            value = tf.make_ndarray(node.attr["value"].tensor)
+            if value.size == 1:
+                constants[node.name] = bool(value.reshape(()))
+
+    return pruned
+
+## Get the tensors of a built candidate graph which are the same in every script. The training op is train_op in
+## most scripts and train_op_1 in the ones which can freeze layers.
+## Returns: dict with graph, X, y, training, logits, train_op and extra_update_ops
+def candidate_tensors(namespace):
+    tensors = dict((name, namespace[name]) for name in ("graph", "X", "y", "training", "logits"))
+
+    tensors["train_op"] = namespace.get("train_op", namespace.get("train_op_1"))
+    tensors["extra_update_ops"] = namespace.get("extra_update_ops",
+                                                tensors["graph"].get_collection(tf.GraphKeys.UPDATE_OPS))
+
+    return tensors
+
+## number of trainable parameters in a graph
+def count_parameters(graph):
+    with graph.as_default():
+        return int(sum(np.prod(v.get_shape().as_list()) for v in tf.trainable_variables()))
+
+## Make a batch to feed to a candidate's X and y placeholders
+## Returns: feed dict of random images and labels
+def synthetic_feed(tensors, batch_size, seed=0):
+    rng = np.random.RandomState(seed)
+    X, y = tensors["X"], tensors["y"]
+
+    x_shape = [batch_size] + X.get_shape().as_list()[1:]
+    y_shape = [batch_size] + y.get_shape().as_list()[1:]
+
+    images = rng.uniform(-0.5, 0.5, size=x_shape).astype(X.dtype.as_numpy_dtype)
+    labels = (rng.rand(*y_shape) > 0.95).astype(y.dtype.as_numpy_dtype)
+
+    return {X: images, y: labels}
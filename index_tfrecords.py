@@ -0,0 +1,39 @@
+import os
+import argparse
+from dataset_utils import load_manifest, save_manifest, get_dataset, index_shard
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data", help="which datasets to index", nargs="+", type=int, default=None)
+    parser.add_argument("--data_dir", help="directory the shards are in", default="data")
+    parser.add_argument("-u", "--update", help="write the record counts and sizes to the manifest", nargs='?', const=True,
+                        default=False)
+    args = parser.parse_args()
+
+    manifest = load_manifest()
+    datasets = args.data if args.data is not None else sorted(int(what) for what in manifest["datasets"])
+
+    for what in datasets:
+        dataset = get_dataset(what, manifest)
+        if dataset is None or "training" not in dataset:
+            continue
+
+        for shard in dataset["training"]:
+            path = os.path.join(args.data_dir, shard["path"])
+            if not os.path.exists(path):
+                print("Skipping", path, "- not downloaded")
+                continue
+
+            records, file_size = index_shard(path)
+            shard["records"] = records
+            shard["bytes"] = file_size
+
+            print("Indexed", path, "-", records, "records,", file_size, "bytes")
+
+        # keep the dataset total consistent with the shards once they are all indexed
+        if all(shard.get("records") is not None for shard in dataset["training"]):
+            dataset["records"] = sum(shard["records"] for shard in dataset["training"])
+
+    if args.update:
+        save_manifest(manifest)
+        print("Updated manifest")
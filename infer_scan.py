@@ -0,0 +1,147 @@
+import os
+import time
+import shlex
+import argparse
+import numpy as np
+import tensorflow as tf
+from graph_utils import build_candidate_graph
+from inference_utils import TiledInference, predict_whole_scan
+from filter_utils import TileFilter
+
+## Read a scan as a uint8 array (height, width), from a .npy file or any image tensorflow can decode, taking the first
+## channel as the train_images pngs have the mask in the second one
+## Args: scale_by - float - factor to resize the scan by, i.e. 0.66 as the dataset 100 crops are
+##       channel - int - channel to read, 1 for the mask of a train_images png
+def read_scan(path, scale_by=1.0, channel=0):
+    if path.endswith(".npy"):
+        scan = np.load(path)
+        if scan.ndim == 3:
+            scan = scan[:, :, channel]
+        elif channel != 0:
+            raise ValueError("%s has no channel %d" % (path, channel))
+    else:
+        graph = tf.Graph()
+        with graph.as_default():
+            image = tf.image.decode_image(tf.read_file(path))
+
+        with tf.Session(graph=graph) as sess:
+            scan = sess.run(image)[:, :, channel]
+
+    if scale_by != 1.0:
+        graph = tf.Graph()
+        with graph.as_default():
+            pixels = tf.placeholder(tf.uint8, shape=[None, None, 1])
+            new_size = [int(scan.shape[0] * scale_by), int(scan.shape[1] * scale_by)]
+            resized = tf.cast(tf.image.resize_images(pixels, new_size, method=tf.image.ResizeMethod.BILINEAR), tf.uint8)
+
+        with tf.Session(graph=graph) as sess:
+            scan = sess.run(resized, feed_dict={pixels: scan[:, :, np.newaxis]})[:, :, 0]
+
+    return scan
+
+## write a probability map as a greyscale png
+def write_png(probabilities, path):
+    graph = tf.Graph()
+    with graph.as_default():
+        pixels = tf.placeholder(tf.uint8, shape=[None, None, 1])
+        png = tf.image.encode_png(pixels)
+
+    with tf.Session(graph=graph) as sess:
+        with open(path, "wb") as f:
+            f.write(sess.run(png, feed_dict={pixels: (np.asarray(probabilities) * 255).astype(np.uint8)[:, :, np.newaxis]}))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scans", help="scans to run the model on, as .npy or png", nargs="+")
+    parser.add_argument("-m", "--model", help="segmentation model script", default="candidate_3.9.4.02.py")
+    parser.add_argument("-a", "--args", help="command line arguments the model was trained with, i.e. \"-d 12\"", default="")
+    parser.add_argument("-c", "--checkpoint", help="checkpoint to restore, defaults to the model's own", default=None)
+    parser.add_argument("--stride", help="pixels between tiles, defaults to three quarters of a tile", default=None, type=int)
+    parser.add_argument("-b", "--batch_size", help="number of tiles per batch", default=8, type=int)
+    parser.add_argument("--scale_by", help="factor to resize the scans by before tiling", default=1.0, type=float)
+    parser.add_argument("-o", "--out", help="directory to write the probability maps to", default="predictions")
+    parser.add_argument("--png", help="also write the maps as pngs", nargs='?', const=True, default=False)
+    parser.add_argument("--filter", help="skip tiles which are mostly background, by their mean and standard deviation",
+                        nargs='?', const=True, default=False)
+    parser.add_argument("--filter_thresholds", help="minimum mean, maximum mean and minimum standard deviation of the "
+                        "tiles to run, on 0-255 pixel values", nargs=3, default=[20.0, 220.0, 5.0], type=float)
+    parser.add_argument("--whole", help="run each scan in a single pass instead of in tiles", nargs='?', const=True,
+                        default=False)
+    parser.add_argument("--compare", help="run each scan both in tiles and in a single pass and compare the time and "
+                        "the maps", nargs='?', const=True, default=False)
+    args = parser.parse_args()
+
+    # the comparison runs the tiles first
+    whole = args.whole and not args.compare
+
+    # a single pass needs the graph built for any input size, which can run the tiles as well
+    argv = shlex.split(args.args)
+    if (args.whole or args.compare) and "--dynamic" not in argv:
+        argv.append("--dynamic")
+
+    namespace = build_candidate_graph(args.model, argv)
+    graph = namespace["graph"]
+    checkpoint = args.checkpoint or os.path.join("./model", namespace["model_name"] + ".ckpt")
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+
+    with graph.as_default():
+        saver = tf.train.Saver()
+
+    with tf.Session(graph=graph) as sess:
+        saver.restore(sess, checkpoint)
+        print("Restored", checkpoint)
+
+        X, probabilities = namespace["X"], namespace["logits_sm"]
+        feed_dict = {namespace["training"]: False}
+
+        tile_filter = TileFilter(*args.filter_thresholds) if args.filter else None
+        inference = TiledInference(sess, X, probabilities, tile_size=namespace["size"], stride=args.stride,
+                                   batch_size=args.batch_size, feed_dict=feed_dict, tile_filter=tile_filter)
+
+        for path in args.scans:
+            scan = read_scan(path, scale_by=args.scale_by)
+            name = os.path.splitext(os.path.basename(path))[0]
+
+            # the map is written straight to disk
+            out = np.lib.format.open_memmap(os.path.join(args.out, name + "_probabilities.npy"), mode="w+",
+                                            dtype=np.float32, shape=scan.shape)
+
+            # the first runs are slower, so the comparison times the tiles after a run which isn't timed, the same as
+            # the single pass
+            if args.compare:
+                inference.predict(scan)
+
+            start = time.time()
+            if whole:
+                out[:] = predict_whole_scan(sess, X, probabilities, scan, feed_dict=feed_dict)
+            else:
+                inference.predict(scan, out=out)
+            seconds = time.time() - start
+            out.flush()
+
+            if whole:
+                print("{}: {}x{} in one pass, {:.2f} seconds".format(name, scan.shape[0], scan.shape[1], seconds))
+            else:
+                print("{}: {}x{} in {} of {} tiles ({:.0%} skipped), {:.2f} seconds".format(
+                    name, scan.shape[0], scan.shape[1], inference.tiles_run, inference.total_tiles,
+                    inference.skipped_fraction(), seconds))
+
+            if args.compare:
+                # the first run of a new input size is slower, so time a second one
+                predict_whole_scan(sess, X, probabilities, scan, feed_dict=feed_dict)
+                start = time.time()
+                whole_map = predict_whole_scan(sess, X, probabilities, scan, feed_dict=feed_dict)
+                whole_seconds = time.time() - start
+
+                difference = np.abs(whole_map - out)
+                print("    one pass: {:.2f} seconds, {:.1f}x faster, mean difference {:.4f}, max {:.4f}, "
+                      "{:.2%} of pixels classified differently".format(
+                          whole_seconds, seconds / whole_seconds, difference.mean(), difference.max(),
+                          np.mean((whole_map > 0.5) != (out > 0.5))))
+
+            if args.png:
+                write_png(out, os.path.join(args.out, name + "_probabilities.png"))
+
+            del out
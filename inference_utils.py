@@ -0,0 +1,281 @@
+import numpy as np
+import tensorflow as tf
+from filter_utils import tile_stats
+
+## Start positions of tiles of tile_size along an axis of length, stride apart, with the last tile against the end so
+## the whole axis is covered. An axis shorter than a tile gets a single tile and is padded.
+def tile_positions(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+
+    positions = list(range(0, length - tile_size + 1, stride))
+    if positions[-1] != length - tile_size:
+        positions.append(length - tile_size)
+
+    return positions
+
+## Weights to blend overlapping tiles with, rising linearly from the edges over overlap pixels so the seams between
+## tiles fade into each other. The edges keep a small weight so pixels only one tile covers are still predicted.
+## Returns: float32 array (tile_size, tile_size)
+def blend_window(tile_size, overlap):
+    ramp = np.ones(tile_size, dtype=np.float32)
+
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+
+    return np.outer(ramp, ramp)
+
+## center and scale uint8 pixels the way the training records and validation data are
+def scale_pixels(tiles, mu=127.0, scale=255.0):
+    return (tiles.astype(np.float32) - mu) / scale
+
+## Runs a segmentation graph over a whole scan of any size. The scan is cut into tiles of the size the graph was built
+## for, stride apart, which are run in batches through X, and the probability maps are blended back together with
+## overlap-add. The tiles are run row by row and only a band one tile high is kept in memory, each band is written to
+## the output as soon as no later tile overlaps it, so memory use depends on the scan width and not its height. The
+## output can be a np.memmap so the full map never has to be in memory either.
+## Args: sess - tf.Session - with the model restored
+##       X - the image placeholder, [None, tile_size, tile_size, 1]
+##       probabilities - the probability map output, i.e. logits_sm
+##       tile_size - int - tile height and width, defaults to the size of X
+##       stride - int - pixels between tiles, defaults to three quarters of a tile
+##       batch_size - int - number of tiles per run
+##       feed_dict - dict - anything else to feed, i.e. {training: False}
+##       preprocess - fn(uint8 tiles) -> float tiles to feed to X
+##       tile_filter - fn(scan, ys, xs, tile_size) -> bool array (len(ys), len(xs)) of the tiles to run, i.e. a
+##                     TileFilter, or None to run them all. The tiles which are not run are predicted as 0.
+class TiledInference(object):
+    def __init__(self, sess, X, probabilities, tile_size=None, stride=None, batch_size=8, feed_dict=None,
+                 preprocess=scale_pixels, tile_filter=None):
+        self.sess = sess
+        self.X = X
+        self.probabilities = probabilities
+        self.tile_size = tile_size or X.get_shape().as_list()[1]
+        self.stride = stride or self.tile_size * 3 // 4
+        self.batch_size = batch_size
+        self.feed_dict = feed_dict or {}
+        self.preprocess = preprocess
+        self.tile_filter = tile_filter
+
+        self.window = blend_window(self.tile_size, self.tile_size - self.stride)
+
+        # the number of tiles of the last scan and how many of them were run
+        self.total_tiles = 0
+        self.tiles_run = 0
+
+    ## the (y, x) of the tiles of a scan to run, in row major order
+    def tiles(self, scan):
+        ys = tile_positions(scan.shape[0], self.tile_size, self.stride)
+        xs = tile_positions(scan.shape[1], self.tile_size, self.stride)
+
+        if self.tile_filter is not None:
+            keep = self.tile_filter(scan, ys, xs, self.tile_size)
+        else:
+            keep = np.ones((len(ys), len(xs)), dtype=bool)
+
+        self.total_tiles = len(ys) * len(xs)
+        self.tiles_run = int(keep.sum())
+
+        return [(y, x) for i, y in enumerate(ys) for j, x in enumerate(xs) if keep[i, j]]
+
+    ## fraction of the tiles of the last scan which were skipped, i.e. the fraction of the compute saved by the filter
+    def skipped_fraction(self):
+        return 1.0 - float(self.tiles_run) / self.total_tiles if self.total_tiles else 0.0
+
+    ## the probability maps of a list of tiles
+    def _run_tiles(self, scan, tiles):
+        batch = np.zeros((len(tiles), self.tile_size, self.tile_size, 1), dtype=scan.dtype)
+
+        # tiles past the edge of a scan smaller than a tile are left as background
+        for k, (y, x) in enumerate(tiles):
+            tile = scan[y:y + self.tile_size, x:x + self.tile_size]
+            batch[k, :tile.shape[0], :tile.shape[1], 0] = tile
+
+        feed_dict = dict(self.feed_dict)
+        feed_dict[self.X] = self.preprocess(batch)
+
+        return self.sess.run(self.probabilities, feed_dict=feed_dict).reshape(len(tiles), self.tile_size, self.tile_size)
+
+    ## Predict the probability map of a scan
+    ## Args: scan - uint8 array (height, width) or (height, width, 1)
+    ##       out - float array (height, width) to write the map to, e.g. a np.memmap, or None to allocate one
+    ## Returns: out
+    def predict(self, scan, out=None):
+        if scan.ndim == 3:
+            scan = scan[:, :, 0]
+
+        height, width = scan.shape
+        if out is None:
+            out = np.zeros((height, width), dtype=np.float32)
+
+        tiles = self.tiles(scan)
+
+        # the sums of the weighted predictions and of the weights for the rows band_top to band_top + tile_size
+        band_height = self.tile_size
+        band_width = max(width, self.tile_size)
+        band = np.zeros((band_height, band_width), dtype=np.float32)
+        weights = np.zeros((band_height, band_width), dtype=np.float32)
+        band_top = 0
+
+        def flush(top, stop):
+            # the rows from top to stop are finished, write them out and move the band down
+            rows = min(stop, height) - top
+            n = min(rows, band_height)
+            if rows <= 0:
+                return
+
+            out[top:top + n] = band[:n, :width] / np.maximum(weights[:n, :width], 1e-6)
+            out[top + n:top + rows] = 0
+
+            band[:band_height - n] = band[n:]
+            weights[:band_height - n] = weights[n:]
+            band[band_height - n:] = 0
+            weights[band_height - n:] = 0
+
+        for start in range(0, len(tiles), self.batch_size):
+            batch_tiles = tiles[start:start + self.batch_size]
+            maps = self._run_tiles(scan, batch_tiles) * self.window
+
+            for (y, x), tile_map in zip(batch_tiles, maps):
+                # no later tile reaches above this row
+                if y > band_top:
+                    flush(band_top, y)
+                    band_top = y
+
+                band[:, x:x + self.tile_size] += tile_map
+                weights[:, x:x + self.tile_size] += self.window
+
+        flush(band_top, height)
+
+        return out
+
+## Predict the probability map of a whole scan in a single run, for a graph built with dynamic height and width (the
+## candidates' --dynamic). The overlapping tiles of TiledInference compute the same features several times, here each
+## pixel is only computed once. The scan is padded to a multiple of the network's total stride, which is 32 for the
+## segmentation candidates, so the upsampling resizes line up with the input.
+## Args: sess - tf.Session - with the model restored
+##       X - the image placeholder, [None, None, None, 1]
+##       probabilities - the probability map output, i.e. logits_sm
+##       scan - uint8 array (height, width) or (height, width, 1)
+##       feed_dict - dict - anything else to feed, i.e. {training: False}
+##       multiple - int - pad the height and width to a multiple of this
+## Returns: float32 array (height, width)
+def predict_whole_scan(sess, X, probabilities, scan, feed_dict=None, multiple=32, preprocess=scale_pixels):
+    if scan.ndim == 3:
+        scan = scan[:, :, 0]
+
+    height, width = scan.shape
+    padded_height = -(-height // multiple) * multiple
+    padded_width = -(-width // multiple) * multiple
+
+    # pad with background as the tiles past the edge of a scan are
+    padded = np.zeros((1, padded_height, padded_width, 1), dtype=scan.dtype)
+    padded[0, :height, :width, 0] = scan
+
+    feed_dict = dict(feed_dict or {})
+    feed_dict[X] = preprocess(padded)
+
+    return sess.run(probabilities, feed_dict=feed_dict)[0, :height, :width, 0]
+
+## Gates the tiles of a scan with a small classifier, as a tile_filter for TiledInference, so the segmentation network
+## only runs on the tiles the classifier scores as abnormal. The tiles are resized to the classifier's input size in
+## its own graph. A prefilter such as a TileFilter can drop the background tiles before they are classified.
+## Args: sess - tf.Session - with the classifier restored
+##       X - the classifier's image input
+##       abnormal_probability - Tensor (batch,) of the probability a tile is abnormal
+##       threshold - float - tiles scoring below this are skipped
+##       batch_size - int - number of tiles per classifier run
+##       feed_dict - dict - anything else to feed, i.e. {training: False}
+##       prefilter - fn(scan, ys, xs, tile_size) -> bool array of the tiles to classify, or None
+class ClassifierGate(object):
+    def __init__(self, sess, X, abnormal_probability, threshold=0.5, batch_size=32, feed_dict=None,
+                 preprocess=scale_pixels, prefilter=None):
+        self.sess = sess
+        self.X = X
+        self.abnormal_probability = abnormal_probability
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.feed_dict = feed_dict or {}
+        self.preprocess = preprocess
+        self.prefilter = prefilter
+
+        input_size = X.get_shape().as_list()[1:3]
+        with sess.graph.as_default():
+            self._tiles = tf.placeholder(tf.float32, shape=[None, None, None, 1])
+            self._resized = tf.image.resize_images(self._tiles, input_size, method=tf.image.ResizeMethod.AREA)
+
+        # the scores of the tiles of the last scan, 0 for tiles the prefilter dropped
+        self.scores = None
+
+    def __call__(self, scan, ys, xs, tile_size):
+        if self.prefilter is not None:
+            keep = self.prefilter(scan, ys, xs, tile_size)
+        else:
+            keep = np.ones((len(ys), len(xs)), dtype=bool)
+
+        tiles = [(i, j) for i in range(len(ys)) for j in range(len(xs)) if keep[i, j]]
+        self.scores = np.zeros((len(ys), len(xs)), dtype=np.float32)
+
+        for start in range(0, len(tiles), self.batch_size):
+            batch_tiles = tiles[start:start + self.batch_size]
+            batch = np.zeros((len(batch_tiles), tile_size, tile_size, 1), dtype=scan.dtype)
+
+            for k, (i, j) in enumerate(batch_tiles):
+                tile = scan[ys[i]:ys[i] + tile_size, xs[j]:xs[j] + tile_size]
+                batch[k, :tile.shape[0], :tile.shape[1], 0] = tile
+
+            feed_dict = dict(self.feed_dict)
+            feed_dict[self.X] = self.sess.run(self._resized, feed_dict={self._tiles: self.preprocess(batch)})
+            scores = self.sess.run(self.abnormal_probability, feed_dict=feed_dict)
+
+            for (i, j), score in zip(batch_tiles, scores):
+                self.scores[i, j] = score
+
+        return self.scores >= self.threshold
+
+## Which pixels of a scan the tiles at ys, xs with keep set cover, from a difference array so it is one pass over the
+## scan whatever the number of tiles
+## Returns: bool array of the scan's shape
+def tile_coverage(shape, ys, xs, tile_size, keep):
+    counts = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int32)
+
+    for i, j in zip(*np.nonzero(keep)):
+        y0, x0 = ys[i], xs[j]
+        y1, x1 = min(y0 + tile_size, shape[0]), min(x0 + tile_size, shape[1])
+        counts[y0, x0] += 1
+        counts[y0, x1] -= 1
+        counts[y1, x0] -= 1
+        counts[y1, x1] += 1
+
+    return np.cumsum(np.cumsum(counts, axis=0), axis=1)[:shape[0], :shape[1]] > 0
+
+## How much of a scan's lesions a cascade keeps at each threshold, from the classifier's scores of the tiles and the
+## ground truth mask
+## Args: scores - array (len(ys), len(xs)) - ClassifierGate.scores of the scan
+##       mask - array (height, width) - ground truth, non zero for lesion pixels
+## Returns: list of dicts of threshold, the fraction of tiles sent to the segmenter, the recall of the tiles with lesion
+##          pixels and the recall of the lesion pixels covered by a tile sent to the segmenter
+def cascade_recall_curve(scores, mask, ys, xs, tile_size, thresholds):
+    mask = np.asarray(mask) > 0
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+
+    # the tiles with any lesion pixels
+    positive = tile_stats(mask, ys, xs, tile_size)[0] > 0
+    lesion_pixels = mask.sum()
+
+    curve = []
+    for threshold in thresholds:
+        keep = scores >= threshold
+        covered = tile_coverage(mask.shape, ys, xs, tile_size, keep)
+
+        curve.append({
+            "threshold": threshold,
+            "tiles_segmented": float(keep.mean()),
+            "tile_recall": float(keep[positive].mean()) if positive.any() else np.nan,
+            "pixel_recall": float(covered[mask].sum() / lesion_pixels) if lesion_pixels else np.nan,
+        })
+
+    return curve
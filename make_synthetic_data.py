@@ -0,0 +1,227 @@
+import os
+import copy
+import argparse
+import numpy as np
+import tensorflow as tf
+from dataset_utils import load_manifest, save_manifest, get_dataset, packed_path, pack_mask_array, index_shard, \
+    train_images_dir
+from training_utils import DATASET_SHAPES
+
+## Make a synthetic mammogram-like image: a smooth bright breast region fading to a dark background with texture noise,
+## and optionally an elliptical lesion which is brighter than the tissue around it.
+## Args: rng - np.random.RandomState
+##       height, width - int - size of the image
+##       lesion - bool - whether to add a lesion
+##       positive_ratio - float - fraction of the pixels the lesion covers
+## Returns: image - uint8 array (height, width), mask - uint8 array (height, width) of 0 and 1
+def synthetic_image(rng, height, width, lesion=True, positive_ratio=0.02):
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+
+    # the breast is a half ellipse against one side of the image
+    cy = height * rng.uniform(0.4, 0.6)
+    ry = height * rng.uniform(0.45, 0.6)
+    rx = width * rng.uniform(0.7, 0.95)
+    tissue = 1.0 - (((rows - cy) / ry) ** 2 + (cols / rx) ** 2)
+    tissue = np.clip(tissue, 0.0, 1.0) ** 0.5
+
+    image = 40.0 + 140.0 * tissue
+    image += rng.normal(0.0, 12.0, size=(height, width)) * (tissue > 0)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+
+    if lesion and positive_ratio > 0:
+        # an ellipse with the requested area somewhere inside the image
+        area = positive_ratio * height * width
+        aspect = rng.uniform(0.6, 1.6)
+        a = np.sqrt(area / np.pi * aspect)
+        b = np.sqrt(area / np.pi / aspect)
+        y0 = rng.uniform(b, max(b, height - b))
+        x0 = rng.uniform(a, max(a, width - a))
+
+        inside = ((rows - y0) / b) ** 2 + ((cols - x0) / a) ** 2 <= 1.0
+        mask[inside] = 1
+        image[inside] += rng.uniform(40.0, 70.0)
+
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    return image, mask
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+## serialize one example in the schema read by read_and_decode_single_example
+def _example(image, label, label_type, packed=False):
+    if label_type == "mask":
+        if packed:
+            feature = {'label_packed': _bytes_feature(np.packbits(label > 0).tobytes())}
+        else:
+            feature = {'label': _bytes_feature(label.tobytes())}
+    else:
+        feature = {'label': _int64_feature(int(label)), 'label_normal': _int64_feature(int(label != 0))}
+
+    feature['image'] = _bytes_feature(image.tobytes())
+
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+## Make n examples of a dataset. Classification examples get a class label from 1 to 4 if they have a lesion and 0
+## otherwise, segmentation examples get the lesion mask.
+## Returns: images - uint8 array (n, size, size, 1), labels - int array (n,) or uint8 array (n, size, size, 1)
+def make_examples(rng, n, size, label_type, positive_examples=0.5, positive_ratio=0.02):
+    images = np.empty((n, size, size, 1), dtype=np.uint8)
+
+    if label_type == "mask":
+        labels = np.empty((n, size, size, 1), dtype=np.uint8)
+    else:
+        labels = np.empty(n, dtype=np.int64)
+
+    for i in range(n):
+        lesion = rng.rand() < positive_examples
+        image, mask = synthetic_image(rng, size, size, lesion=lesion, positive_ratio=positive_ratio)
+        images[i, :, :, 0] = image
+
+        if label_type == "mask":
+            labels[i, :, :, 0] = mask
+        else:
+            labels[i] = rng.randint(1, 5) if lesion else 0
+
+    return images, labels
+
+## Write the training shards of a dataset, splitting the records evenly over the shards listed in the manifest. If
+## packed is set the same records are also written with bit-packed masks, as pack_masks.py would.
+## Returns: the record count of each shard
+def write_training_shards(rng, shard_paths, records, size, label_type, packed=False, **kwargs):
+    counts = [len(part) for part in np.array_split(np.arange(records), len(shard_paths))]
+    packed = packed and label_type == "mask"
+
+    for path, count in zip(shard_paths, counts):
+        paths = [path, packed_path(path)] if packed else [path]
+        writers = [tf.python_io.TFRecordWriter(out_path) for out_path in paths]
+
+        # make the examples in small chunks to keep memory low for large images
+        for start in range(0, count, 64):
+            images, labels = make_examples(rng, min(64, count - start), size, label_type, **kwargs)
+
+            for image, label in zip(images, labels):
+                for writer, packed_label in zip(writers, (False, True)):
+                    writer.write(_example(image, label, label_type, packed=packed_label))
+
+        for writer, out_path in zip(writers, paths):
+            writer.close()
+            index_shard(out_path)
+
+        print("Wrote", count, "records to", path)
+
+    return counts
+
+## write validation or test data in the format load_validation_data reads
+def write_arrays(rng, data_path, labels_path, examples, size, label_type, packed=False, **kwargs):
+    images, labels = make_examples(rng, examples, size, label_type, **kwargs)
+
+    np.save(data_path, images)
+    np.save(labels_path, labels)
+
+    if label_type == "mask" and packed:
+        np.save(packed_path(labels_path), pack_mask_array(labels))
+
+    # the classification datasets also have the filenames of the examples
+    if label_type != "mask":
+        np.save(labels_path.replace("_labels", "_filenames"),
+                np.array(["synthetic_%05d.png" % i for i in range(examples)]))
+
+    print("Wrote", examples, "examples to", data_path)
+
+## write full size scans as pngs with the image in the first channel and the mask in the second, like train_images
+def write_pngs(rng, image_dir, count, height, width, positive_examples=0.5, positive_ratio=0.02):
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        pixels = tf.placeholder(tf.uint8, shape=[height, width, 3])
+        png = tf.image.encode_png(pixels)
+
+    with tf.Session(graph=graph) as sess:
+        for i in range(count):
+            lesion = rng.rand() < positive_examples
+            image, mask = synthetic_image(rng, height, width, lesion=lesion, positive_ratio=positive_ratio)
+
+            channels = np.stack([image, mask, np.zeros_like(image)], axis=-1)
+            with open(os.path.join(image_dir, "P_%05d_SYNTHETIC_%d.png" % (i, i)), "wb") as f:
+                f.write(sess.run(png, feed_dict={pixels: channels}))
+
+    print("Wrote", count, "pngs to", image_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data", help="which datasets to make", nargs="+", type=int, default=[12])
+    parser.add_argument("-o", "--out", help="directory to write the data to", default="synthetic_data")
+    parser.add_argument("-n", "--records", help="number of training records per dataset", default=1000, type=int)
+    parser.add_argument("-e", "--examples", help="number of validation and test examples", default=100, type=int)
+    parser.add_argument("--size", help="image size, defaults to the size of the dataset", default=None, type=int)
+    parser.add_argument("--eval_size", help="size of the validation and test images, defaults to size", default=None, type=int)
+    parser.add_argument("--positive", help="fraction of examples with a lesion", default=0.5, type=float)
+    parser.add_argument("--ratio", help="fraction of the pixels a lesion covers", default=0.02, type=float)
+    parser.add_argument("--packed", help="also write bit-packed masks", nargs='?', const=True, default=False)
+    parser.add_argument("--images", help="number of pngs to write for dataset 100", default=50, type=int)
+    parser.add_argument("--image_size", help="height and width of the pngs, at least 970 for 640 pixel crops at a "
+                        "scale of 0.66", nargs=2, default=[1600, 1200], type=int)
+    parser.add_argument("-s", "--seed", help="random seed", default=0, type=int)
+    args = parser.parse_args()
+
+    # the classification inputs and models are fixed to the size of their dataset
+    for what in args.data:
+        size, label_type = DATASET_SHAPES.get(what, (640, 'mask'))
+        if label_type == "label" and any(other not in (None, size) for other in (args.size, args.eval_size)):
+            parser.error("dataset %d has %d pixel images, --size and --eval_size can't change it" % (what, size))
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+
+    rng = np.random.RandomState(args.seed)
+    kwargs = {"positive_examples": args.positive, "positive_ratio": args.ratio}
+
+    # a copy of the manifest with the synthetic record counts and without any files to download
+    manifest = copy.deepcopy(load_manifest())
+    manifest["data_dir"] = args.out
+
+    for what in args.data:
+        dataset = get_dataset(what, manifest)
+        if dataset is None:
+            print("Unknown dataset", what)
+            continue
+
+        dataset.pop("files", None)
+
+        size, label_type = DATASET_SHAPES.get(what, (640, 'mask'))
+        size = args.size or size
+        eval_size = args.eval_size or size
+
+        if "training" in dataset:
+            paths = [os.path.join(args.out, shard["path"]) for shard in dataset["training"]]
+            counts = write_training_shards(rng, paths, args.records, size, label_type, packed=args.packed, **kwargs)
+
+            for shard, path, count in zip(dataset["training"], paths, counts):
+                shard["records"] = count
+                shard["bytes"] = os.path.getsize(path)
+
+            dataset["records"] = int(sum(counts))
+
+        if what == 100:
+            # where the candidates read them from with this manifest
+            write_pngs(rng, train_images_dir(manifest=manifest), args.images, args.image_size[0],
+                       args.image_size[1], **kwargs)
+
+        for data in ("validation", "test"):
+            if data in dataset:
+                files = dataset[data]
+                write_arrays(rng, os.path.join(args.out, files["data"]), os.path.join(args.out, files["labels"]),
+                             args.examples, eval_size, label_type, packed=args.packed, **kwargs)
+
+    manifest_path = os.path.join(args.out, "datasets.json")
+    save_manifest(manifest, manifest_path)
+
+    print("Wrote manifest to", manifest_path)
+    print("Use it with: DATASETS_MANIFEST=" + manifest_path)
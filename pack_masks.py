@@ -0,0 +1,74 @@
+import os
+import argparse
+import numpy as np
+from dataset_utils import get_dataset, evaluation_files, packed_path, pack_mask_array, index_shard
+
+## Rewrite a tfrecords shard of segmentation examples with the mask bit-packed into a label_packed feature, which is
+## 8 times smaller than the raw uint8 mask. The other features are copied as they are.
+## Returns: number of records written
+def pack_tfrecords(path, out_path=None):
+    import tensorflow as tf
+
+    out_path = out_path or packed_path(path)
+    count = 0
+
+    with tf.python_io.TFRecordWriter(out_path) as writer:
+        for record in tf.python_io.tf_record_iterator(path):
+            example = tf.train.Example.FromString(record)
+            feature = example.features.feature
+
+            mask = np.frombuffer(feature['label'].bytes_list.value[0], dtype=np.uint8)
+            feature['label_packed'].bytes_list.value.append(np.packbits(mask > 0).tobytes())
+            del feature['label']
+
+            writer.write(example.SerializeToString())
+            count += 1
+
+    # the packed shard gets its own offset index for the record sampler
+    index_shard(out_path)
+
+    return count
+
+## write the bit-packed version of a validation or test set's masks next to them
+## Returns: size of the dense and the packed masks in bytes
+def pack_label_array(labels_path):
+    masks = np.load(labels_path, mmap_mode='r')
+    packed = pack_mask_array(masks)
+    np.save(packed_path(labels_path), packed)
+
+    return masks.nbytes, packed.nbytes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--data", help="which datasets to convert", nargs="+", type=int, default=[12])
+    parser.add_argument("--data_dir", help="directory the data is in", default="data")
+    parser.add_argument("--records", help="convert the training shards", nargs='?', const=True, default=False)
+    parser.add_argument("--arrays", help="convert the validation and test masks", nargs='?', const=True, default=False)
+    args = parser.parse_args()
+
+    for what in args.data:
+        dataset = get_dataset(what)
+        if dataset is None:
+            print("Unknown dataset", what)
+            continue
+
+        if args.records:
+            for shard in dataset.get("training", []):
+                path = os.path.join(args.data_dir, shard["path"])
+                if not os.path.exists(path):
+                    print("Skipping", path, "- not downloaded")
+                    continue
+
+                count = pack_tfrecords(path)
+                print("Packed", count, "records from", path, "-", os.path.getsize(path), "->",
+                      os.path.getsize(packed_path(path)), "bytes")
+
+        if args.arrays:
+            for data in ("validation", "test"):
+                _, labels_path = evaluation_files(data=data, which=what, data_dir=args.data_dir)
+                if not os.path.exists(labels_path):
+                    print("Skipping", labels_path, "- not downloaded")
+                    continue
+
+                dense_bytes, packed_bytes = pack_label_array(labels_path)
+                print("Packed", labels_path, "-", dense_bytes, "->", packed_bytes, "bytes")
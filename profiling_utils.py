@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import tensorflow as tf
+
+## Decides which training steps get traced with FULL_TRACE and aggregates the RunMetadata from the traced steps into
+## per-op and per-layer times and memory. Steps which are not traced are run without RunOptions, so when tracing is
+## off there is no overhead at all.
+## Args: every - int - trace every nth step, 0 to turn off
+##       start - int - first step of a window of steps to trace
+##       stop - int - end of the window (exclusive)
+##       max_traces - int - stop tracing after this many traces, None for no limit
+class TraceSampler(object):
+    def __init__(self, every=0, start=None, stop=None, max_traces=50):
+        self.every = every
+        self.start = start
+        self.stop = stop
+        self.max_traces = max_traces
+
+        self.traces = 0
+        self.op_stats = {}
+        self.layer_stats = {}
+        self._run_metadata = None
+
+    def should_trace(self, step):
+        if self.max_traces is not None and self.traces >= self.max_traces:
+            return False
+
+        if self.start is not None and self.stop is not None and self.start <= step < self.stop:
+            return True
+
+        return bool(self.every) and step % self.every == 0
+
+    ## get the keyword arguments to pass to sess.run for this step, empty if the step is not traced
+    def run_kwargs(self, step):
+        if not self.should_trace(step):
+            return {}
+
+        self._run_metadata = tf.RunMetadata()
+
+        return {
+            'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            'run_metadata': self._run_metadata,
+        }
+
+    ## record the metadata of the step that was just run, if it was traced, and optionally log it to tensorboard
+    def record(self, step, writer=None):
+        if self._run_metadata is None:
+            return
+
+        run_metadata = self._run_metadata
+        self._run_metadata = None
+        self.traces += 1
+
+        if writer is not None:
+            writer.add_run_metadata(run_metadata, 'step %d' % step)
+
+        self._aggregate(run_metadata)
+
+    def _aggregate(self, run_metadata):
+        for device in run_metadata.step_stats.dev_stats:
+            # on gpu the same kernels are also reported under stream:all
+            if device.device.endswith("stream:all"):
+                continue
+
+            for node in device.node_stats:
+                name = node.node_name.split(":")[0]
+                micros = node.all_end_rel_micros
+                memory = sum(allocator.total_bytes for allocator in node.memory)
+
+                # the op type is in the timeline label, i.e. "conv0.1/Conv2D = Conv2D(...)"
+                if " = " in node.timeline_label:
+                    op_type = node.timeline_label.split(" = ")[1].split("(")[0]
+                else:
+                    op_type = ""
+
+                _add_stats(self.op_stats, (name, op_type), micros, memory)
+                _add_stats(self.layer_stats, _layer_name(name), micros, memory)
+
+    ## write the aggregated op and layer stats as csv files in the directory, normally the tensorboard log dir
+    def write_report(self, log_dir):
+        if not self.traces:
+            return None
+
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        ops_path = os.path.join(log_dir, "profile_ops.csv")
+        with open(ops_path, "w") as f:
+            f.write("op,type,calls,mean_ms_per_step,total_ms,mean_bytes_per_step\n")
+            for (name, op_type), (calls, micros, memory) in _sorted_stats(self.op_stats):
+                f.write("{},{},{},{:.3f},{:.3f},{:.0f}\n".format(name, op_type, calls, micros / self.traces / 1000.0,
+                                                                   micros / 1000.0, memory / self.traces))
+
+        layers_path = os.path.join(log_dir, "profile_layers.csv")
+        with open(layers_path, "w") as f:
+            f.write("layer,ops,mean_ms_per_step,total_ms,mean_bytes_per_step\n")
+            for layer, (calls, micros, memory) in _sorted_stats(self.layer_stats):
+                f.write("{},{},{:.3f},{:.3f},{:.0f}\n".format(layer, calls, micros / self.traces / 1000.0,
+                                                             micros / 1000.0, memory / self.traces))
+
+        print("Wrote profile of", self.traces, "traced steps to", log_dir)
+
+        return ops_path, layers_path
+
+def _add_stats(stats, key, micros, memory):
+    calls, total_micros, total_memory = stats.get(key, (0, 0, 0))
+    stats[key] = (calls + 1, total_micros + micros, total_memory + memory)
+
+def _sorted_stats(stats):
+    return sorted(stats.items(), key=lambda item: item[1][1], reverse=True)
+
+## the layer is the top name scope of an op, gradient ops are grouped by the layer they are the gradient of
+def _layer_name(name):
+    parts = name.split("/")
+
+    if parts[0] == "gradients" and len(parts) > 2:
+        return parts[1] + " (backward)"
+
+    return parts[0]
+
+## Breaks the training step time down into waiting for input and running the model. Every step's wall time is
+## recorded. On every nth step the batch is first dequeued on its own and then fed to the training step, which splits
+## the step into input wait and compute and is when the fill level of the input queues is read. The metrics steps and
+## the summary writing are timed separately. Every report_every steps the averages are written to tensorboard and
+## printed. A starved input pipeline shows up as a large input wait and empty queues.
+## Args: every - int - split every nth step, 0 to turn the timing off
+##       report_every - int - write and print the averages every nth step
+class StepTimer(object):
+    def __init__(self, every=0, report_every=500):
+        self.every = every
+        self.report_every = report_every
+
+        self.queue_sizes = []
+        self._reset()
+
+    def _reset(self):
+        self.times = {}
+        self.queues = {}
+        self.steps = 0
+
+    ## get the size ops of the input queues of the graph
+    def setup(self, graph):
+        if not self.every:
+            return
+
+        with graph.as_default():
+            self.queue_sizes = [(runner.queue.name, runner.queue.size())
+                                for runner in graph.get_collection(tf.GraphKeys.QUEUE_RUNNERS)]
+
+    ## split the last step of every every steps, which keeps it off the metrics steps
+    def should_split(self, i):
+        return bool(self.every) and (i + 1) % self.every == 0
+
+    def add(self, kind, seconds):
+        count, total = self.times.get(kind, (0, 0.0))
+        self.times[kind] = (count + 1, total + seconds)
+
+    ## read the number of elements in each input queue
+    def sample_queues(self, sess):
+        if not self.queue_sizes:
+            return
+
+        sizes = sess.run([size for _, size in self.queue_sizes])
+        for (name, _), size in zip(self.queue_sizes, sizes):
+            count, total = self.queues.get(name, (0, 0))
+            self.queues[name] = (count + 1, total + size)
+
+    def mean(self, kind):
+        count, total = self.times.get(kind, (0, 0.0))
+        return total / count if count else None
+
+    ## count a finished step and write and print the averages if a report is due
+    def step_done(self, step, writer=None):
+        if not self.every:
+            return
+
+        self.steps += 1
+        if self.steps < self.report_every:
+            return
+
+        values = dict((kind, self.mean(kind)) for kind in self.times)
+
+        # the fraction of a split step spent waiting for input
+        if values.get("input_wait") is not None and values.get("compute") is not None:
+            values["input_wait_fraction"] = values["input_wait"] / (values["input_wait"] + values["compute"])
+
+        queues = dict((name, float(total) / count) for name, (count, total) in self.queues.items())
+
+        if writer is not None:
+            summary = tf.Summary()
+            for kind, value in sorted(values.items()):
+                summary.value.add(tag="timing/" + kind, simple_value=value)
+            for name, value in sorted(queues.items()):
+                summary.value.add(tag="queues/" + name, simple_value=value)
+            writer.add_summary(summary, step)
+
+        line = "Step {} - {:.3f} s/step".format(step, values.get("step", 0.0))
+        if "input_wait_fraction" in values:
+            line += " - input wait {:.3f} s ({:.0%}) - compute {:.3f} s".format(
+                values["input_wait"], values["input_wait_fraction"], values["compute"])
+        if values.get("metrics_step") is not None:
+            line += " - metrics step {:.3f} s".format(values["metrics_step"])
+        if values.get("summary") is not None:
+            line += " - summaries {:.3f} s".format(values["summary"])
+        for name, value in sorted(queues.items()):
+            line += " - {} {:.0f}".format(name, value)
+        print(line)
+
+        self._reset()
+
+## parse a step window in the form "start:stop"
+def parse_step_window(window):
+    if not window:
+        return None, None
+
+    start, stop = window.split(":")
+    return int(start), int(stop)
+
+## peak resident memory of this process in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes, mac os bytes
+    if sys.platform == "darwin":
+        return peak / 2.0 ** 20
+
+    return peak / 1024.0
+
+## Time a benchmark loop and the cpu it uses. Call start() after the warm up steps and stop() after the timed steps.
+## cpu_utilization is the cpu time of all the threads of the process divided by the wall time, so 4.0 means 4 cores
+## were kept busy on average.
+class Stopwatch(object):
+    def start(self):
+        self.wall = time.time()
+        self.cpu = _cpu_seconds()
+
+    def stop(self):
+        self.seconds = time.time() - self.wall
+        self.cpu_utilization = (_cpu_seconds() - self.cpu) / max(self.seconds, 1e-9)
+
+        return self.seconds
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+## get the commit the benchmark is run on so results can be compared across commits
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+## Run one benchmark configuration in a fresh python process, so its peak memory and threads don't affect the others.
+## The script is called with --run <config as json> and should print its result as a json line starting with RESULT.
+## Returns: dict of the result, with an error entry if the run failed
+def run_in_subprocess(script, config, timeout=None, env=None):
+    command = [sys.executable, script, "--run", json.dumps(config)]
+
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        return dict(config, error="timeout")
+
+    for line in reversed(output.stdout.decode().splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+
+    error = output.stderr.decode().strip().splitlines()
+    return dict(config, error=error[-1] if error else "exit code %d" % output.returncode)
+
+## print the result of a benchmark run for run_in_subprocess to pick up
+def report_result(result):
+    print("RESULT " + json.dumps(result))
+    sys.stdout.flush()
+
+## write a list of result dicts as a csv table and a json file
+## Returns: paths of the csv and json files
+def write_results(results, path):
+    columns = []
+    for result in results:
+        for key in result:
+            if key not in columns:
+                columns.append(key)
+
+    root, _ = os.path.splitext(path)
+    csv_path = root + ".csv"
+    json_path = root + ".json"
+
+    with open(csv_path, "w") as f:
+        f.write(",".join(columns) + "\n")
+        for result in results:
+            f.write(",".join(_csv_value(result.get(column, "")) for column in columns) + "\n")
+
+    with open(json_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    return csv_path, json_path
+
+def _csv_value(value):
+    if isinstance(value, float):
+        return "{:.4f}".format(value)
+
+    value = str(value)
+    if "," in value or '"' in value:
+        value = '"' + value.replace('"', '""') + '"'
+
+    return value
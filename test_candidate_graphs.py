@@ -0,0 +1,66 @@
+import os
+import sys
+import shlex
+import shutil
+import tempfile
+import subprocess
+import unittest
+import dataset_utils
+
+try:
+    import tensorflow as tf
+    from graph_utils import build_candidate_graph
+    from cascade_scan import CLASSIFIER_ARGS
+except ImportError:
+    tf = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+## Builds candidate graphs the way the tools do, without any data, and checks the shapes of their inputs
+@unittest.skipIf(tf is None, "tensorflow is not installed")
+class CandidateGraphTest(unittest.TestCase):
+    def build(self, script, argv):
+        return build_candidate_graph(os.path.join(REPO_DIR, script), argv)
+
+    def assertInputSize(self, namespace, size):
+        self.assertEqual(namespace["X"].get_shape().as_list(), [None, size, size, 1])
+        self.assertEqual(namespace["y"].get_shape().as_list(), [None, size, size, 1])
+        self.assertEqual(namespace["logits_sm"].get_shape().as_list()[1:3], [size, size])
+
+    def test_dataset_13_uint8(self):
+        self.assertInputSize(self.build("candidate_3.9.4.02.py", ["-d", "13", "--uint8"]), 320)
+
+    def test_dataset_13_tfdata(self):
+        self.assertInputSize(self.build("candidate_3.9.4.02.py", ["-d", "13", "--tfdata"]), 320)
+
+    ## make a small synthetic copy of a dataset and point the manifest at it until the test ends
+    def synthetic_data(self, dataset, *argv):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+
+        subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "make_synthetic_data.py"), "-d", str(dataset),
+                               "-o", data_dir] + list(argv))
+
+        self.addCleanup(setattr, dataset_utils, "_manifest", dataset_utils._manifest)
+        self.addCleanup(setattr, dataset_utils, "MANIFEST_PATH", dataset_utils.MANIFEST_PATH)
+        dataset_utils.MANIFEST_PATH, dataset_utils._manifest = os.path.join(data_dir, "datasets.json"), None
+
+    ## the sampler indexes the shards when it is built, so it reads a few synthetic records
+    def test_dataset_13_sampler(self):
+        self.synthetic_data(13, "-n", "4", "-e", "2")
+        self.assertInputSize(self.build("candidate_3.9.4.02.py", ["-d", "13", "--sampler"]), 320)
+
+    ## the pngs are counted when the graph is built, so they must be where the candidate reads them from
+    def test_dataset_100_synthetic_pngs(self):
+        self.synthetic_data(100, "-e", "2", "--images", "2")
+        self.assertInputSize(self.build("candidate_3.9.4.02.py", ["-d", "100"]), 640)
+
+    ## the cascade restores the classifier from its default arguments
+    def test_cascade_classifier(self):
+        classifier = self.build("candidate_1.0.0.29.py", shlex.split(CLASSIFIER_ARGS))
+
+        self.assertEqual(classifier["X"].get_shape().as_list(), [None, 299, 299, 1])
+        self.assertEqual(classifier["probabilities"].get_shape().as_list(), [None, 2])
+
+if __name__ == "__main__":
+    unittest.main()
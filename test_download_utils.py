@@ -0,0 +1,107 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from download_utils import fetch_file
+
+DATA = bytes(bytearray(range(256))) * 4096
+
+## Serves DATA at every path with byte range support. The paths in truncate and corrupt misbehave on their first
+## request, sending half of the data or flipped bytes, and every request's Range header is recorded.
+class FlakyHandler(BaseHTTPRequestHandler):
+    truncate = set()
+    corrupt = set()
+    ranges = []
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        FlakyHandler.ranges.append((self.path, header))
+
+        start = int(header[len("bytes="):].split("-")[0]) if header else 0
+        body = DATA[start:]
+
+        if self.path in FlakyHandler.corrupt:
+            FlakyHandler.corrupt.discard(self.path)
+            body = bytes(255 - b for b in body)
+
+        self.send_response(206 if header else 200)
+        if header:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(DATA) - 1, len(DATA)))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if self.path in FlakyHandler.truncate:
+            FlakyHandler.truncate.discard(self.path)
+            body = body[:len(body) // 2]
+            self.close_connection = True
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FetchFileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.dest_dir = tempfile.mkdtemp()
+        FlakyHandler.ranges = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dest_dir)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_resumes_interrupted_transfer(self):
+        FlakyHandler.truncate.add("/truncated.bin")
+
+        path = fetch_file(self.url + "/truncated.bin", self.dest_dir, "truncated.bin", size=len(DATA), retries=1)
+
+        self.assertEqual(self.read(path), DATA)
+        self.assertEqual(FlakyHandler.ranges, [("/truncated.bin", None),
+                                               ("/truncated.bin", "bytes=%d-" % (len(DATA) // 2))])
+
+    def test_resumes_with_content_length_when_size_unknown(self):
+        FlakyHandler.truncate.add("/unsized.bin")
+
+        path = fetch_file(self.url + "/unsized.bin", self.dest_dir, "unsized.bin", retries=1)
+
+        self.assertEqual(self.read(path), DATA)
+        self.assertEqual(len(FlakyHandler.ranges), 2)
+
+    def test_retries_checksum_mismatch(self):
+        FlakyHandler.corrupt.add("/corrupt.bin")
+
+        path = fetch_file(self.url + "/corrupt.bin", self.dest_dir, "corrupt.bin", size=len(DATA),
+                          sha256=hashlib.sha256(DATA).hexdigest(), retries=1)
+
+        self.assertEqual(self.read(path), DATA)
+        self.assertEqual(FlakyHandler.ranges, [("/corrupt.bin", None), ("/corrupt.bin", None)])
+
+    def test_gives_up_after_retries(self):
+        FlakyHandler.corrupt.add("/bad.bin")
+
+        with self.assertRaises(IOError):
+            fetch_file(self.url + "/bad.bin", self.dest_dir, "bad.bin", sha256=hashlib.sha256(DATA).hexdigest(),
+                       retries=0)
+
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, "bad.bin")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,475 @@
+import os
+import time
+import signal
+import numpy as np
+import tensorflow as tf
+from training_utils import load_weights
+from profiling_utils import TraceSampler, StepTimer
+from checkpoint_utils import CheckpointManager, load_checkpoint_state
+
+## Runs the session loop that the candidate scripts all share: initializing or restoring the model, starting the queue
+## runners, running the training steps with a metrics fetch every metrics_every steps, saving checkpoints in the
+## background every checkpoint_every epochs or on a step or time cadence, and evaluating on the validation data at the
+## end of each epoch. Each checkpoint also saves the epoch and step within it, the metric history, the streaming metric
+## values and the position of the input sampler, so a restored model continues exactly where it was saved. On SIGTERM
+## a checkpoint is saved after the current step and the script exits, so preempted jobs can be restarted with -r.
+## Args: graph - tf.Graph - the built graph
+##       tensors - dict - tensors from the graph:
+##           X, y, training - the input placeholders
+##           global_step - the global step variable
+##           train_op - op to train all the variables
+##           frozen_train_op - optional op to train only the unfrozen variables
+##           extra_update_ops - batch norm update ops
+##           metrics_op - metric update ops to run on every evaluation batch
+##           merged - merged summaries
+##           train_metrics - dict of name -> tensor to fetch with the training step every metrics_every steps
+##           eval_metrics - dict of name -> tensor to fetch at the end of an evaluation
+##           features - optional output of the last frozen layer, for training from a FeatureCache
+##       model_name - str - name to save the checkpoints and logs as
+##       tracer - TraceSampler - which steps to trace, defaults to no tracing
+##       timer - StepTimer - how to break down the step times, defaults to no timing
+##       checkpoint_steps, checkpoint_seconds - save a checkpoint every n steps or seconds as well
+##       keep_checkpoints - int - number of step checkpoints to keep next to model_name.ckpt
+##       sampler - RecordSampler - the sampler the input pipeline reads from, to save and restore its position
+## Hooks are called with the trainer, the global step and the values:
+##       metrics hooks - fn(trainer, step, values) after each metrics fetch
+##       checkpoint hooks - fn(trainer, step, save_path) after each checkpoint is snapshotted, it is still being written
+##       evaluate hooks - fn(trainer, step, results) after each evaluation
+class Trainer(object):
+    def __init__(self, graph, tensors, model_name, config=None, log_to_tensorboard=True, metrics_every=50,
+                 checkpoint_every=1, print_every=1, tracer=None, timer=None, checkpoint_steps=None,
+                 checkpoint_seconds=None, keep_checkpoints=3, sampler=None):
+        self.graph = graph
+        self.tensors = tensors
+        self.model_name = model_name
+        self.config = config if config is not None else tf.ConfigProto()
+        self.log_to_tensorboard = log_to_tensorboard
+        self.metrics_every = metrics_every
+        self.checkpoint_every = checkpoint_every
+        self.print_every = print_every
+        self.tracer = tracer if tracer is not None else TraceSampler()
+        self.timer = timer if timer is not None else StepTimer()
+        self.checkpoint_steps = checkpoint_steps
+        self.checkpoint_seconds = checkpoint_seconds
+        self.keep_checkpoints = keep_checkpoints
+        self.sampler = sampler
+
+        self.metrics_hooks = []
+        self.checkpoint_hooks = []
+        self.evaluate_hooks = []
+
+        self.sess = None
+        self.step = 0
+
+        # where training is, saved with each checkpoint
+        self.epoch = 0
+        self.epoch_step = 0
+        self.history = {}
+        self.epoch_metrics = None
+        self.preempted = False
+
+        # the sampler position is the one training started at plus the batches read from the pipeline since
+        self.input_state = None
+        self.input_batches = 0
+        self.input_batch_size = None
+        self._metric_values = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## create the session, writers and saver and start the queue runners
+    def open(self):
+        self.sess = tf.Session(graph=self.graph, config=self.config)
+
+        if self.log_to_tensorboard:
+            self.train_writer = tf.summary.FileWriter(self.log_dir('tr'), self.sess.graph)
+            self.test_writer = tf.summary.FileWriter(self.log_dir('te'))
+        else:
+            self.train_writer = None
+            self.test_writer = None
+
+        with self.graph.as_default():
+            self.saver = tf.train.Saver()
+            self.local_init = tf.local_variables_initializer()
+            self.global_init = tf.global_variables_initializer()
+
+            # the streaming metrics are local variables, reset every epoch, so they are saved in the state
+            self.metric_variables = tf.get_collection(tf.GraphKeys.METRIC_VARIABLES)
+            self.metric_placeholders = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                                        for v in self.metric_variables]
+            self.restore_metrics = tf.group(*[v.assign(p) for v, p in zip(self.metric_variables,
+                                                                            self.metric_placeholders)])
+
+        self.timer.setup(self.graph)
+
+        self.checkpoints = CheckpointManager(self.graph, self.model_name,
+                                             checkpoint_dir=os.path.dirname(self.checkpoint_path()),
+                                             keep=self.keep_checkpoints, every_steps=self.checkpoint_steps,
+                                             every_seconds=self.checkpoint_seconds)
+
+        self.sess.run(self.local_init)
+
+        # the queue runners are started once the variables are initialized
+        self.coord = None
+        self.threads = []
+
+    ## stop the queue runners, finish writing the last checkpoint and close the session
+    def close(self):
+        self.stop_queues()
+        self.checkpoints.close()
+
+        for writer in (self.train_writer, self.test_writer):
+            if writer is not None:
+                writer.close()
+
+        self.sess.close()
+
+    def stop_queues(self):
+        if self.coord is not None:
+            self.coord.request_stop()
+            self.coord.join(self.threads)
+            self.coord = None
+            self.threads = []
+
+    def log_dir(self, prefix):
+        return os.path.join('./logs', prefix + '_' + self.model_name)
+
+    def checkpoint_path(self, model_name=None):
+        return os.path.join('./model', (model_name or self.model_name) + '.ckpt')
+
+    def add_hook(self, kind, fn):
+        getattr(self, kind + '_hooks').append(fn)
+
+    def _call_hooks(self, hooks, *args):
+        for fn in hooks:
+            fn(self, *args)
+
+    ## Initialize the variables, initialize them from the weights of another model or restore a model
+    ## Args: init_model - str - model to take the initial weights from
+    ##       restore_model - str - model to restore and continue training
+    ##       exclude - list - variables not to take from init_model
+    def initialize(self, init_model=None, restore_model=None, exclude=None):
+        # restore this model if it has been saved before
+        source = init_model or restore_model or self.model_name
+        init = not os.path.exists(self.checkpoint_path(source) + '.index')
+
+        if init:
+            self.sess.run(self.global_init)
+            print("Initializing model...")
+        elif init_model is not None:
+            self.sess.run(self.global_init)
+
+            # create the initializer function to initialize the weights and run it
+            init_fn = load_weights(init_model, exclude=exclude or [])
+            init_fn(self.sess)
+
+            # reset the global step
+            self.sess.run(self.tensors['global_step'].initializer)
+
+            print("Initializing weights from model", init_model)
+        elif restore_model is not None:
+            self.saver.restore(self.sess, self.checkpoint_path(restore_model))
+            print("Restoring model from", restore_model)
+        else:
+            self.saver.restore(self.sess, self.checkpoint_path())
+            print("Restoring model", self.model_name)
+
+        self.step = self.sess.run(self.tensors['global_step'])
+
+        # continue training from where the checkpoint was saved, the records are only read once the queues start
+        if not init and init_model is None:
+            state = load_checkpoint_state(self.checkpoint_path(source))
+            if state is not None:
+                self.restore_state(state)
+
+        if self.sampler is not None:
+            self.input_state = self.sampler.state()
+
+        # start the queue runners
+        self.coord = tf.train.Coordinator()
+        self.threads = tf.train.start_queue_runners(sess=self.sess, coord=self.coord)
+
+    ## the state to save with a checkpoint to resume training from it
+    def resume_state(self):
+        values = self.sess.run(self.metric_variables)
+
+        state = {
+            'step': int(self.step),
+            'epoch': self.epoch,
+            'epoch_step': self.epoch_step,
+            'history': self.history,
+            'epoch_metrics': self.epoch_metrics,
+            'metric_variables': dict((v.op.name, np.asarray(value).tolist())
+                                     for v, value in zip(self.metric_variables, values)),
+        }
+
+        if self.sampler is not None and self.input_state is not None:
+            state['sampler'] = self.sampler.advance(self.input_state, self.input_batches * (self.input_batch_size or 0))
+
+        return state
+
+    ## continue from a state saved with a checkpoint, the metric values are restored when its epoch is continued
+    def restore_state(self, state):
+        self.epoch = state['epoch']
+        self.epoch_step = state['epoch_step']
+        self.history = state.get('history', {})
+        self.epoch_metrics = state.get('epoch_metrics')
+        self._metric_values = state.get('metric_variables')
+
+        if self.sampler is not None and state.get('sampler') is not None:
+            self.sampler.restore(state['sampler'])
+
+        print("Resuming from epoch", self.epoch, "step", self.epoch_step)
+
+    def _preempt(self, signum, frame):
+        print("Received signal", signum, "- saving a checkpoint after this step")
+        self.preempted = True
+
+    ## save a checkpoint and exit if a SIGTERM was received
+    def _exit_if_preempted(self):
+        if self.preempted:
+            self.save_checkpoint()
+            self.checkpoints.wait()
+            raise SystemExit("Preempted at step %d, restart with -r %s to continue" % (self.step, self.model_name))
+
+    ## Train the model, evaluating it on eval_data after every epoch, starting from the epoch and step restored
+    ## Args: epochs - int - number of epochs to train
+    ##       steps_per_epoch - int - number of training steps per epoch
+    ##       eval_data - EvaluationData - data to evaluate on after each epoch, or None
+    ##       batch_size - int - training input and evaluation batch size
+    ##       freeze - bool - only train the unfrozen variables with frozen_train_op
+    ##       feature_cache - FeatureCache - train the unfrozen layers from stored activations of the frozen layers
+    def train(self, epochs, steps_per_epoch, eval_data=None, batch_size=16, freeze=False, feature_cache=None):
+        print("Training model", self.model_name, "...")
+        update_ops = None
+
+        if feature_cache is not None:
+            if not freeze:
+                raise ValueError("Training from a feature cache requires frozen layers")
+
+            # the frozen layers are cut off by feeding their output, so only the update ops after the cut can run
+            steps_per_epoch = len(feature_cache) // batch_size
+            update_ops = ops_after_cut(self.tensors['extra_update_ops'], self.tensors['features'], self.tensors['X'])
+
+        self.input_batch_size = batch_size
+
+        # on a preemption finish the step, save and exit
+        previous_handler = signal.signal(signal.SIGTERM, self._preempt)
+
+        try:
+            self._train_epochs(epochs, steps_per_epoch, eval_data, batch_size, freeze, feature_cache, update_ops)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+        # write the per op and per layer profile next to the tensorboard logs
+        self.tracer.write_report(self.log_dir('tr'))
+
+    ## the epochs of train, from the restored epoch on
+    def _train_epochs(self, epochs, steps_per_epoch, eval_data, batch_size, freeze, feature_cache, update_ops):
+        for epoch in range(self.epoch, epochs):
+            start = self.epoch_step
+
+            if feature_cache is not None:
+                feeds = ({self.tensors['features']: features, self.tensors['y']: labels}
+                         for features, labels in feature_cache.get_batches(batch_size))
+                batch_metrics = self.train_epoch(epoch, steps_per_epoch, freeze=True, feed_batches=feeds,
+                                                 update_ops=update_ops, start=start)
+            else:
+                batch_metrics = self.train_epoch(epoch, steps_per_epoch, freeze=freeze, start=start)
+
+            self._exit_if_preempted()
+
+            self.epoch, self.epoch_step = epoch + 1, 0
+            for name, values in batch_metrics.items():
+                self.history.setdefault('train_' + name, []).append(float(np.mean(values)) if values else np.nan)
+
+            if eval_data is not None:
+                results = self.evaluate(eval_data, batch_size)
+            else:
+                results = {}
+
+            for name, value in results.items():
+                self.history.setdefault('cv_' + name, []).append(float(value))
+
+            # save checkpoint every nth epoch, after evaluating so the saved history has the epoch's cv metrics
+            if self.checkpoint_every and epoch % self.checkpoint_every == 0:
+                self.save_checkpoint()
+
+            self._exit_if_preempted()
+
+            # Print progress every nth epoch to keep output to reasonable amount
+            if epoch % self.print_every == 0:
+                print('Epoch {:02d} - step {} - cv acc: {:.4f} - train acc: {:.3f} (mean)'.format(
+                    epoch, self.step, results.get('accuracy', np.nan), np.mean(batch_metrics.get('accuracy', [np.nan]))))
+
+    ## Run one epoch of training steps, stopping early after a SIGTERM
+    ## Args: feed_batches - iterable of feed dicts to use instead of the graph's input pipeline, or None
+    ##       update_ops - ops to run with each step instead of extra_update_ops
+    ##       start - int - step of the epoch to continue from, the restored metrics are used if it is not 0
+    ## Returns: dict of metric name -> list of the values fetched during the epoch
+    def train_epoch(self, epoch, steps_per_epoch, freeze=False, feed_batches=None, update_ops=None, start=0):
+        self.sess.run(self.local_init)
+
+        t = self.tensors
+        train_op = t['frozen_train_op'] if freeze else t['train_op']
+        update_ops = t['extra_update_ops'] if update_ops is None else update_ops
+        metric_names = sorted(t['train_metrics'].keys())
+
+        # continue the streaming metrics and the metric lists of a restored epoch
+        if start > 0 and self._metric_values is not None:
+            self.sess.run(self.restore_metrics, feed_dict=dict(
+                (p, self._metric_values[v.op.name]) for v, p in zip(self.metric_variables, self.metric_placeholders)
+                if v.op.name in self._metric_values))
+
+        if start > 0 and self.epoch_metrics is not None:
+            batch_metrics = dict((name, list(self.epoch_metrics.get(name, []))) for name in metric_names)
+        else:
+            batch_metrics = dict((name, []) for name in metric_names)
+
+        self._metric_values = None
+        self.epoch_metrics = batch_metrics
+
+        feeds = iter(feed_batches) if feed_batches is not None else None
+
+        for i in range(start, steps_per_epoch):
+            step_start = time.time()
+
+            feed_dict = {t['training']: True}
+            if feeds is not None:
+                feed_dict.update(next(feeds))
+                self.timer.add('input_wait', time.time() - step_start)
+
+            # get the trace options if this step is sampled
+            trace_kwargs = self.tracer.run_kwargs(epoch * steps_per_epoch + i)
+
+            # on a split step dequeue the batch on its own first, then feed it to the training step
+            split = feeds is None and not trace_kwargs and self.timer.should_split(i)
+            if split:
+                self.timer.sample_queues(self.sess)
+
+                dequeue_start = time.time()
+                feed_dict[t['X']], feed_dict[t['y']] = self.sess.run([t['X'], t['y']])
+                self.timer.add('input_wait', time.time() - dequeue_start)
+
+            run_start = time.time()
+
+            # every nth step get the metrics
+            if (i % self.metrics_every != 0) or (i == 0):
+                _, _, self.step = self.sess.run([train_op, update_ops, t['global_step']],
+                                                feed_dict=feed_dict, **trace_kwargs)
+
+                if split or feeds is not None:
+                    self.timer.add('compute', time.time() - run_start)
+            else:
+                fetches = [train_op, update_ops, t['global_step'], t['merged']] + \
+                          [t['train_metrics'][name] for name in metric_names]
+                values = self.sess.run(fetches, feed_dict=feed_dict, **trace_kwargs)
+                self.timer.add('metrics_step', time.time() - run_start)
+
+                self.step, summary = values[2], values[3]
+                values = dict(zip(metric_names, values[4:]))
+
+                for name in metric_names:
+                    batch_metrics[name].append(float(values[name]))
+
+                # log the summaries to tensorboard
+                if self.train_writer is not None:
+                    summary_start = time.time()
+                    self.train_writer.add_summary(summary, self.step)
+                    self.timer.add('summary', time.time() - summary_start)
+
+                self._call_hooks(self.metrics_hooks, self.step, values)
+
+            self.epoch_step = i + 1
+            if feeds is None:
+                self.input_batches += 1
+
+            # log the meta data of the traced steps
+            self.tracer.record(self.step, self.train_writer)
+
+            self.timer.add('step', time.time() - step_start)
+            self.timer.step_done(self.step, self.train_writer)
+
+            if self.checkpoints.should_save(self.step):
+                self.save_checkpoint()
+
+            if self.preempted:
+                break
+
+        return batch_metrics
+
+    ## snapshot the variables and write them to a new checkpoint in the background, model_name.ckpt is updated to it
+    ## once it is written
+    def save_checkpoint(self):
+        print("Saving checkpoint")
+        save_path = self.checkpoints.save(self.sess, self.step, state=self.resume_state())
+
+        self._call_hooks(self.checkpoint_hooks, self.step, save_path)
+
+        return save_path
+
+    ## Evaluate the model on data that is fed through the X and y placeholders
+    ## Args: data - object with a get_batches(batch_size) method, such as EvaluationData
+    ## Returns: dict of name -> value of the eval_metrics
+    def evaluate(self, data, batch_size=16, writer='test'):
+        t = self.tensors
+
+        # initialize the local variables so we have metrics only on the evaluation
+        self.sess.run(self.local_init)
+
+        print("Evaluating model...")
+        feed_dict = None
+        for batch in data.get_batches(batch_size):
+            feed_dict = {
+                t['X']: batch[0],
+                t['y']: batch[1],
+                t['training']: False
+            }
+            self.sess.run(t['metrics_op'], feed_dict=feed_dict)
+
+        # one more step to get our metrics
+        names = sorted(t['eval_metrics'].keys())
+        metrics = [t['eval_metrics'][name] for name in names]
+
+        # the summaries need a batch, they get the last evaluation batch so they don't dequeue one from the training input
+        if writer == 'test' and self.test_writer is not None and feed_dict is not None:
+            values = self.sess.run([t['merged']] + metrics, feed_dict=feed_dict)
+            self.test_writer.add_summary(values[0], self.step)
+            values = values[1:]
+        else:
+            values = self.sess.run(metrics, feed_dict={t['training']: False})
+
+        results = dict(zip(names, values))
+
+        print("Done evaluating...")
+        self._call_hooks(self.evaluate_hooks, self.step, results)
+
+        return results
+
+## Get the ops from ops which can still run when cut_tensor is fed, i.e. those which do not need input_tensor other than
+## through cut_tensor. Used to drop the batch norm updates of frozen layers when their output is fed from a cache.
+def ops_after_cut(ops, cut_tensor, input_tensor):
+    def needs_input(op):
+        stack = [op]
+        visited = set()
+
+        # walk back through the inputs without going past the cut
+        while stack:
+            current = stack.pop()
+            if current in visited:
+                continue
+            visited.add(current)
+
+            if current is input_tensor.op:
+                return True
+
+            stack.extend(tensor.op for tensor in current.inputs if tensor is not cut_tensor)
+            stack.extend(current.control_inputs)
+
+        return False
+
+    return [op for op in ops if not needs_input(op)]
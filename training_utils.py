@@ -1,11 +1,16 @@
 import numpy as np
 import os
-import wget
 import zipfile
 from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
 import tensorflow as tf
 import math
+import threading
+import queue
+import json
+from download_utils import fetch_file, fetch_dataset
+from dataset_utils import training_shards, evaluation_files, RecordSampler, PackedMasks, load_masks, \
+    put_until_stopped
 
 ## open zip files
 def unzip(file, destination):
@@ -19,28 +24,7 @@ def unzip(file, destination):
 def download_file(url, name):
     print("\nDownloading " + name + "...")
 
-    # check that the data directory exists
-    try:
-        os.stat("data")
-    except:
-        os.mkdir("data")
-
-    try:
-        fname = wget.download(url, os.path.join('data', name))
-
-        # if the file is a zip file unzip it
-        if "zip" in name:
-            try:
-                unzip(os.path.join("data", name), "data")
-
-                os.remove(os.path.join("data", name))
-                print("\nZip file extracted and deleted", name)
-            except:
-                print("Error extracting and/or deleting zip file...")
-
-    except:
-        print("Error downloading", url)
-
+    return fetch_file(url, "data", name)
 
 ## Batch generator with optional filenames parameter which will also return the filenames of the images
 ## so that they can be identified
@@ -68,6 +52,80 @@ def get_batches(X, y, batch_size, filenames=None, distort=False, shuffle=True):
         else:
             yield X_return, y[batch_idx], filenames[batch_idx]
 
+# marks the end of the batches in a prefetch queue
+_END_OF_BATCHES = object()
+
+## Build batches in a background thread and yield them as they are ready. fill(batch_idx, slot) builds the batch for
+## batch_idx into buffer slot number slot. The consumer holds one batch, the queue holds up to prefetch batches and the
+## worker fills one more, so prefetch + 2 buffer slots are needed.
+def _prefetch_batches(batch_indices, fill, prefetch=2):
+    q = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    n_slots = prefetch + 2
+
+    def worker():
+        try:
+            for k, batch_idx in enumerate(batch_indices):
+                if not put_until_stopped(q, fill(batch_idx, k % n_slots), stop):
+                    return
+
+            put_until_stopped(q, _END_OF_BATCHES, stop)
+        except Exception as e:
+            put_until_stopped(q, e, stop)
+
+    thread = threading.Thread(target=worker, name="batch_prefetch")
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+
+            if item is _END_OF_BATCHES:
+                break
+            elif isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        # stop the worker if we are done early
+        stop.set()
+        thread.join()
+
+## Prefetching version of get_batches. The next prefetch batches are assembled in a background thread into
+## preallocated buffers, so building the batches overlaps with running the graph. The buffers are reused so each batch
+## is only valid until the next one is requested, which is fine for feeding it to sess.run.
+def get_batches_prefetch(X, y, batch_size, filenames=None, distort=False, shuffle=True, prefetch=2):
+    shuffled_idx = np.arange(len(y))
+
+    # if we are shuffling shuffle the index
+    if shuffle:
+        np.random.shuffle(shuffled_idx)
+
+    batch_indices = [shuffled_idx[i:i + batch_size] for i in range(0, len(y), batch_size)]
+
+    # one contiguous buffer for each slot
+    n_slots = prefetch + 2
+    X_buffer = np.empty((n_slots, batch_size) + X.shape[1:], dtype=X.dtype)
+    y_buffer = np.empty((n_slots, batch_size) + y.shape[1:], dtype=y.dtype)
+
+    def fill(batch_idx, slot):
+        n = len(batch_idx)
+        X_return = np.take(X, batch_idx, axis=0, out=X_buffer[slot, :n], mode='clip')
+        y_return = np.take(y, batch_idx, axis=0, out=y_buffer[slot, :n], mode='clip')
+
+        # do random flipping of images
+        coin = np.random.binomial(1, 0.5, size=None)
+        if coin and distort:
+            X_return = X_return[..., ::-1, :]
+
+        if filenames is None:
+            return X_return, y_return
+        else:
+            return X_return, y_return, filenames[batch_idx]
+
+    return _prefetch_batches(batch_indices, fill, prefetch=prefetch)
+
 ## Code for data augmentation for images and labels take from http://ddokkddokk.tistory.com/11
 def _do_nothing(image, label):
     return image, label
@@ -87,8 +145,11 @@ def _image_random_flip(image, label):
     image_aug, label_aug = tf.cond(predicate, lambda: _image_and_label_flip(image, label), lambda: _do_nothing(image, label))
     return image_aug, label_aug
 
-## read data from tfrecords file
-def read_and_decode_single_example(filenames, label_type='label_normal', normalize=False, distort=False, num_epochs=None, size=299, scale=True):
+## read data from tfrecords file. If uint8 is True the image and label are returned as uint8 without any scaling so they
+## take up as little space as possible in the shuffle queue, scale_batch should then be called on the batch. If
+## pack_masks is also True masks are bit-packed into size * size / 8 bytes. packed_labels reads records whose masks
+## were stored bit-packed by pack_masks.py.
+def read_and_decode_single_example(filenames, label_type='label_normal', normalize=False, distort=False, num_epochs=None, size=299, scale=True, uint8=False, pack_masks=False, packed_labels=False):
     filename_queue = tf.train.string_input_producer(filenames, num_epochs=num_epochs)
 
     reader = tf.TFRecordReader()
@@ -118,6 +179,29 @@ def read_and_decode_single_example(filenames, label_type='label_normal', normali
             image = tf.image.random_flip_left_right(image)
             image = tf.image.random_flip_up_down(image)
 
+    elif packed_labels:
+        # records written by pack_masks.py store the mask bit-packed
+        features = tf.parse_single_example(
+            serialized_example,
+            features={
+                'label_packed': tf.FixedLenFeature([], tf.string),
+                'image': tf.FixedLenFeature([], tf.string)
+            })
+
+        label = tf.decode_raw(features['label_packed'], tf.uint8)
+        image = tf.decode_raw(features['image'], tf.uint8)
+
+        image = tf.reshape(image, [size, size, 1])
+
+        # the mask can stay packed until after batching
+        if uint8 and pack_masks:
+            label = tf.reshape(label, [size * size // 8])
+        else:
+            label = _unpack_masks(tf.reshape(label, [1, size * size // 8]), size)[0]
+
+            if not uint8:
+                label = tf.cast(label, tf.int32)
+
     else:
         features = tf.parse_single_example(
             serialized_example,
@@ -131,9 +215,19 @@ def read_and_decode_single_example(filenames, label_type='label_normal', normali
         label = tf.decode_raw(features['label'], tf.uint8)
         image = tf.decode_raw(features['image'], tf.uint8)
 
-        label = tf.cast(label, tf.int32)
         image = tf.reshape(image, [size, size, 1])
-        label = tf.reshape(label, [size, size, 1])
+
+        if not uint8:
+            label = tf.cast(label, tf.int32)
+            label = tf.reshape(label, [size, size, 1])
+        elif pack_masks:
+            label = _pack_mask(tf.reshape(label, [size * size]))
+        else:
+            label = tf.reshape(label, [size, size, 1])
+
+    # leave the image as uint8, it will be scaled after batching
+    if uint8:
+        return image, label
 
     if scale:
         # image = tf.cast(image, tf.float32)
@@ -145,87 +239,225 @@ def read_and_decode_single_example(filenames, label_type='label_normal', normali
     # return the image and the label
     return image, label
 
+## pack a binary uint8 mask into 1 bit per pixel, the number of pixels must be a multiple of 8
+def _pack_mask(mask):
+    bits = tf.reshape(tf.cast(tf.greater(mask, 0), tf.int32), [-1, 8])
+    packed = tf.reduce_sum(bits * tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.int32), axis=1)
 
-## load the test data from files
-def load_validation_data(data="validation", how="normal", which=5, percentage=1, scale=False, shuffle_data=1, size=640):
-    if data == "validation":
-        # load the two data files
-        if which == 4:
-            X_cv = np.load(os.path.join("data", "cv4_data.npy"))
-            labels = np.load(os.path.join("data", "cv4_labels.npy"))
-        elif which == 5:
-            X_cv = np.load(os.path.join("data", "cv5_data.npy"))
-            labels = np.load(os.path.join("data", "cv5_labels.npy"))
-        elif which == 6:
-            X_cv = np.load(os.path.join("data", "cv6_data.npy"))
-            labels = np.load(os.path.join("data", "cv6_labels.npy"))
-        elif which == 8:
-            X_cv = np.load(os.path.join("data", "cv8_data.npy"))
-            labels = np.load(os.path.join("data", "cv8_labels.npy"))
-        elif which == 9:
-            X_cv = np.load(os.path.join("data", "cv9_data.npy"))
-            labels = np.load(os.path.join("data", "cv9_labels.npy"))
-        elif which == 10:
-            X_cv = np.load(os.path.join("data", "cv10_data.npy"))
-            labels = np.load(os.path.join("data", "cv10_labels.npy"))
-        elif which == 11:
-            X_cv = np.load(os.path.join("data", "cv11_data.npy"))
-            labels = np.load(os.path.join("data", "cv11_labels.npy"))
-        elif which == 12:
-            X_cv = np.load(os.path.join("data", "cv12_data.npy"))
-            labels = np.load(os.path.join("data", "cv12_labels.npy"))
-        elif which == 13:
-            X_cv = np.load(os.path.join("data", "cv13_data.npy"))
-            labels = np.load(os.path.join("data", "cv13_labels.npy"))
-        elif which == 100:
-            X_cv = np.load(os.path.join("data", "cv101_data.npy"))
-            labels = np.load(os.path.join("data", "cv101_labels.npy"))
-        else:
-            X_cv = np.load(os.path.join("data", "cv13_data.npy"))
-            labels = np.load(os.path.join("data", "cv13_labels.npy"))
-    elif data == "test":
-        if which == 4:
-            X_cv = np.load(os.path.join("data", "test4_data.npy"))
-            labels = np.load(os.path.join("data", "test4_labels.npy"))
-        elif which == 5:
-            X_cv = np.load(os.path.join("data", "test5_data.npy"))
-            labels = np.load(os.path.join("data", "test5_labels.npy"))
-        elif which == 6:
-            X_cv = np.load(os.path.join("data", "test6_data.npy"))
-            labels = np.load(os.path.join("data", "test6_labels.npy"))
-        elif which == 8:
-            X_cv = np.load(os.path.join("data", "test8_data.npy"))
-            labels = np.load(os.path.join("data", "test8_labels.npy"))
-        elif which == 9:
-            X_cv = np.load(os.path.join("data", "test9_data.npy"))
-            labels = np.load(os.path.join("data", "test9_labels.npy"))
-        elif which == 10:
-            X_cv = np.load(os.path.join("data", "test10_data.npy"))
-            labels = np.load(os.path.join("data", "test10_labels.npy"))
-        elif which == 11:
-            X_cv = np.load(os.path.join("data", "test11_data.npy"))
-            labels = np.load(os.path.join("data", "test11_labels.npy"))
-        elif which == 12:
-            X_cv = np.load(os.path.join("data", "test12_data.npy"))
-            labels = np.load(os.path.join("data", "test12_labels.npy"))
-        elif which == 13:
-            X_cv = np.load(os.path.join("data", "test13_data.npy"))
-            labels = np.load(os.path.join("data", "test13_labels.npy"))
-        elif which == 100:
-            X_cv = np.load(os.path.join("data", "test101_data.npy"))
-            labels = np.load(os.path.join("data", "test101_labels.npy"))
-        else:
-            X_cv = np.load(os.path.join("data", "test13_data.npy"))
-            labels = np.load(os.path.join("data", "test13_labels.npy"))
-    elif data == "mias":
-        if which == 9:
-            X_cv = np.load(os.path.join("data", "all_mias_slices9.npy"))
-            labels = np.load(os.path.join("data", "all_mias_labels9.npy"))
+    return tf.cast(packed, tf.uint8)
+
+## unpack a batch of bit-packed masks to shape (batch, size, size, 1)
+def _unpack_masks(packed, size):
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    bits = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.expand_dims(packed, -1), shifts), 1)
+
+    return tf.reshape(bits, [-1, size, size, 1])
+
+## cast, center and scale a batch that was read with uint8=True in a single step
+## Args: images - uint8 Tensor of images, shape (batch_size, size, size, 1)
+##       labels - uint8 Tensor of labels, shape (batch_size,), (batch_size, size, size, 1) or bit-packed masks
+##       mask_size - int - if the masks are bit-packed the size to unpack them to
+## Returns: images - float32 Tensor, labels - int32 Tensor
+def scale_batch(images, labels, mu=127.0, scale=255.0, mask_size=None, normalize=False):
+    if mask_size is not None:
+        labels = _unpack_masks(labels, mask_size)
+
+    images = _scale_input_data(images, contrast=0, mu=mu, scale=scale)
+    labels = tf.cast(labels, tf.int32)
+
+    if normalize:
+        images = tf.map_fn(tf.image.per_image_standardization, images)
+
+    return images, labels
+
+## image size and label type of a single training example for each dataset
+DATASET_SHAPES = {
+    8: (299, 'label'),
+    9: (299, 'label'),
+    10: (288, 'mask'),
+    12: (640, 'mask'),
+    13: (320, 'mask'),
+    100: (640, 'mask'),
+}
+
+## Calculate how much memory a shuffle queue of the given capacity holds for each dataset when the examples are queued
+## as float32/int32, as uint8 and as uint8 with bit-packed masks, and print the savings
+## Args: capacity - int - number of examples the queue holds, i.e. 75 * batch_size
+## Returns: dict of dataset -> (float_bytes, uint8_bytes, packed_bytes)
+def input_buffer_memory(capacity, datasets=None, verbose=True):
+    if datasets is None:
+        datasets = sorted(DATASET_SHAPES.keys())
+
+    results = {}
+    for which in datasets:
+        size, label_type = DATASET_SHAPES[which]
+        pixels = size * size
+
+        if label_type == 'mask':
+            float_bytes = pixels * 4 + pixels * 4
+            uint8_bytes = pixels + pixels
+            packed_bytes = pixels + pixels // 8
         else:
-            X_cv = np.load(os.path.join("data", "mias_test_images.npy"))
-            labels = np.load(os.path.join("data", "mias_test_labels_enc.npy"))
+            # the classification labels are int64 either way
+            float_bytes = pixels * 4 + 8
+            uint8_bytes = pixels + 8
+            packed_bytes = uint8_bytes
 
-    # encode the labels appropriately
+        results[which] = (float_bytes * capacity, uint8_bytes * capacity, packed_bytes * capacity)
+
+        if verbose:
+            print("Dataset {:3d} - float: {:8.1f} MB - uint8: {:8.1f} MB - packed: {:8.1f} MB - saved: {:8.1f} MB".format(
+                which, float_bytes * capacity / 2 ** 20, uint8_bytes * capacity / 2 ** 20,
+                packed_bytes * capacity / 2 ** 20, (float_bytes - packed_bytes) * capacity / 2 ** 20))
+
+    return results
+
+## randomly flip each example in a batch along an axis, the labels are flipped along with the images if provided
+def _random_flip_batch(images, axis, labels=None, seed=None):
+    coin = tf.less(tf.random_uniform([tf.shape(images)[0]], 0, 1.0, seed=seed), 0.5)
+    images = tf.where(coin, tf.reverse(images, [axis]), images)
+
+    if labels is not None:
+        labels = tf.where(coin, tf.reverse(labels, [axis]), labels)
+
+    return images, labels
+
+## parse a batch of serialized examples at once, this is the batched equivalent of the parsing and decoding done in
+## read_and_decode_single_example
+def _parse_batch(serialized_batch, label_type='label_normal', normalize=False, distort=False, size=299, scale=True,
+                 packed_labels=False):
+    if label_type != 'label_mask':
+        features = tf.parse_example(
+            serialized_batch,
+            features={
+                'label': tf.FixedLenFeature([], tf.int64),
+                'label_normal': tf.FixedLenFeature([], tf.int64),
+                'image': tf.FixedLenFeature([], tf.string)
+            })
+
+        # extract the data, decode_raw on a vector of strings gives us a [batch, 299 * 299] tensor
+        label = features[label_type]
+        image = tf.decode_raw(features['image'], tf.uint8)
+        image = tf.reshape(image, [-1, 299, 299, 1])
+
+        # random flipping of images
+        if distort:
+            image, _ = _random_flip_batch(image, 2)
+            image, _ = _random_flip_batch(image, 1)
+
+    else:
+        label_key = 'label_packed' if packed_labels else 'label'
+        features = tf.parse_example(
+            serialized_batch,
+            features={
+                label_key: tf.FixedLenFeature([], tf.string),
+                'image': tf.FixedLenFeature([], tf.string)
+            })
+
+        label = tf.decode_raw(features[label_key], tf.uint8)
+        image = tf.decode_raw(features['image'], tf.uint8)
+
+        # unpack the whole batch of masks at once
+        if packed_labels:
+            label = _unpack_masks(label, size)
+
+        label = tf.cast(label, tf.int32)
+        image = tf.reshape(image, [-1, size, size, 1])
+        label = tf.reshape(label, [-1, size, size, 1])
+
+        # random flipping of the images and masks together
+        if distort:
+            image, label = _random_flip_batch(image, 2, labels=label)
+            image, label = _random_flip_batch(image, 1, labels=label)
+
+    if scale:
+        image = _scale_input_data(image, contrast=0, mu=127.0, scale=255.0)
+
+    if normalize:
+        image = tf.map_fn(tf.image.per_image_standardization, tf.cast(image, tf.float32))
+
+    return image, label
+
+## tf.data replacement for read_and_decode_single_example + tf.train.shuffle_batch. The tfrecords shards are read in
+## parallel, whole batches are parsed at once and the batches are prefetched so no queue runners are needed.
+## Args: filenames - list - tfrecords files to read
+##       batch_size - int - number of examples per batch
+##       num_parallel_reads - int - how many shards to read from at once
+##       num_parallel_calls - int - how many batches to parse at once
+##       shuffle_buffer - int - number of examples to shuffle over, equivalent to min_after_dequeue
+##       prefetch - int - number of parsed batches to keep ready
+##       packed_labels - bool - the masks in the records are bit-packed, see pack_masks.py
+## Returns: image - Tensor of images, shape (batch_size, size, size, 1)
+##          label - Tensor of labels, shape (batch_size,) or (batch_size, size, size, 1) for masks
+def read_and_decode_batches(filenames, batch_size, label_type='label_normal', normalize=False, distort=False,
+                            num_epochs=None, size=299, scale=True, num_parallel_reads=4, num_parallel_calls=6,
+                            shuffle_buffer=1000, prefetch=2, seed=None, packed_labels=False):
+    if label_type != 'label':
+        label_type = 'label_' + label_type
+
+    # shuffle the order of the shards then read records from several of them at once
+    files = tf.data.Dataset.from_tensor_slices(filenames)
+    files = files.shuffle(len(filenames), seed=seed)
+
+    dataset = files.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset,
+                                                              cycle_length=num_parallel_reads, sloppy=True))
+
+    # shuffle the serialized records, they are much cheaper to hold than the decoded images
+    dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(shuffle_buffer, count=num_epochs, seed=seed))
+
+    # batch before parsing so we can parse and decode the whole batch in one step
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: _parse_batch(serialized, label_type=label_type, normalize=normalize,
+                                                          distort=distort, size=size, scale=scale,
+                                                          packed_labels=packed_labels),
+                          num_parallel_calls=num_parallel_calls)
+
+    dataset = dataset.prefetch(prefetch)
+
+    iterator = dataset.make_one_shot_iterator()
+    image, label = iterator.get_next()
+
+    return image, label
+
+
+## Input pipeline which reads the training records in a new global permutation every epoch with a RecordSampler instead
+## of mixing them in a shuffle buffer, so how well the data is shuffled doesn't depend on a buffer size.
+## Args: same as read_and_decode_batches
+##       sampler - RecordSampler - sampler to use, i.e. one restored from a saved state
+##       readahead - int - number of records the sampler reads at a time
+## Returns: image and label batches and the sampler, whose state() gives the position in the data
+def read_and_decode_sampled(filenames, batch_size, label_type='label_normal', normalize=False, distort=False,
+                            num_epochs=None, size=299, scale=True, num_parallel_calls=6, prefetch=2, seed=0,
+                            sampler=None, readahead=64, packed_labels=False):
+    if label_type != 'label':
+        label_type = 'label_' + label_type
+
+    if sampler is None:
+        sampler = RecordSampler(filenames, seed=seed, readahead=readahead, num_epochs=num_epochs)
+
+    dataset = tf.data.Dataset.from_generator(sampler.records, tf.string, tf.TensorShape([]))
+
+    # batch before parsing so we can parse and decode the whole batch in one step
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: _parse_batch(serialized, label_type=label_type, normalize=normalize,
+                                                          distort=distort, size=size, scale=scale,
+                                                          packed_labels=packed_labels),
+                          num_parallel_calls=num_parallel_calls)
+
+    dataset = dataset.prefetch(prefetch)
+
+    iterator = dataset.make_one_shot_iterator()
+    image, label = iterator.get_next()
+
+    return image, label, sampler
+
+
+## get the paths of the data and labels files for a validation, test or mias dataset
+def _validation_files(data="validation", which=5, data_dir=None):
+    return evaluation_files(data=data, which=which, data_dir=data_dir)
+
+## encode the class labels for the type of classification being done
+def _encode_labels(labels, how="normal"):
     if how == "label":
         y_cv = labels
     elif how == "normal":
@@ -243,7 +475,24 @@ def load_validation_data(data="validation", how="normal", which=5, percentage=1,
         y_cv[labels == 2] = 1
         y_cv[labels == 3] = 2
         y_cv[labels == 4] = 2
-    elif how == "mask":
+
+    return y_cv
+
+## load the test data from files
+def load_validation_data(data="validation", how="normal", which=5, percentage=1, scale=False, shuffle_data=1, size=640,
+                         data_dir=None):
+    data_path, labels_path = _validation_files(data=data, which=which, data_dir=data_dir)
+
+    # load the two data files, masks are read from their bit-packed version if there is one
+    X_cv = np.load(data_path)
+
+    if how == "mask":
+        labels = load_masks(labels_path, X_cv.shape[2])
+    else:
+        labels = np.load(labels_path)
+
+    # encode the labels appropriately
+    if how == "mask":
         y_cv = labels.astype(np.int32)
 
         data_size = X_cv.shape[0]
@@ -254,6 +503,8 @@ def load_validation_data(data="validation", how="normal", which=5, percentage=1,
 
             X_cv = X_cv[:,starty:starty + size, startx:startx + size,:]
             y_cv = y_cv[:,starty:starty + size, startx:startx + size,:]
+    else:
+        y_cv = _encode_labels(labels, how=how)
 
     if shuffle_data:
         # shuffle the data
@@ -265,462 +516,264 @@ def load_validation_data(data="validation", how="normal", which=5, percentage=1,
 
     return X_cv, y_cv
 
+## Memory-mapped version of load_validation_data. Nothing is read into memory here, the data is shuffled with an index
+## permutation and get_mapped_batches crops and scales it one batch at a time, so memory use depends on the batch size
+## rather than on the size of the dataset.
+## Returns: X_cv - memmap of the images
+##          y_cv - encoded labels, or a memmap of the masks
+##          idx - array - the order to read the examples in
+def load_validation_data_mmap(data="validation", how="normal", which=5, shuffle_data=1, data_dir=None):
+    data_path, labels_path = _validation_files(data=data, which=which, data_dir=data_dir)
+
+    X_cv = np.load(data_path, mmap_mode='r')
+
+    # the class labels are small so encode them now, masks are converted per batch and bit-packed masks are only
+    # unpacked a batch at a time
+    if how == "mask":
+        y_cv = load_masks(labels_path, X_cv.shape[2], mmap_mode='r')
+    else:
+        labels = np.load(labels_path, mmap_mode='r')
+        y_cv = _encode_labels(np.asarray(labels), how=how)
+
+    # this gives the same order as shuffling with sklearn using the same random state
+    if shuffle_data:
+        idx = np.random.RandomState(int(shuffle_data)).permutation(len(X_cv))
+    else:
+        idx = np.arange(len(X_cv))
+
+    return X_cv, y_cv, idx
+
+## Batch generator for data loaded with load_validation_data_mmap. Only the examples in the batch are read from disk,
+## masks are center-cropped to size and the images are optionally centered and scaled as float32. If prefetch is set
+## the batches are built in a background thread into reused buffers, see get_batches_prefetch.
+## Args: X - memmap of images
+##       y - labels or memmap of masks
+##       idx - array - order to read the examples in
+##       how - str - label type, masks are cropped along with the images
+##       size - int - size to center-crop masks and their images to
+##       scale - bool - whether to center and scale the images
+##       prefetch - int - number of batches to build ahead, 0 to build them on demand
+def get_mapped_batches(X, y, idx, batch_size, how="normal", size=640, scale=False, mu=127.0, scale_by=255.0, filenames=None, prefetch=0):
+    h, w = X.shape[1], X.shape[2]
+
+    # same center crop as load_validation_data
+    if how == "mask" and (h != size or w != size):
+        starty = h // 2 - (size // 2)
+        startx = w // 2 - (size // 2)
+        rows = slice(starty, starty + size)
+        cols = slice(startx, startx + size)
+        out_shape = (size, size) + X.shape[3:]
+    else:
+        rows = slice(None)
+        cols = slice(None)
+        out_shape = X.shape[1:]
+
+    # read each batch in file order so the reads are as sequential as possible
+    batch_indices = [np.sort(idx[i:i + batch_size]) for i in range(0, len(idx), batch_size)]
+
+    if prefetch:
+        n_slots = prefetch + 2
+        X_buffer = np.empty((n_slots, batch_size) + out_shape, dtype=np.float32 if scale else X.dtype)
+        if how == "mask":
+            y_buffer = np.empty((n_slots, batch_size) + out_shape, dtype=np.int32)
+
+    def fill(batch_idx, slot):
+        n = len(batch_idx)
+
+        if slot is None:
+            X_batch = X[batch_idx, rows, cols]
+
+            if scale:
+                X_batch = X_batch.astype(np.float32)
+        else:
+            X_batch = X_buffer[slot, :n]
+            X_batch[...] = X[batch_idx, rows, cols]
+
+        if scale:
+            X_batch -= mu
+            X_batch /= scale_by
+
+        if how == "mask":
+            if slot is None:
+                y_batch = y[batch_idx, rows, cols].astype(np.int32)
+            else:
+                y_batch = y_buffer[slot, :n]
+                y_batch[...] = y[batch_idx, rows, cols]
+        else:
+            y_batch = y[batch_idx]
+
+        if filenames is None:
+            return X_batch, y_batch
+        else:
+            return X_batch, y_batch, filenames[batch_idx]
+
+    if prefetch:
+        return _prefetch_batches(batch_indices, fill, prefetch=prefetch)
+    else:
+        return (fill(batch_idx, None) for batch_idx in batch_indices)
+
+## Validation or test data which is memory-mapped once and keeps the same shuffled order, so it can be evaluated on
+## every epoch without being reloaded from disk
+class EvaluationData(object):
+    def __init__(self, data="validation", how="normal", which=5, size=640, scale=True, shuffle_data=1, in_memory=False, prefetch=2):
+        self.how = how
+        self.size = size
+        self.scale = scale
+        self.prefetch = prefetch
+
+        self.X, self.y, self.idx = load_validation_data_mmap(data=data, how=how, which=which, shuffle_data=shuffle_data)
+
+        # optionally read the whole dataset into memory if there is room for it, keeping bit-packed masks packed
+        if in_memory:
+            self.X = np.array(self.X)
+
+            if isinstance(self.y, PackedMasks):
+                self.y = PackedMasks(np.array(self.y.packed), self.y.width)
+            else:
+                self.y = np.array(self.y)
+
+    def __len__(self):
+        return len(self.idx)
+
+    ## iterate over the data in batches, the order is the same every time. The next batches are built in the
+    ## background while the current one is used unless prefetch is 0.
+    def get_batches(self, batch_size, filenames=None):
+        return get_mapped_batches(self.X, self.y, self.idx, batch_size, how=self.how, size=self.size,
+                                  scale=self.scale, filenames=filenames, prefetch=self.prefetch)
+
+# evaluation datasets which have already been loaded in this process
+_evaluation_data = {}
+
+## Get an EvaluationData for the dataset, it is only loaded the first time it is requested and the same object is
+## returned after that
+def get_evaluation_data(data="validation", how="normal", which=5, size=640, scale=True, shuffle_data=1, in_memory=False, prefetch=2):
+    key = (data, how, which, size, scale, shuffle_data, in_memory, prefetch)
+
+    if key not in _evaluation_data:
+        _evaluation_data[key] = EvaluationData(data=data, how=how, which=which, size=size, scale=scale,
+                                               shuffle_data=shuffle_data, in_memory=in_memory, prefetch=prefetch)
+
+    return _evaluation_data[key]
+
+## Run the frozen layers of a model over the training data once and store their output activations and the labels on
+## disk, so the unfrozen layers can be trained from the stored activations without running the frozen layers again.
+## Args: sess - Session with the model restored and the input queues running
+##       features - Tensor - output of the last frozen layer
+##       labels - Tensor - labels from the input pipeline
+##       steps - int - number of batches to store, i.e. steps_per_epoch
+##       cache_dir - str - directory to write the cache to
+##       feed_dict - dict - feed for the frozen layers, normally {training: False}. With training False the batch norms
+##                   of the frozen layers use their moving averages, so the stored activations are the ones the model
+##                   gives at inference rather than the per batch statistics a frozen training step would use. Feed
+##                   {training: True} to store those instead.
+##       dtype - numpy dtype to store the activations as
+##       pack_masks - bool - bit-pack mask labels
+## Returns: number of examples stored
+def build_feature_cache(sess, features, labels, steps, cache_dir, feed_dict=None, dtype=np.float16, pack_masks=True):
+    if steps < 1:
+        raise ValueError("steps must be at least 1 to build a feature cache, got " + str(steps))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    features_store = None
+    count = 0
+
+    for i in range(steps):
+        feature_batch, label_batch = sess.run([features, labels], feed_dict=feed_dict)
+        n = len(feature_batch)
+
+        # create the stores once we know the batch size and shapes
+        if features_store is None:
+            total = steps * n
+            label_shape = label_batch.shape[1:]
+            packed = pack_masks and len(label_shape) > 1
+
+            features_store = np.lib.format.open_memmap(os.path.join(cache_dir, "features.npy"), mode="w+",
+                                                       dtype=dtype, shape=(total,) + feature_batch.shape[1:])
+
+            if packed:
+                labels_store = np.lib.format.open_memmap(os.path.join(cache_dir, "labels.npy"), mode="w+",
+                                                         dtype=np.uint8,
+                                                         shape=(total, (int(np.prod(label_shape)) + 7) // 8))
+            else:
+                labels_store = np.lib.format.open_memmap(os.path.join(cache_dir, "labels.npy"), mode="w+",
+                                                         dtype=label_batch.dtype, shape=(total,) + label_shape)
+
+        # the last batch may be smaller if the input has a limited number of epochs
+        n = min(n, len(features_store) - count)
+        features_store[count:count + n] = feature_batch[:n]
+
+        if packed:
+            labels_store[count:count + n] = np.packbits(label_batch[:n].reshape(n, -1) > 0, axis=1)
+        else:
+            labels_store[count:count + n] = label_batch[:n]
+
+        count += n
+
+        if i % 100 == 0:
+            print("Cached features for", count, "examples")
+
+    features_store.flush()
+    labels_store.flush()
+
+    with open(os.path.join(cache_dir, "features.json"), "w") as f:
+        json.dump({"records": count, "label_shape": list(label_shape), "packed": bool(packed)}, f)
+
+    return count
+
+## Activations and labels written by build_feature_cache, memory-mapped and served in shuffled batches
+class FeatureCache(object):
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "features.json")) as f:
+            info = json.load(f)
+
+        self.records = info["records"]
+        self.label_shape = tuple(info["label_shape"])
+        self.packed = info["packed"]
+
+        self.features = np.load(os.path.join(cache_dir, "features.npy"), mmap_mode='r')
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return self.records
+
+    ## iterate over shuffled batches of float32 activations and labels
+    def get_batches(self, batch_size, shuffle=True):
+        idx = np.arange(self.records)
+        if shuffle:
+            np.random.shuffle(idx)
+
+        pixels = int(np.prod(self.label_shape))
+
+        for i in range(0, self.records, batch_size):
+            # read in file order
+            batch_idx = np.sort(idx[i:i + batch_size])
+
+            features = self.features[batch_idx].astype(np.float32)
+
+            if self.packed:
+                labels = np.unpackbits(self.labels[batch_idx], axis=1)[:, :pixels]
+                labels = labels.reshape((len(batch_idx),) + self.label_shape).astype(np.int32)
+            else:
+                labels = self.labels[batch_idx]
+
+            yield features, labels
+
 ## Download the data if it doesn't already exist, many datasets have been created, which one to download can be specified using
 ## the what argument
-def download_data(what=4):
-    if what == 8:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training8_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_0.zip',
-                              'training8_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_1.zip',
-                              'training8_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_2.zip',
-                              'training8_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_3.zip',
-                              'training8_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_4.zip',
-                              'training8_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test8_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_data.zip',
-                              'test8_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test8_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_filenames.npy',
-                              'test8_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test8_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_labels.npy',
-                              'test8_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv8_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_data.zip', 'cv8_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv8_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_labels.npy','cv8_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv8_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_filenames.npy',
-                              'cv8_filenames.npy')
-    elif what == 100:
-        # download and unzip images
-        if not os.path.exists(os.path.join("data", "train_images", "P_00008_LEFT_CC_10.png")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/train_images0.zip',
-                              'train_images0.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00510_RIGHT_CC_791.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images1.zip',
-                              'train_images1.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01009_RIGHT_CC_1583.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2.zip',
-                              'train_images2.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01252_RIGHT_CC_1953.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images3.zip',
-                              'train_images3.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01741_RIGHT_CC_2710.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images4.zip',
-                              'train_images4.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01501_RIGHT_CC_2343.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images5.zip',
-                              'train_images5.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00751_LEFT_CC_1184.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images6.zip',
-                              'train_images6.zip')
-
-        if not os.path.exists(os.path.join("data", "cv100_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv100_data.zip',
-                              'cv100_data.zip')
-
-        if not os.path.exists(os.path.join("data", "cv100_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv100_labels.zip',
-                              'cv100_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test100_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test100_data.zip',
-                              'test100_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test100_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test100_labels.zip',
-                              'test100_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test101_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test101_labels.zip',
-                              'test101_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "cv101_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv101_labels.zip',
-                              'cv101_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test101_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test101_data.zip',
-                              'test101_data.zip')
-
-        if not os.path.exists(os.path.join("data", "cv101_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv101_data.zip',
-                              'cv101_data.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00008_RIGHT_MLO_13_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_0.zip',
-                              'train_images2_0.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00701_LEFT_CC_844_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_1.zip',
-                              'train_images2_1.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01313_LEFT_CC_1626_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_2.zip',
-                              'train_images2_2.zip')
-    elif what == 9:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training9_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_0.zip',
-                              'training9_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_1.zip',
-                              'training9_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_2.zip',
-                              'training9_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_3.zip',
-                              'training9_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_4.zip',
-                              'training9_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test9_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_data.zip',
-                              'test9_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test9_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_filenames.npy',
-                              'test9_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test9_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_labels.npy',
-                              'test9_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv9_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_data.zip', 'cv9_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv9_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_labels.npy','cv9_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv9_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_filenames.npy',
-                              'cv9_filenames.npy')
-    elif what == 10:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training10_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_0.zip',
-                              'training10_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_1.zip',
-                              'training10_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_2.zip',
-                              'training10_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_3.zip',
-                              'training10_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_4.zip',
-                              'training10_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test10_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test10_data.zip',
-                              'test10_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test10_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test10_labels.npy',
-                              'test10_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv10_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv10_data.zip', 'cv10_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv10_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv10_labels.npy','cv10_labels.npy')
-    
-    elif what == 11:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training11_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_0.zip',
-                              'training11_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_1.zip',
-                              'training11_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_2.zip',
-                              'training11_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_3.zip',
-                              'training11_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_4.zip',
-                              'training11_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test11_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test11_data.zip',
-                              'test11_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test11_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test11_labels.zip',
-                              'test11_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv11_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv11_data.zip', 'cv11_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv11_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv11_labels.zip','cv11_labels.zip')
-
-    elif what == 12:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training12_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_0.zip',
-                              'training12_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_1.zip',
-                              'training12_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_2.zip',
-                              'training12_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_3.zip',
-                              'training12_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_4.zip',
-                              'training12_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test12_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test12_data.zip',
-                              'test12_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test12_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test12_labels.zip',
-                              'test12_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv12_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv12_data.zip', 'cv12_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv12_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv12_labels.zip',
-                              'cv12_labels.zip')
-            
-    elif what == 13:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training13_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_0.zip',
-                              'training13_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_1.zip',
-                              'training13_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_2.zip',
-                              'training13_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_3.zip',
-                              'training13_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_4.zip',
-                              'training13_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test13_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test13_data.zip',
-                              'test13_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test13_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test13_labels.zip',
-                              'test13_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv13_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv13_data.zip', 'cv13_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv13_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv13_labels.zip',
-                              'cv13_labels.zip')
-    elif what == 0:
-        # download MIAS test data
-        if not os.path.exists(os.path.join("data", "mias_test_images.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_slices.npy',
-                              'mias_test_images.npy')
-
-        if not os.path.exists(os.path.join("data", "mias_test_labels_enc.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_labels.npy',
-                              'mias_test_labels_enc.npy')
-
-        # download MIAS test data
-        if not os.path.exists(os.path.join("data", "all_mias_slices9.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_slices9.npy',
-                              'all_mias_slices9.npy')
-
-        if not os.path.exists(os.path.join("data", "all_mias_labels9.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_labels9.npy',
-                              'all_mias_labels9.npy')
-
-    elif what ==6:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training6_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_0.zip',
-                              'training6_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_1.zip',
-                              'training6_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_2.zip',
-                              'training6_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_3.zip',
-                              'training6_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_4.zip',
-                              'training6_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test6_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_data.zip',
-                              'test6_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test6_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_filenames.npy',
-                              'test6_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test6_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_labels.npy',
-                              'test6_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv6_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_data.zip',
-                              'cv6_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv6_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_labels.npy',
-                              'cv6_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv6_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_filenames.npy',
-                              'cv6_filenames.npy')
+## Args: what - int - which dataset
+##       data_dir - str - directory to download to
+##       base_url - str - download the files from here instead of the locations in datasets.json
+##       workers - int - number of files to download at a time
+def download_data(what=4, data_dir="data", base_url=None, workers=4):
+    return fetch_dataset(what, data_dir=data_dir, base_url=base_url, workers=workers)
 
 ## Load the training data and return a list of the tfrecords file and the size of the dataset
-## Multiple data sets have been created for this project, which one to be used can be set with the type argument
-def get_training_data(what=5):
-    if what == 8:
-        train_path_10 = os.path.join("data", "training8_0.tfrecords")
-        train_path_11 = os.path.join("data", "training8_1.tfrecords")
-        train_path_12 = os.path.join("data", "training8_2.tfrecords")
-        train_path_13 = os.path.join("data", "training8_3.tfrecords")
-        train_path_14 = os.path.join("data", "training8_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 40559
-
-    elif what == 9:
-        train_path_10 = os.path.join("data", "training9_0.tfrecords")
-        train_path_11 = os.path.join("data", "training9_1.tfrecords")
-        train_path_12 = os.path.join("data", "training9_2.tfrecords")
-        train_path_13 = os.path.join("data", "training9_3.tfrecords")
-        train_path_14 = os.path.join("data", "training9_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 43739
-
-    elif what == 10:
-        train_path_10 = os.path.join("data", "training10_0.tfrecords")
-        train_path_11 = os.path.join("data", "training10_1.tfrecords")
-        train_path_12 = os.path.join("data", "training10_2.tfrecords")
-        train_path_13 = os.path.join("data", "training10_3.tfrecords")
-        train_path_14 = os.path.join("data", "training10_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 55890
-
-    elif what == 12:
-        train_path_10 = os.path.join("data", "training12_0.tfrecords")
-        train_path_11 = os.path.join("data", "training12_1.tfrecords")
-        train_path_12 = os.path.join("data", "training12_2.tfrecords")
-        train_path_13 = os.path.join("data", "training12_3.tfrecords")
-        train_path_14 = os.path.join("data", "training12_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 36755
-        
-    elif what == 13:
-        train_path_10 = os.path.join("data", "training13_0.tfrecords")
-        train_path_11 = os.path.join("data", "training13_1.tfrecords")
-        train_path_12 = os.path.join("data", "training13_2.tfrecords")
-        train_path_13 = os.path.join("data", "training13_3.tfrecords")
-        train_path_14 = os.path.join("data", "training13_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 13548
-    else:
-        raise ValueError('Invalid dataset!')
-
-    return train_files, total_records
+## Multiple data sets have been created for this project, which one to be used can be set with the type argument.
+## The shards and record counts are listed in datasets.json, run index_tfrecords.py -u to record exact counts.
+def get_training_data(what=5, data_dir=None, packed=False):
+    return training_shards(what, data_dir=data_dir, packed=packed)
 
 def evaluate_model():
     pass
@@ -953,7 +1006,11 @@ def _parse_function(filename, size=640):
 #       distort - bool - whether or not to do online data augmentation
 # Returns: image - Tensor of image, shape (crop_size, crop_size, 1)
 #          label - Tensor of label, shape (crop_size, crop_size, 1)
-def _read_images(image_dir, crop_size, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False):
+#       crops_per_image - int - if more than 1, this many crops are taken from each decoded image and returned as a
+#                         batch of shape (crops_per_image, crop_size, crop_size, 1), use enqueue_many to batch them
+#       tile_filter - TileFilter - take the crops from positions which are not mostly background, or None
+def _read_images(image_dir, crop_size, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False, crops_per_image=1,
+                 tile_filter=None):
     filenames = tf.train.match_filenames_once(image_dir + "*.png")
     filename_queue = tf.train.string_input_producer(filenames, capacity=2048, name="file_queue")
 
@@ -967,9 +1024,16 @@ def _read_images(image_dir, crop_size, scale_by=0.66, mu=127.0, scale=255.0, dis
     raw_image = tf.image.decode_png(image_file)
 
     # call function to process and crop images
-    return _process_images(raw_image, crop_size=crop_size, scale_by=scale_by, mu=127.0, scale=255.0, distort=distort, standardize=standardize)
+    return _process_images(raw_image, crop_size=crop_size, scale_by=scale_by, mu=127.0, scale=255.0, distort=distort, standardize=standardize, crops_per_image=crops_per_image,
+                           tile_filter=tile_filter)
+
+def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False, crops_per_image=1,
+                    tile_filter=None, filter_candidates=8):
+    if crops_per_image > 1:
+        return _process_images_multi(raw_image, crops_per_image, crop_size=crop_size, scale_by=scale_by, mu=mu,
+                                     scale=scale, distort=distort, standardize=standardize, tile_filter=tile_filter,
+                                     filter_candidates=filter_candidates)
 
-def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False):
     # figure out size of raw crop by dividing size by scale
     if scale_by != 1.0:
         image_size = int(crop_size // scale_by)
@@ -980,12 +1044,77 @@ def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255
     nnoise = tf.random_normal([1], mean=1.0, stddev=0.025)
     noisy_image_size = tf.cast(image_size * nnoise, dtype=tf.int32)
 
-    # random crop the image
-    raw_image = tf.random_crop(raw_image, size=[noisy_image_size[0], noisy_image_size[0], 3])
-
-    # if applicable, resize the image to the destination size
+    # random crop the image, checking the mean and variance of a few positions first if we are filtering out background
+    if tile_filter is not None:
+        ys, xs = tile_filter.random_crops(raw_image[:, :, 0], noisy_image_size[0], candidates=filter_candidates)
+        raw_image = tf.slice(raw_image, tf.stack([ys[0], xs[0], 0]),
+                             tf.stack([noisy_image_size[0], noisy_image_size[0], 3]))
+    else:
+        raw_image = tf.random_crop(raw_image, size=[noisy_image_size[0], noisy_image_size[0], 3])
+
+    return _finish_crop(raw_image, crop_size=crop_size, resize=(scale_by != 1.0), mu=mu, scale=scale, distort=distort,
+                        standardize=standardize)
+
+## Take crops_per_image random crops from one decoded image in a single crop_and_resize, which applies the scale_by
+## factor and the 2.5% size noise to all of the crops at once. This spreads the cost of decoding an image over all of
+## its crops. With a tile_filter the positions are picked from filter_candidates per crop which are not background.
+## Returns: images - Tensor of images, shape (crops_per_image, crop_size, crop_size, 1)
+##          labels - Tensor of labels, shape (crops_per_image, crop_size, crop_size, 1)
+def _process_images_multi(raw_image, crops_per_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False,
+                          tile_filter=None, filter_candidates=8):
+    # figure out size of raw crop by dividing size by scale
     if scale_by != 1.0:
+        image_size = int(crop_size // scale_by)
+    else:
         image_size = crop_size
+
+    shape = tf.shape(raw_image)
+    height = tf.cast(shape[0], tf.float32)
+    width = tf.cast(shape[1], tf.float32)
+
+    # noisy size and random position for each crop
+    sizes = image_size * tf.random_normal([crops_per_image], mean=1.0, stddev=0.025)
+    sizes = tf.minimum(sizes, tf.minimum(height, width))
+
+    if tile_filter is not None:
+        # filter at the nominal size, the noisy crops are moved back inside the image if they go over the edge
+        filter_size = tf.minimum(image_size, tf.minimum(shape[0], shape[1]))
+        ys, xs = tile_filter.random_crops(raw_image[:, :, 0], filter_size, n=crops_per_image,
+                                          candidates=crops_per_image * filter_candidates)
+        y1 = tf.minimum(tf.cast(ys, tf.float32), height - sizes)
+        x1 = tf.minimum(tf.cast(xs, tf.float32), width - sizes)
+    else:
+        y1 = tf.random_uniform([crops_per_image]) * (height - sizes)
+        x1 = tf.random_uniform([crops_per_image]) * (width - sizes)
+
+    # crop_and_resize takes the boxes in normalized coordinates
+    boxes = tf.stack([y1 / (height - 1), x1 / (width - 1),
+                      (y1 + sizes - 1) / (height - 1), (x1 + sizes - 1) / (width - 1)], axis=1)
+
+    crops = tf.image.crop_and_resize(tf.expand_dims(tf.cast(raw_image[:, :, :2], tf.float32), 0), boxes,
+                                     tf.zeros([crops_per_image], dtype=tf.int32), [crop_size, crop_size])
+
+    # extract the images and labels from the channels
+    images = crops[:, :, :, 0:1]
+    labels = tf.cast(crops[:, :, :, 1:2], dtype=tf.int32)
+
+    if standardize:
+        images = tf.map_fn(tf.image.per_image_standardization, images)
+    else:
+        # scale the images
+        images = _scale_input_data(images, contrast=None, mu=mu, scale=scale)
+
+    if distort:
+        images, labels = augment(images, labels, horizontal_flip=True, augment_labels=True, vertical_flip=True, mixup=0)
+
+    return images, labels
+
+## resize a raw crop to the crop size, split it into the image and label and scale the image
+def _finish_crop(raw_image, crop_size=640, resize=True, mu=127.0, scale=255.0, distort=False, standardize=False):
+    image_size = crop_size
+
+    # if applicable, resize the image to the destination size
+    if resize:
         raw_image = tf.image.resize_images(raw_image, [image_size, image_size])
 
     # extract the image and label from the channels and resize them for convnet
@@ -1001,7 +1130,132 @@ def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255
         # scale the image
         image = _scale_input_data(image, contrast=None, mu=mu, scale=scale)
 
+    # augment works on batches, so the crop is augmented as a batch of one
     if distort:
-        image, label = augment(image, label, horizontal_flip=True, augment_labels=True, vertical_flip=True, mixup=0)
+        images, labels = augment(tf.expand_dims(image, 0), tf.expand_dims(label, 0), horizontal_flip=True,
+                                 augment_labels=True, vertical_flip=True, mixup=0)
+        image = tf.reshape(images[0], [image_size, image_size, 1])
+        label = tf.reshape(labels[0], [image_size, image_size, 1])
+
+    return image, label
+
+## Decode every png in image_dir once and store the image and label channels as raw uint8 in shards,
+## so training crops can be taken without decoding any pngs. The scale_by the images were resized by is stored with
+## them so they are not resized twice.
+## Args: image_dir - str - directory of the training pngs
+##       cache_dir - str - directory to write the shards and index to
+##       scale_by - float - optionally resize the images by this factor before storing them
+##       shard_bytes - int - approximate maximum size of each shard, an image is never split across shards
+## Returns: number of images cached
+def build_image_cache(image_dir, cache_dir, scale_by=None, shard_bytes=2 ** 30):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    filenames = sorted([f for f in os.listdir(image_dir) if f.endswith(".png")])
+
+    # graph to decode and optionally resize each image, only the image and label channels are kept
+    graph = tf.Graph()
+    with graph.as_default():
+        png = tf.placeholder(tf.string, shape=[])
+        decoded = tf.image.decode_png(png, channels=3)[:, :, :2]
+
+        if scale_by is not None and scale_by != 1.0:
+            shape = tf.cast(tf.shape(decoded)[:2], tf.float32) * scale_by
+            decoded = tf.image.resize_images(decoded, tf.cast(tf.round(shape), tf.int32))
+            decoded = tf.cast(tf.round(decoded), tf.uint8)
+
+    # each row is shard, offset, height, width
+    index = np.zeros((len(filenames), 4), dtype=np.int64)
+    shard = 0
+    shard_file = None
+
+    with tf.Session(graph=graph) as sess:
+        for i, filename in enumerate(filenames):
+            with open(os.path.join(image_dir, filename), "rb") as f:
+                image = sess.run(decoded, feed_dict={png: f.read()})
+
+            # start a new shard when this one is full
+            if shard_file is None or shard_file.tell() + image.nbytes > shard_bytes:
+                if shard_file is not None:
+                    shard_file.close()
+                    shard += 1
+
+                shard_file = open(os.path.join(cache_dir, "images_" + str(shard) + ".bin"), "wb")
+
+            index[i] = [shard, shard_file.tell(), image.shape[0], image.shape[1]]
+            shard_file.write(np.ascontiguousarray(image).tobytes())
+
+            if i % 500 == 0:
+                print("Cached", i, "of", len(filenames), "images")
+
+    if shard_file is not None:
+        shard_file.close()
+
+    np.save(os.path.join(cache_dir, "index.npy"), index)
+    np.save(os.path.join(cache_dir, "filenames.npy"), np.array(filenames))
+
+    with open(os.path.join(cache_dir, "cache.json"), "w") as f:
+        json.dump({"images": len(filenames), "shards": shard + 1, "scale_by": scale_by}, f)
+
+    return len(filenames)
+
+## The index of the decoded images written by build_image_cache, each image is stored at its offset in its shard
+class ImageCache(object):
+    def __init__(self, cache_dir):
+        self.index = np.load(os.path.join(cache_dir, "index.npy"))
+
+        with open(os.path.join(cache_dir, "cache.json")) as f:
+            info = json.load(f)
+
+        self.scale_by = info["scale_by"]
+        self.shard_paths = [os.path.join(cache_dir, "images_" + str(i) + ".bin") for i in range(info["shards"])]
+
+    def __len__(self):
+        return len(self.index)
+
+## Same as _read_images but the crops are taken from an ImageCache instead of decoding the pngs. Each image is read
+## from its offset in its shard as a single fixed length record, so only that image's bytes are read and the reads and
+## crops run in parallel in tensorflow. The images are read in a new random order every epoch. If the cache was built
+## with scale_by already applied the crops only need a small resize to remove the size noise.
+## Args: num_parallel_calls - int - number of images to read and crop at once
+## Returns: image - Tensor of image, shape (crop_size, crop_size, 1)
+##          label - Tensor of label, shape (crop_size, crop_size, 1)
+def _read_cached_images(cache_dir, crop_size, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False,
+                        num_parallel_calls=4):
+    cache = ImageCache(cache_dir)
+
+    if cache.scale_by is not None and cache.scale_by != scale_by:
+        raise ValueError("The images in " + cache_dir + " were resized by " + str(cache.scale_by) + " but scale_by is " +
+                         str(scale_by) + ", rebuild the cache with the same scale")
+
+    # if the cache was not pre-scaled take a larger crop and resize it down
+    if cache.scale_by is None and scale_by != 1.0:
+        raw_size = int(crop_size // scale_by)
+    else:
+        raw_size = crop_size
+
+    paths = [cache.shard_paths[shard] for shard in cache.index[:, 0]]
+    dataset = tf.data.Dataset.from_tensor_slices((paths, cache.index[:, 1], cache.index[:, 2], cache.index[:, 3]))
+    dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(len(cache)))
+
+    # read each image as one record starting at its offset
+    def read(path, offset, height, width):
+        record = tf.data.FixedLengthRecordDataset(path, height * width * 2, header_bytes=offset).take(1)
+        return record.map(lambda raw: tf.reshape(tf.decode_raw(raw, tf.uint8), tf.stack([height, width, 2])))
+
+    dataset = dataset.apply(tf.contrib.data.parallel_interleave(read, cycle_length=num_parallel_calls))
+
+    def crop(image):
+        # add a small amount of random noise to the size for variety, the same as _process_images
+        shape = tf.shape(image)
+        size = tf.cast(raw_size * tf.random_normal([], mean=1.0, stddev=0.025), tf.int32)
+        size = tf.minimum(size, tf.minimum(shape[0], shape[1]))
+
+        raw_image = tf.random_crop(image, size=tf.stack([size, size, 2]))
+
+        return _finish_crop(raw_image, crop_size=crop_size, resize=True, mu=mu, scale=scale, distort=distort,
+                            standardize=standardize)
+
+    dataset = dataset.map(crop, num_parallel_calls=num_parallel_calls).prefetch(num_parallel_calls)
 
-    return image, label
\ No newline at end of file
+    return dataset.make_one_shot_iterator().get_next()